@@ -0,0 +1,260 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import math
+import hashlib
+
+# Indexes into AGGREGATE_LABELS
+AGG_COUNT = 0
+AGG_SUM = 1
+AGG_MEAN = 2
+AGG_MIN = 3
+AGG_MAX = 4
+AGG_STDDEV = 5
+AGG_DISTINCT = 6
+AGG_PERCENTILE = 7
+# Name of the output attribute of each aggregate. Count and sum are saved in NUMPOINTS.
+AGGREGATE_FIELDS = [None, None, 'MEAN', 'MIN', 'MAX', 'STDDEV', 'DISTINCT', 'PERCENTILE']
+
+# A HyperLogLog has 2^HLL_PRECISION registers for a standard error of about 3%
+HLL_PRECISION = 10
+# Distinct hashes are kept exactly until there are more than this
+HLL_SPARSE_LIMIT = 128
+TDIGEST_COMPRESSION = 100
+
+def isNull(value):
+    # NULL attributes are a null QVariant, which is checked without importing Qt
+    return value is None or (type(value).__name__ == 'QVariant' and value.isNull())
+
+def hashValue(value):
+    '''Returns a 64 bit hash of the value that is the same from one QGIS session to the next.'''
+    return int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'little')
+
+class HyperLogLog():
+    '''
+    Approximate count of distinct values. Small sets of hashes are kept exactly and are only
+    converted to registers once they exceed HLL_SPARSE_LIMIT, so that most cells of a density
+    map use little memory and have an exact count.
+    '''
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.sparse = set()
+        self.registers = None
+
+    def add(self, value):
+        self.addHash(hashValue(value))
+
+    def addHash(self, h):
+        if self.registers is None:
+            self.sparse.add(h)
+            if len(self.sparse) > HLL_SPARSE_LIMIT:
+                self.registers = bytearray(1 << self.precision)
+                for s in self.sparse:
+                    self.addRegister(s)
+                self.sparse = None
+        else:
+            self.addRegister(h)
+
+    def addRegister(self, h):
+        p = self.precision
+        index = h & ((1 << p) - 1)
+        # Position of the leftmost 1 bit of the remaining 64 - p bits
+        rank = 64 - p - (h >> p).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.registers is None:
+            for h in other.sparse:
+                self.addHash(h)
+            return
+        if self.registers is None:
+            self.registers = bytearray(1 << self.precision)
+            for s in self.sparse:
+                self.addRegister(s)
+            self.sparse = None
+        registers = self.registers
+        for i, r in enumerate(other.registers):
+            if r > registers[i]:
+                registers[i] = r
+
+    def count(self):
+        if self.registers is None:
+            return len(self.sparse)
+        m = len(self.registers)
+        alpha = 0.7213 / (1.0 + 1.079 / m)
+        estimate = alpha * m * m / sum([2.0 ** -r for r in self.registers])
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+class TDigest():
+    '''
+    Merging t-digest for approximate percentiles. Values are buffered and periodically
+    merged into at most about compression centroids, which are smaller at the tails
+    so that high percentiles such as the 95th or 99th stay accurate.
+    '''
+    def __init__(self, compression=TDIGEST_COMPRESSION):
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.buffer = []
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value):
+        self.buffer.append(value)
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        if len(self.buffer) >= self.compression:
+            self.compress()
+
+    def scale(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def inverseScale(self, k):
+        if k >= self.compression / 4:
+            return 1.0
+        return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def compress(self):
+        if not self.buffer:
+            return
+        centroids = list(zip(self.means, self.weights)) + [(v, 1.0) for v in self.buffer]
+        centroids.sort()
+        self.buffer = []
+        total = self.total + len(centroids) - len(self.means)
+        self.total = total
+        means = []
+        weights = []
+        so_far = 0.0
+        limit = total * self.inverseScale(self.scale(0.0) + 1)
+        mean, weight = centroids[0]
+        for m, w in centroids[1:]:
+            if so_far + weight + w <= limit:
+                weight += w
+                mean += (m - mean) * w / weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                so_far += weight
+                limit = total * self.inverseScale(self.scale(so_far / total) + 1)
+                mean, weight = m, w
+        means.append(mean)
+        weights.append(weight)
+        self.means = means
+        self.weights = weights
+
+    def quantile(self, q):
+        self.compress()
+        n = len(self.means)
+        if n == 0:
+            return None
+        if q <= 0:
+            return self.minimum
+        if q >= 1:
+            return self.maximum
+        if n == 1:
+            return self.means[0]
+        target = q * self.total
+        # Each centroid is centered on its share of the cumulative weight
+        cumulative = self.weights[0] / 2
+        if target < cumulative:
+            return self.minimum + (self.means[0] - self.minimum) * target / cumulative
+        for i in range(n - 1):
+            step = (self.weights[i] + self.weights[i + 1]) / 2
+            if target < cumulative + step:
+                return self.means[i] + (self.means[i + 1] - self.means[i]) * (target - cumulative) / step
+            cumulative += step
+        remaining = self.total - cumulative
+        if remaining <= 0:
+            return self.maximum
+        return self.means[-1] + (self.maximum - self.means[-1]) * min((target - cumulative) / remaining, 1.0)
+
+class CellAggregate():
+    '''
+    Aggregate of one attribute over the points in a density cell. Every point is counted
+    in count while only the non-null values are aggregated. The memory used by each cell
+    is bounded regardless of the number of points.
+    '''
+    def __init__(self, aggregate, percentile=95):
+        self.aggregate = aggregate
+        self.count = 0
+        if aggregate == AGG_DISTINCT:
+            self.sketch = HyperLogLog()
+        elif aggregate == AGG_PERCENTILE:
+            self.sketch = TDigest()
+            self.percentile = percentile / 100.0
+        else:
+            self.sketch = None
+            # Running statistics using Welford's algorithm
+            self.n = 0
+            self.mean = 0.0
+            self.m2 = 0.0
+            self.minimum = None
+            self.maximum = None
+
+    def add(self, value):
+        self.count += 1
+        if isNull(value):
+            return
+        if self.aggregate == AGG_DISTINCT:
+            self.sketch.add(value)
+            return
+        try:
+            value = float(value)
+        except Exception:
+            return
+        if value != value:
+            return
+        if self.aggregate == AGG_PERCENTILE:
+            self.sketch.add(value)
+            return
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def value(self):
+        '''Returns the aggregate of the cell or None if it had no values.'''
+        if self.aggregate == AGG_DISTINCT:
+            return self.sketch.count()
+        if self.aggregate == AGG_PERCENTILE:
+            return self.sketch.quantile(self.percentile)
+        if self.n == 0:
+            return None
+        if self.aggregate == AGG_MEAN:
+            return self.mean
+        if self.aggregate == AGG_MIN:
+            return self.minimum
+        if self.aggregate == AGG_MAX:
+            return self.maximum
+        # Population standard deviation
+        return math.sqrt(self.m2 / self.n)
+
+def aggregateFactory(aggregate, percentile=95):
+    '''
+    Returns a function that creates the CellAggregate of a new cell, or None for count and
+    sum, which are accumulated as plain numbers.
+    '''
+    if aggregate in (AGG_COUNT, AGG_SUM):
+        return None
+    def newAggregate():
+        return CellAggregate(aggregate, percentile)
+    return newAggregate
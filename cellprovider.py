@@ -0,0 +1,342 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import (
+    QgsVectorDataProvider,
+    QgsDataProvider,
+    QgsAbstractFeatureSource,
+    QgsAbstractFeatureIterator,
+    QgsFeatureIterator,
+    QgsFeatureRequest,
+    QgsFeature,
+    QgsFields,
+    QgsField,
+    QgsGeometry,
+    QgsPointXY,
+    QgsRectangle,
+    QgsWkbTypes,
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
+    QgsCsException,
+    QgsExpressionContext,
+    QgsExpressionContextUtils,
+    QgsProviderRegistry,
+    QgsProviderMetadata)
+from .cellstore import CellStore, cellKey
+from .hotspots import CELL_GEOHASH, CELL_H3
+
+CELL_PROVIDER_KEY = 'densitycells'
+CELL_TABLE_FILTER = 'Density cell tables (*.npz *.parquet)'
+# Number of synthesized cell polygons that are kept between requests
+GEOMETRY_CACHE_SIZE = 200000
+
+def geohashExtents(ids):
+    '''
+    Returns an (n, 4) array of the xmin, ymin, xmax, ymax of geohash ids packed with
+    geohash.to_int. The bits are de-interleaved with numpy one bit position at a time.
+    '''
+    extents = np.zeros((len(ids), 4), dtype=np.float64)
+    for length in range(1, 13):
+        num_bits = 5 * length
+        mask = (ids >> num_bits) == 1
+        if not mask.any():
+            continue
+        bits = ids[mask] & ((1 << num_bits) - 1)
+        lon = np.zeros(len(bits), dtype=np.int64)
+        lat = np.zeros(len(bits), dtype=np.int64)
+        for i in range(num_bits):
+            bit = (bits >> (num_bits - 1 - i)) & 1
+            # Geohash bits alternate starting with longitude
+            if i % 2 == 0:
+                lon = (lon << 1) | bit
+            else:
+                lat = (lat << 1) | bit
+        lon_size = 360.0 / 2 ** ((num_bits + 1) // 2)
+        lat_size = 180.0 / 2 ** (num_bits // 2)
+        x_min = lon * lon_size - 180.0
+        y_min = lat * lat_size - 90.0
+        extents[mask] = np.column_stack((x_min, y_min, x_min + lon_size, y_min + lat_size))
+    return extents
+
+def h3Boundary(h3, cell_id):
+    return [QgsPointXY(p[1], p[0]) for p in h3.h3_to_geo_boundary(cell_id)]
+
+def h3Extents(h3, ids):
+    extents = np.zeros((len(ids), 4), dtype=np.float64)
+    for i, cell_id in enumerate(ids.tolist()):
+        coords = h3.h3_to_geo_boundary(cell_id)
+        lats = [p[0] for p in coords]
+        lons = [p[1] for p in coords]
+        extents[i] = (min(lons), min(lats), max(lons), max(lats))
+    return extents
+
+def loadCellTable(path):
+    '''
+    Reads a cell store saved by the density grids or a Parquet cell table. Returns the
+    cell type, the int64 cell ids and an ordered dictionary of the numeric columns.
+    '''
+    columns = OrderedDict()
+    if os.path.splitext(path)[1].lower() == '.parquet':
+        import pyarrow.parquet as pq
+        import pyarrow.types as pt
+        table = pq.read_table(path)
+        names = table.column_names
+        if 'GEOHASH' in names or 'H3HASH' in names:
+            cell_type = CELL_GEOHASH if 'GEOHASH' in names else CELL_H3
+            for name in names:
+                column = table.column(name)
+                if name != 'CELL_ID' and (pt.is_integer(column.type) or pt.is_floating(column.type)):
+                    columns[name] = column.to_numpy().astype(np.float64)
+            return cell_type, table.column('CELL_ID').to_numpy(), columns
+    store = CellStore.load(path)
+    columns['NUMPOINTS'] = store.values
+    return store.cell_type, store.ids, columns
+
+class CellTableFeatureIterator(QgsAbstractFeatureIterator):
+    def __init__(self, source, request):
+        super(CellTableFeatureIterator, self).__init__(request)
+        self._request = request if request is not None else QgsFeatureRequest()
+        self._source = source
+        provider = source._provider
+        self._transform = QgsCoordinateTransform()
+        if self._request.destinationCrs().isValid() and self._request.destinationCrs() != provider.crs():
+            self._transform = QgsCoordinateTransform(provider.crs(), self._request.destinationCrs(), self._request.transformContext())
+        try:
+            filter_rect = self.filterRectToSourceCrs(self._transform)
+        except QgsCsException:
+            self._rows = []
+            self._index = 0
+            return
+        if self._request.filterType() == QgsFeatureRequest.FilterFid:
+            rows = np.array([self._request.filterFid()], dtype=np.int64)
+        elif self._request.filterType() == QgsFeatureRequest.FilterFids:
+            rows = np.array(sorted(self._request.filterFids()), dtype=np.int64)
+        else:
+            rows = None
+        if rows is not None:
+            rows = rows[(rows >= 0) & (rows < provider.featureCount())]
+        if not filter_rect.isNull():
+            # Only the cells whose cached bounding box intersects the rectangle are synthesized
+            extents = provider.cellExtents()
+            mask = ((extents[:, 0] <= filter_rect.xMaximum()) & (extents[:, 2] >= filter_rect.xMinimum()) &
+                (extents[:, 1] <= filter_rect.yMaximum()) & (extents[:, 3] >= filter_rect.yMinimum()))
+            if rows is None:
+                rows = np.flatnonzero(mask)
+            else:
+                rows = rows[mask[rows]]
+            if self._request.flags() & QgsFeatureRequest.ExactIntersect:
+                self._rect_geom = QgsGeometry.fromRect(filter_rect)
+            else:
+                self._rect_geom = None
+        else:
+            self._rect_geom = None
+        self._rows = range(provider.featureCount()) if rows is None else rows.tolist()
+        self._index = 0
+        self._geometry = not (self._request.flags() & QgsFeatureRequest.NoGeometry) or self._rect_geom is not None
+        if self._request.filterType() == QgsFeatureRequest.FilterExpression:
+            self._expression = self._request.filterExpression()
+            self._expression.prepare(source._expression_context)
+        else:
+            self._expression = None
+
+    def fetchFeature(self, f):
+        provider = self._source._provider
+        while self._index < len(self._rows):
+            row = self._rows[self._index]
+            self._index += 1
+            feature = QgsFeature(provider.fields(), row)
+            feature.setAttributes(provider.attributes(row))
+            if self._geometry:
+                geom = provider.cellGeometry(row)
+                if self._rect_geom is not None and not self._rect_geom.intersects(geom):
+                    continue
+                feature.setGeometry(geom)
+            if self._expression is not None:
+                self._source._expression_context.setFeature(feature)
+                if not self._expression.evaluate(self._source._expression_context):
+                    continue
+            self.geometryToDestinationCrs(feature, self._transform)
+            f.setFields(feature.fields())
+            f.setId(row)
+            f.setAttributes(feature.attributes())
+            if feature.hasGeometry():
+                f.setGeometry(feature.geometry())
+            else:
+                f.clearGeometry()
+            f.setValid(True)
+            return True
+        f.setValid(False)
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        feature = QgsFeature()
+        if not self.nextFeature(feature):
+            raise StopIteration
+        return feature
+
+    def rewind(self):
+        self._index = 0
+        return True
+
+    def close(self):
+        self._index = len(self._rows)
+        return True
+
+class CellTableFeatureSource(QgsAbstractFeatureSource):
+    def __init__(self, provider):
+        super(CellTableFeatureSource, self).__init__()
+        self._provider = provider
+        self._expression_context = QgsExpressionContext()
+        self._expression_context.appendScope(QgsExpressionContextUtils.globalScope())
+        self._expression_context.setFields(provider.fields())
+
+    def getFeatures(self, request):
+        return QgsFeatureIterator(CellTableFeatureIterator(self, request))
+
+class CellTableProvider(QgsVectorDataProvider):
+    '''
+    Read only vector data provider of a geohash or H3 density cell table that only
+    holds the cell ids and their values. The polygons are synthesized when they are
+    requested from the cell id. The cell bounding boxes are calculated once as numpy
+    arrays so that map extent requests only create the polygons of the visible cells.
+    '''
+    @classmethod
+    def providerKey(cls):
+        return CELL_PROVIDER_KEY
+
+    @classmethod
+    def description(cls):
+        return 'Density analysis cell table'
+
+    @classmethod
+    def createProvider(cls, uri, providerOptions, flags=None):
+        return CellTableProvider(uri, providerOptions)
+
+    def __init__(self, uri='', providerOptions=QgsDataProvider.ProviderOptions()):
+        super(CellTableProvider, self).__init__(uri)
+        self._uri = uri
+        self._valid = False
+        self._fields = QgsFields()
+        self._extents = None
+        self._geometries = OrderedDict()
+        self._lock = threading.Lock()
+        self._h3 = None
+        try:
+            self._cell_type, self._ids, self._columns = loadCellTable(uri)
+            if self._cell_type == CELL_H3:
+                import h3.api.basic_int as h3
+                self._h3 = h3
+        except Exception:
+            self._ids = np.zeros(0, dtype=np.int64)
+            self._columns = OrderedDict()
+            return
+        self._fields.append(QgsField('CELL_ID', QVariant.LongLong))
+        self._fields.append(QgsField('GEOHASH' if self._cell_type == CELL_GEOHASH else 'H3HASH', QVariant.String))
+        for name in self._columns.keys():
+            self._fields.append(QgsField(name, QVariant.Double))
+        self._crs = QgsCoordinateReferenceSystem('EPSG:4326')
+        self._valid = True
+
+    def cellName(self, row):
+        cell = cellKey(self._cell_type, int(self._ids[row]))
+        if self._cell_type == CELL_H3:
+            return self._h3.h3_to_string(cell)
+        return cell
+
+    def attributes(self, row):
+        attr = [int(self._ids[row]), self.cellName(row)]
+        for values in self._columns.values():
+            v = float(values[row])
+            attr.append(None if v != v else v)
+        return attr
+
+    def cellExtents(self):
+        with self._lock:
+            if self._extents is None:
+                if self._cell_type == CELL_GEOHASH:
+                    self._extents = geohashExtents(self._ids)
+                else:
+                    self._extents = h3Extents(self._h3, self._ids)
+            return self._extents
+
+    def cellGeometry(self, row):
+        '''Returns the polygon of a cell from the cache or synthesizes it from the cell id.'''
+        with self._lock:
+            geom = self._geometries.get(row)
+            if geom is not None:
+                self._geometries.move_to_end(row)
+                return geom
+        if self._cell_type == CELL_GEOHASH:
+            x_min, y_min, x_max, y_max = self.cellExtents()[row].tolist()
+            geom = QgsGeometry.fromRect(QgsRectangle(x_min, y_min, x_max, y_max))
+        else:
+            geom = QgsGeometry.fromPolygonXY([h3Boundary(self._h3, int(self._ids[row]))])
+        with self._lock:
+            self._geometries[row] = geom
+            if len(self._geometries) > GEOMETRY_CACHE_SIZE:
+                self._geometries.popitem(last=False)
+        return geom
+
+    def featureSource(self):
+        return CellTableFeatureSource(self)
+
+    def getFeatures(self, request=QgsFeatureRequest()):
+        return QgsFeatureIterator(CellTableFeatureIterator(CellTableFeatureSource(self), request))
+
+    def dataSourceUri(self, expandAuthConfig=True):
+        return self._uri
+
+    def storageType(self):
+        return 'Density cell table'
+
+    def wkbType(self):
+        return QgsWkbTypes.Polygon
+
+    def featureCount(self):
+        return len(self._ids)
+
+    def fields(self):
+        return self._fields
+
+    def crs(self):
+        return self._crs if self._valid else QgsCoordinateReferenceSystem()
+
+    def extent(self):
+        if not self._valid or len(self._ids) == 0:
+            return QgsRectangle()
+        extents = self.cellExtents()
+        return QgsRectangle(extents[:, 0].min(), extents[:, 1].min(), extents[:, 2].max(), extents[:, 3].max())
+
+    def updateExtents(self):
+        pass
+
+    def isValid(self):
+        return self._valid
+
+    def capabilities(self):
+        return QgsVectorDataProvider.SelectAtId
+
+    def name(self):
+        return self.providerKey()
+
+def registerCellTableProvider():
+    '''Registers the cell table provider once per QGIS session.'''
+    registry = QgsProviderRegistry.instance()
+    if registry.providerMetadata(CELL_PROVIDER_KEY) is None:
+        metadata = QgsProviderMetadata(CellTableProvider.providerKey(), CellTableProvider.description(), CellTableProvider.createProvider)
+        registry.registerProvider(metadata)
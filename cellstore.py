@@ -0,0 +1,114 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import numpy as np
+from .valuesample import ValueSample, DEFAULT_SAMPLE_SIZE
+from .hotspots import CELL_GEOHASH
+from . import geohash
+
+CELL_STORE_FILTER = 'NumPy compressed arrays (*.npz);;Parquet (*.parquet)'
+
+def cellId(cell_type, cell):
+    '''Returns the int64 id of a geohash string or H3 cell. H3 cells are already integers.'''
+    if cell_type == CELL_GEOHASH:
+        return geohash.to_int(cell)
+    return cell
+
+def cellKey(cell_type, cell_id):
+    '''Returns the geohash string or H3 cell of an id.'''
+    if cell_type == CELL_GEOHASH:
+        return geohash.from_int(cell_id)
+    return cell_id
+
+class CellStore():
+    '''
+    Sparse table of cell values kept as a sorted int64 array of cell ids and a float64
+    array of their values. Geohashes are packed with geohash.to_int and H3 cells are
+    stored as their 64 bit index. Merging, thresholding and sampling work on the arrays
+    so that cell geometry is only created for the cells that are written out.
+    '''
+    def __init__(self, cell_type, ids, values):
+        self.cell_type = cell_type
+        self.ids = ids
+        self.values = values
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def fromCells(cell_type, cells):
+        '''Creates a store from a dictionary of geohash or H3 cell values.'''
+        n = len(cells)
+        ids = np.fromiter((cellId(cell_type, c) for c in cells.keys()), dtype=np.int64, count=n)
+        values = np.fromiter(cells.values(), dtype=np.float64, count=n)
+        order = np.argsort(ids, kind='stable')
+        return CellStore(cell_type, ids[order], values[order])
+
+    def merge(self, other):
+        '''Returns a new store with the values of cells that are in both stores summed.'''
+        ids = np.concatenate((self.ids, other.ids))
+        values = np.concatenate((self.values, other.values))
+        unique_ids, inverse = np.unique(ids, return_inverse=True)
+        return CellStore(self.cell_type, unique_ids, np.bincount(inverse, weights=values, minlength=len(unique_ids)))
+
+    def threshold(self, min_value):
+        '''Returns a new store with only the cells whose value is at least min_value.'''
+        keep = self.values >= min_value
+        return CellStore(self.cell_type, self.ids[keep], self.values[keep])
+
+    def sample(self, max_size=DEFAULT_SAMPLE_SIZE):
+        '''
+        Returns a ValueSample of the cell values for styling. The sample is drawn from the
+        value array at once instead of adding the values to the reservoir one at a time.
+        '''
+        sample = ValueSample(max_size)
+        values = self.values[np.isfinite(self.values)]
+        if len(values) == 0:
+            return sample
+        sample.count = len(values)
+        sample.minimum = float(values.min())
+        sample.maximum = float(values.max())
+        if 0 < max_size < len(values):
+            values = np.random.default_rng(0).choice(values, max_size, replace=False)
+        sample.values = values.tolist()
+        return sample
+
+    def cells(self):
+        '''Iterates over the geohash string or H3 cell and value of each cell.'''
+        for cell_id, value in zip(self.ids.tolist(), self.values.tolist()):
+            yield cellKey(self.cell_type, cell_id), value
+
+    def save(self, path):
+        '''Saves the store as compressed numpy arrays or, if pyarrow is installed, as Parquet.'''
+        if os.path.splitext(path)[1].lower() == '.parquet':
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except Exception:
+                raise ImportError('Saving the cell store as Parquet requires the pyarrow Python package. Use a .npz file instead.')
+            table = pa.table({'CELL_ID': self.ids, 'VALUE': self.values})
+            table = table.replace_schema_metadata({'cell_type': str(self.cell_type)})
+            pq.write_table(table, path)
+        else:
+            np.savez_compressed(path, cell_type=self.cell_type, ids=self.ids, values=self.values)
+
+    @staticmethod
+    def load(path):
+        if os.path.splitext(path)[1].lower() == '.parquet':
+            import pyarrow.parquet as pq
+            table = pq.read_table(path)
+            cell_type = int(table.schema.metadata[b'cell_type'])
+            ids = table.column('CELL_ID').to_numpy()
+            values = table.column('VALUE').to_numpy()
+            order = np.argsort(ids, kind='stable')
+            return CellStore(cell_type, ids[order], values[order])
+        with np.load(path) as data:
+            return CellStore(int(data['cell_type']), data['ids'], data['values'])
@@ -0,0 +1,67 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from qgis.core import (
+    QgsFeatureRequest,
+    QgsGraduatedSymbolRenderer,
+    QgsRendererRange,
+    QgsClassificationQuantile,
+    QgsClassificationEqualInterval,
+    QgsClassificationLogarithmic,
+    QgsClassificationJenks,
+    QgsClassificationPrettyBreaks,
+    QgsClassificationStandardDeviation)
+# ValueSample does not depend on QGIS so that it can be tested on its own
+from .valuesample import ValueSample, DEFAULT_SAMPLE_SIZE
+
+def classificationMethod(mode):
+    '''Returns the QgsClassificationMethod for a COLOR_RAMP_MODE index.'''
+    if mode == 0: # Quantile
+        return QgsClassificationQuantile()
+    elif mode == 1: # Equal Interval
+        return QgsClassificationEqualInterval()
+    elif mode == 2: # Logarithmic scale
+        return QgsClassificationLogarithmic()
+    elif mode == 3: # Natural Breaks (Jenks)
+        return QgsClassificationJenks()
+    elif mode == 4: # Pretty Breaks
+        return QgsClassificationPrettyBreaks()
+    else: # Standard Deviation
+        return QgsClassificationStandardDeviation()
+
+def sampleLayerValues(layer, attr, max_size, feedback=None, fields=None):
+    '''
+    Reads only the attribute column of the layer, without geometry, and
+    returns a ValueSample with at most max_size values. The layer may be a
+    QgsVectorLayerFeatureSource in which case its fields must be given.
+    '''
+    sample = ValueSample(max_size)
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes([attr], fields if fields is not None else layer.fields())
+    for f in layer.getFeatures(request):
+        if feedback and feedback.isCanceled():
+            break
+        sample.add(f[attr])
+    return sample
+
+def createGraduatedRenderer(attr, sample, num_classes, mode, symbol, ramp):
+    '''
+    Creates a graduated renderer with explicit class ranges that are calculated
+    from a ValueSample rather than from all the features of the layer.
+    '''
+    method = classificationMethod(mode)
+    ranges = method.classes(sample.classValues(), num_classes)
+    renderer = QgsGraduatedSymbolRenderer(attr)
+    renderer.setClassificationMethod(method)
+    renderer.setSourceSymbol(symbol.clone())
+    for r in ranges:
+        renderer.addClassRange(QgsRendererRange(r, symbol.clone()))
+    renderer.updateColorRamp(ramp)
+    return renderer
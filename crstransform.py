@@ -0,0 +1,175 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import math
+import numpy as np
+from qgis.core import QgsCoordinateTransform, QgsCoordinateReferenceSystem, QgsPointXY, QgsProject
+
+# Number of points that are read before their coordinates are transformed together
+TRANSFORM_BATCH_SIZE = 10000
+
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+UTM_SCALE = 0.9996
+UTM_FALSE_EASTING = 500000.0
+UTM_FALSE_NORTHING_SOUTH = 10000000.0
+WEB_MERCATOR_IDS = ('EPSG:3857', 'EPSG:900913', 'EPSG:3785', 'EPSG:102100', 'EPSG:102113')
+
+def webMercatorToWgs84(x, y):
+    '''Inverse spherical Mercator of coordinate arrays, which is exact for EPSG:3857.'''
+    lon = np.degrees(x / WGS84_A)
+    lat = np.degrees(2.0 * np.arctan(np.exp(y / WGS84_A)) - math.pi / 2)
+    return lon, lat
+
+def utmToWgs84(zone, south):
+    '''
+    Returns a function for the inverse transverse Mercator of a WGS 84 UTM zone using
+    the Kruger series, which is accurate to well under a millimeter within a zone.
+    '''
+    n = WGS84_F / (2 - WGS84_F)
+    n2 = n * n
+    n3 = n2 * n
+    A = WGS84_A / (1 + n) * (1 + n2 / 4 + n2 * n2 / 64)
+    beta = (n / 2 - 2 * n2 / 3 + 37 * n3 / 96, n2 / 48 + n3 / 15, 17 * n3 / 480)
+    delta = (2 * n - 2 * n2 / 3 - 2 * n3, 7 * n2 / 3 - 8 * n3 / 5, 56 * n3 / 15)
+    lon0 = zone * 6 - 183
+    false_northing = UTM_FALSE_NORTHING_SOUTH if south else 0.0
+    def transform(x, y):
+        xi = (y - false_northing) / (UTM_SCALE * A)
+        eta = (x - UTM_FALSE_EASTING) / (UTM_SCALE * A)
+        xi_p = xi.copy()
+        eta_p = eta.copy()
+        for j, b in enumerate(beta, 1):
+            xi_p -= b * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+            eta_p -= b * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+        chi = np.arcsin(np.sin(xi_p) / np.cosh(eta_p))
+        lat = chi.copy()
+        for j, d in enumerate(delta, 1):
+            lat += d * np.sin(2 * j * chi)
+        lon = lon0 + np.degrees(np.arctan2(np.sinh(eta_p), np.cos(xi_p)))
+        return lon, np.degrees(lat)
+    return transform
+
+def utmZone(authid):
+    '''Returns the (zone, south) of a WGS 84 UTM EPSG code or None.'''
+    if not authid.startswith('EPSG:'):
+        return None
+    try:
+        code = int(authid[5:])
+    except ValueError:
+        return None
+    if 32601 <= code <= 32660:
+        return code - 32600, False
+    if 32701 <= code <= 32760:
+        return code - 32700, True
+    return None
+
+def qgisTransform(src_crs, dest_crs):
+    '''Transforms coordinate arrays one point at a time, which works for any CRS.'''
+    xform = QgsCoordinateTransform(src_crs, dest_crs, QgsProject.instance())
+    def transform(x, y):
+        lon = np.full(len(x), np.nan)
+        lat = np.full(len(x), np.nan)
+        for i, (px, py) in enumerate(zip(x.tolist(), y.tolist())):
+            try:
+                pt = xform.transform(QgsPointXY(px, py))
+                lon[i] = pt.x()
+                lat[i] = pt.y()
+            except Exception:
+                pass
+        return lon, lat
+    return transform
+
+def projTransform(src_crs, dest_crs):
+    '''
+    Transforms coordinate arrays with a single pyproj call. Returns None if pyproj is not
+    installed or if the project transform context has a coordinate operation for the pair,
+    which pyproj would not use.
+    '''
+    if QgsProject.instance().transformContext().calculateCoordinateOperation(src_crs, dest_crs):
+        return None
+    try:
+        from pyproj import CRS, Transformer
+        # The default WKT1 export loses datum ensemble and bound CRS details
+        if src_crs.authid():
+            crs = CRS.from_user_input(src_crs.authid())
+        else:
+            crs = CRS.from_wkt(src_crs.toWkt(QgsCoordinateReferenceSystem.WKT_PREFERRED))
+        transformer = Transformer.from_crs(crs, 'EPSG:4326', always_xy=True)
+    except Exception:
+        return None
+    def transform(x, y):
+        lon, lat = transformer.transform(x, y)
+        return np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+    return transform
+
+def wgs84Transform(src_crs):
+    '''
+    Returns a function that transforms x and y numpy arrays in src_crs to longitude and
+    latitude arrays, or None if src_crs is already EPSG:4326. Web Mercator and WGS 84 UTM
+    zones share the WGS 84 datum so they use closed form vectorized math. Any other CRS is
+    transformed in batches by pyproj when it is installed and the project does not set a
+    datum transformation for it, and otherwise point by point with the project transform.
+    Points that cannot be transformed are returned as NaN.
+    '''
+    dest_crs = QgsCoordinateReferenceSystem('EPSG:4326')
+    if src_crs == dest_crs:
+        # QGIS geometries are always in x=longitude, y=latitude order so no axis swap is needed
+        return None
+    authid = src_crs.authid().upper()
+    if authid in WEB_MERCATOR_IDS:
+        return webMercatorToWgs84
+    zone = utmZone(authid)
+    if zone:
+        return utmToWgs84(*zone)
+    transform = projTransform(src_crs, dest_crs)
+    if transform is None:
+        transform = qgisTransform(src_crs, dest_crs)
+    return transform
+
+def transformBatch(features, x, y, transform):
+    x = np.array(x, dtype=np.float64)
+    y = np.array(y, dtype=np.float64)
+    if transform is not None:
+        with np.errstate(all='ignore'):
+            x, y = transform(x, y)
+    valid = np.isfinite(x) & np.isfinite(y)
+    for feature, lon, lat, ok in zip(features, x.tolist(), y.tolist(), valid.tolist()):
+        if ok:
+            yield feature, lon, lat
+        else:
+            yield feature, None, None
+
+def transformedPoints(features, transform):
+    '''
+    Yields each feature with the longitude and latitude of its point. The features are
+    read in batches of TRANSFORM_BATCH_SIZE so that their coordinates are transformed
+    together by a wgs84Transform function. Features without a point, or whose point
+    could not be transformed, are yielded with None coordinates.
+    '''
+    batch = []
+    x = []
+    y = []
+    for feature in features:
+        try:
+            pt = feature.geometry().asPoint()
+            x.append(pt.x())
+            y.append(pt.y())
+        except Exception:
+            x.append(math.nan)
+            y.append(math.nan)
+        batch.append(feature)
+        if len(batch) >= TRANSFORM_BATCH_SIZE:
+            yield from transformBatch(batch, x, y, transform)
+            batch = []
+            x = []
+            y = []
+    if batch:
+        yield from transformBatch(batch, x, y, transform)
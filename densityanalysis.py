@@ -12,11 +12,13 @@
 
 from qgis.PyQt.QtCore import QUrl, Qt
 from qgis.PyQt.QtGui import QIcon
-from qgis.PyQt.QtWidgets import QAction, QMessageBox, QMenu, QToolButton
-from qgis.core import QgsApplication
+from qgis.PyQt.QtWidgets import QAction, QMessageBox, QMenu, QToolButton, QFileDialog
+from qgis.core import Qgis, QgsApplication, QgsProject, QgsVectorLayer
 import processing
 from .provider import DensityAnalysisProvider
-from .settings import SettingsWidget
+from .cellprovider import registerCellTableProvider, CELL_PROVIDER_KEY, CELL_TABLE_FILTER
+from .graduatedstyle import applyGraduatedStyle
+from .settings import SettingsWidget, settings
 from .utils import h3InstallString
 
 import os
@@ -24,6 +26,7 @@ import os
 class DensityAnalysis(object):
     heatmap_dialog = None
     style_Layers_dialog = None
+    streaming_dialog = None
     settingsDialog = None
     h3_installed = False
 
@@ -108,6 +111,19 @@ class DensityAnalysis(object):
         self.toolbar.addAction(self.heatmapAction)
         self.iface.addPluginToMenu("Density analysis", self.heatmapAction)
 
+        self.giStarAction = QAction(icon, "Getis-Ord Gi* hotspot statistic", self.iface.mainWindow())
+        self.giStarAction.triggered.connect(self.giStarAlgorithm)
+        self.iface.addPluginToMenu("Density analysis", self.giStarAction)
+
+        icon = QIcon(os.path.dirname(__file__) + '/icons/geohashdensity.svg')
+        self.streamingAction = QAction(icon, "Streaming density map", self.iface.mainWindow())
+        self.streamingAction.triggered.connect(self.showStreamingDialog)
+        self.iface.addPluginToMenu("Density analysis", self.streamingAction)
+
+        self.cellTableAction = QAction(icon, "Open density cell table", self.iface.mainWindow())
+        self.cellTableAction.triggered.connect(self.openCellTable)
+        self.iface.addPluginToMenu("Density analysis", self.cellTableAction)
+
         icon = QIcon(os.path.dirname(__file__) + '/icons/kde.png')
         self.kdeAction = QAction(icon, "Styled heatmap (Kernel density estimation)", self.iface.mainWindow())
         self.kdeAction.triggered.connect(self.kdeAlgorithm)
@@ -173,6 +189,7 @@ class DensityAnalysis(object):
 
         # Add the processing provider
         QgsApplication.processingRegistry().addProvider(self.provider)
+        registerCellTableProvider()
 
     def unload(self):
         self.iface.removePluginMenu('Density analysis', self.densityGridAction)
@@ -186,12 +203,17 @@ class DensityAnalysis(object):
         self.iface.removePluginMenu('Density analysis', self.styledPolyDensityAction)
         self.iface.removePluginMenu('Density analysis', self.polyDensityAction)
         self.iface.removePluginMenu('Density analysis', self.heatmapAction)
+        self.iface.removePluginMenu('Density analysis', self.giStarAction)
+        self.iface.removePluginMenu('Density analysis', self.streamingAction)
+        self.iface.removePluginMenu('Density analysis', self.cellTableAction)
         self.iface.removePluginMenu('Density analysis', self.style2layersAction)
         self.iface.removePluginMenu('Density analysis', self.rasterStyleAction)
         self.iface.removePluginMenu("Density analysis", self.settingsAction)
         self.iface.removePluginMenu("Density analysis", self.helpAction)
         if self.heatmap_dialog:
             self.iface.removeDockWidget(self.heatmap_dialog)
+        if self.streaming_dialog:
+            self.streaming_dialog.stop()
         # Remove Toolbar
         del self.toolbar
         """Remove the provider."""
@@ -205,6 +227,26 @@ class DensityAnalysis(object):
             self.iface.addDockWidget(Qt.RightDockWidgetArea, self.heatmap_dialog)
         self.heatmap_dialog.show()
 
+    def showStreamingDialog(self):
+        """Display the streaming density map window."""
+        if not self.streaming_dialog:
+            from .streamingdensity import StreamingDensityDialog
+            self.streaming_dialog = StreamingDensityDialog(self.iface, self.iface.mainWindow())
+        self.streaming_dialog.show()
+
+    def openCellTable(self):
+        """Add a density cell store or Parquet cell table as a layer whose polygons are created on demand."""
+        path, _ = QFileDialog.getOpenFileName(self.iface.mainWindow(), 'Open density cell table', '', CELL_TABLE_FILTER)
+        if not path:
+            return
+        layer = QgsVectorLayer(path, os.path.splitext(os.path.basename(path))[0], CELL_PROVIDER_KEY)
+        if not layer.isValid():
+            self.iface.messageBar().pushMessage("", "Unable to read the density cell table", level=Qgis.Warning, duration=4)
+            return
+        QgsProject.instance().addMapLayer(layer)
+        applyGraduatedStyle(layer, 'NUMPOINTS', settings.defaultColorRamp(), False,
+            settings.num_ramp_classes, settings.color_ramp_mode, True)
+
     def densityGridAlgorithm(self):
         processing.execAlgorithmDialog('densityanalysis:densitymap', {})
 
@@ -289,6 +331,9 @@ class DensityAnalysis(object):
     def kdeAlgorithm(self):
         processing.execAlgorithmDialog('densityanalysis:styledkde', {})
 
+    def giStarAlgorithm(self):
+        processing.execAlgorithmDialog('densityanalysis:gistar', {})
+
     def settings(self):
         if self.settingsDialog is None:
             self.settingsDialog = SettingsWidget(self.iface, self.iface.mainWindow())
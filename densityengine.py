@@ -0,0 +1,490 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from qgis.PyQt.QtCore import Qt, QVariant, QDate, QTime, QDateTime
+from qgis.core import Qgis, QgsFields, QgsField, QgsFeature, QgsFeatureRequest, QgsFeatureSink, QgsGeometry, QgsPointXY, QgsRectangle, QgsCoordinateTransform, QgsCoordinateReferenceSystem, QgsProject, QgsWkbTypes
+from qgis.core import QgsProcessingLayerPostProcessorInterface
+from .classbreaks import ValueSample, DEFAULT_SAMPLE_SIZE
+from .aggregates import CellAggregate, HyperLogLog, isNull
+from .cellstore import CellStore
+from .crstransform import wgs84Transform, transformedPoints
+from .geoparquet import writeDensityParquet
+from .hotspots import CELL_GEOHASH, CELL_H3
+from . import geohash
+
+# In process density engine shared by the geohash and H3 density algorithms and their
+# styled map wrappers. The wrappers call these functions directly and style the output
+# with the returned value sample rather than chaining processing algorithms.
+
+# Output of the intermediate child algorithm steps so that they are always memory layers
+MEMORY_OUTPUT = 'memory:'
+# Number of features written to the final output sink in each call
+BULK_INSERT_SIZE = 50000
+# Length in seconds of each TIME_BIN_LABELS bin
+TIME_BIN_SECONDS = [3600, 86400, 604800]
+WEEK_OFFSET = 3 * 86400
+
+def epsg4326():
+    return QgsCoordinateReferenceSystem("EPSG:4326")
+
+def densityFields(hash_name, temporal=False, aggregate_field=None, entities=False):
+    '''
+    Returns the attributes of a geohash or H3 density layer. aggregate_field is the name
+    of the attribute that holds the aggregate of another field in each cell and entities
+    adds the NUMENTITIES distinct entity count.
+    '''
+    fields = QgsFields()
+    fields.append(QgsField('ID', QVariant.Int))
+    fields.append(QgsField(hash_name, QVariant.String))
+    fields.append(QgsField('NUMPOINTS', QVariant.Double))
+    if aggregate_field:
+        fields.append(QgsField(aggregate_field, QVariant.Double))
+    if entities:
+        fields.append(QgsField('NUMENTITIES', QVariant.Int))
+    if temporal:
+        fields.append(QgsField('TIME_START', QVariant.DateTime))
+        fields.append(QgsField('TIME_END', QVariant.DateTime))
+    return fields
+
+def copyToSink(layer, sink, feedback, expression=None):
+    '''
+    Writes the features of an intermediate memory layer to the final output sink in
+    large batches, keeping only those that match the optional filter expression.
+    Returns the number of features written.
+    '''
+    request = QgsFeatureRequest()
+    if expression:
+        request.setFilterExpression(expression)
+    total = 100.0 / layer.featureCount() if layer.featureCount() else 0
+    features = []
+    cnt = 0
+    for cnt, f in enumerate(layer.getFeatures(request), 1):
+        if feedback.isCanceled():
+            return cnt
+        features.append(f)
+        if len(features) >= BULK_INSERT_SIZE:
+            sink.addFeatures(features, QgsFeatureSink.FastInsert)
+            features = []
+            feedback.setProgress(int(cnt * total))
+    if features:
+        sink.addFeatures(features, QgsFeatureSink.FastInsert)
+    return cnt
+
+def geohashCellKey(resolution):
+    def cellKey(lat, lon):
+        return geohash.encode(lat, lon, resolution)
+    return cellKey
+
+def h3CellKey(h3, resolution):
+    def cellKey(lat, lon):
+        h = h3.geo_to_h3(lat, lon, resolution)
+        if h == 0: # Check to see if the input coordinates were invalid
+            return None
+        return h
+    return cellKey
+
+def geohashFieldKey(resolution):
+    '''
+    Returns a function that converts a precomputed geohash attribute to its cell at
+    resolution by truncating it, or None if it is null or coarser than resolution.
+    '''
+    def cellKey(value):
+        if isNull(value):
+            return None
+        value = str(value).strip().lower()[:resolution]
+        if len(value) < resolution or not geohash.is_valid(value):
+            return None
+        return value
+    return cellKey
+
+def h3FieldKey(h3, resolution):
+    '''
+    Returns a function that converts a precomputed H3 index attribute, either an integer
+    or a hexadecimal string, to its parent cell at resolution. None is returned for null
+    or invalid indexes and for cells that are coarser than resolution.
+    '''
+    def cellKey(value):
+        if isNull(value):
+            return None
+        if isinstance(value, str):
+            value = h3.string_to_h3(value.strip())
+        else:
+            value = int(value)
+        if not h3.h3_is_valid(value):
+            return None
+        cell_resolution = h3.h3_get_resolution(value)
+        if cell_resolution < resolution:
+            return None
+        if cell_resolution > resolution:
+            return h3.h3_to_parent(value, resolution)
+        return value
+    return cellKey
+
+def cellFieldRequest(source, cell_field, attributes, extent=None, extent_crs=None):
+    '''
+    Returns the request for only the precomputed cell field and the other attributes
+    that are needed, without the geometry. A table without geometry ignores the extent.
+    '''
+    if source.wkbType() == QgsWkbTypes.NoGeometry:
+        extent = None
+    request = extentRequest(source, extent, extent_crs)
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes([cell_field] + [a for a in attributes if a], source.fields())
+    return request
+
+def toDateTime(value):
+    '''Converts a date, date time or ISO 8601 string attribute to a QDateTime or returns None.'''
+    if isinstance(value, QDateTime):
+        dt = value
+    elif isinstance(value, QDate):
+        dt = QDateTime(value, QTime(0, 0), Qt.UTC)
+    elif isinstance(value, str):
+        dt = QDateTime.fromString(value, Qt.ISODate)
+    else:
+        return None
+    if not dt.isValid():
+        return None
+    return dt
+
+def timeSeconds(value):
+    '''Returns a time attribute in seconds since the epoch or None if it is not a valid time.'''
+    dt = toDateTime(value)
+    if dt is None:
+        return None
+    return dt.toSecsSinceEpoch()
+
+def timeBinKey(time_bin):
+    '''
+    Returns a function that maps a date or date time attribute to the start of its time bin
+    in seconds since the epoch. Bins are aligned to UTC and weeks start on Monday.
+    '''
+    secs = TIME_BIN_SECONDS[time_bin]
+    # The epoch was a Thursday so weeks are shifted to start on Monday
+    offset = WEEK_OFFSET if time_bin == 2 else 0
+    def binKey(value):
+        t = timeSeconds(value)
+        if t is None:
+            return None
+        return (t + offset) // secs * secs - offset
+    return binKey
+
+def timeBinRange(start, time_bin):
+    '''Returns the start and end of a time bin as UTC QDateTimes.'''
+    return [QDateTime.fromSecsSinceEpoch(start, Qt.UTC),
+        QDateTime.fromSecsSinceEpoch(start + TIME_BIN_SECONDS[time_bin], Qt.UTC)]
+
+def extentRequest(source, extent=None, extent_crs=None):
+    '''
+    Returns the request for the points of source. If extent is given, it is transformed
+    to the source CRS and set as the filter rectangle so the provider can use its
+    spatial index and only the points within the extent are read.
+    '''
+    request = QgsFeatureRequest()
+    if extent is not None and not extent.isNull():
+        src_crs = source.sourceCrs()
+        if extent_crs is not None and extent_crs.isValid() and extent_crs != src_crs:
+            transform = QgsCoordinateTransform(extent_crs, src_crs, QgsProject.instance())
+            extent = transform.transformBoundingBox(extent)
+        request.setFilterRect(extent)
+    return request
+
+def binPoints(sources, cell_key, weight_field, feedback, progress=85, time_field=None, time_bin=1, aggregate_factory=None,
+        entity_field=None, entities=None, extent=None, extent_crs=None, cell_field=None, progress_start=0):
+    '''
+    Sums the point counts or weights of all the sources into a dictionary keyed by cell.
+    The points are transformed to EPSG:4326 in batches and cell_key(lat, lon) returns their cell.
+    If time_field is given, the dictionary is keyed by the (cell, time bin start) tuple
+    so that all of the time bins are counted in a single pass over the points. If
+    aggregate_factory is given, each cell has a CellAggregate of the weight field instead.
+    If entity_field is given, the entities dictionary is filled with a HyperLogLog of the
+    entity values in each cell. All of the sources share the same sketch for a cell.
+    If extent is given only the points within it are read. If cell_field is given, the
+    geometry is not read and cell_key(value) returns the cell of its attribute value.
+    The progress goes from progress_start to progress_start + progress.
+    '''
+    bin_key = timeBinKey(time_bin) if time_field else None
+    ghash = {}
+    cumulative = progress_start
+    incremental = progress / len(sources) if sources else 0
+    for source in sources:
+        total = incremental / source.featureCount() if source.featureCount() else 0
+        # A multi-layer source without the entity field still has its points counted
+        entity_idx = source.fields().indexOf(entity_field) if entity_field else -1
+        if cell_field:
+            # Only the attributes are read so the density reduces to a group by of the cell field
+            cell_idx = source.fields().indexOf(cell_field)
+            features = source.getFeatures(cellFieldRequest(source, cell_field,
+                [weight_field, time_field, entity_field], extent, extent_crs))
+            points = ((f, None, None) for f in features)
+        else:
+            # Coordinates are transformed in batches with closed form math for common projections
+            transform = wgs84Transform(source.sourceCrs())
+            features = source.getFeatures(extentRequest(source, extent, extent_crs))
+            points = transformedPoints(features, transform)
+        for cnt, (feature, lon, lat) in enumerate(points):
+            if feedback.isCanceled():
+                break
+            try:
+                if cell_field:
+                    h = cell_key(feature.attribute(cell_idx))
+                elif lon is None:
+                    continue
+                else:
+                    h = cell_key(lat, lon)
+                if h is None:
+                    continue
+                if bin_key:
+                    t = bin_key(feature[time_field])
+                    if t is None:
+                        continue
+                    h = (h, t)
+                if entity_field:
+                    sketch = entities.get(h)
+                    if sketch is None:
+                        sketch = entities[h] = HyperLogLog()
+                    value = feature.attribute(entity_idx) if entity_idx != -1 else None
+                    if not isNull(value):
+                        sketch.add(value)
+                if aggregate_factory:
+                    agg = ghash.get(h)
+                    if agg is None:
+                        agg = ghash[h] = aggregate_factory()
+                    agg.add(feature[weight_field])
+                else:
+                    weight = feature[weight_field] if weight_field else 1
+                    if h in ghash:
+                        ghash[h] += weight
+                    else:
+                        ghash[h] = weight
+            except Exception:
+                pass
+            if cnt % 1000 == 0:
+                feedback.setProgress(int(cnt * total + cumulative))
+        cumulative += incremental
+    return ghash
+
+def binCellStore(sources, cell_type, cell_key, weight_field, feedback, progress=85, extent=None, extent_crs=None, cell_field=None):
+    '''
+    Bins the plain point counts, or weights, of each source with binPoints into its own
+    CellStore and merges the stores, so that only the cell dictionary of one source is
+    held at a time.
+    '''
+    store = CellStore.fromCells(cell_type, {})
+    incremental = progress / len(sources) if sources else 0
+    for i, source in enumerate(sources):
+        if feedback.isCanceled():
+            break
+        cells = binPoints([source], cell_key, weight_field, feedback, incremental, extent=extent,
+            extent_crs=extent_crs, cell_field=cell_field, progress_start=i * incremental)
+        store = store.merge(CellStore.fromCells(cell_type, cells))
+        del cells
+    return store
+
+def writeCells(items, num_cells, sink, cell_geometry, cell_name, feedback, progress_start=85, time_bin=None, entities=None, sample=None):
+    '''
+    Writes a polygon for each (key, value) cell item and returns a sample of the cell values.
+    If sample is given it already holds the cell values and is returned as is.
+    The keys are (cell, time bin start) tuples when time_bin is given, in which case the
+    geometry of each cell is only created once and shared by all of its time bins.
+    CellAggregate values are written as the point count followed by the aggregate.
+    If entities is given, the distinct entity count of each cell is written after them.
+    '''
+    total = (100 - progress_start) / num_cells if num_cells else 0
+    # Sample the cell values as they are written so the output can be styled without reading it back
+    add_sample = sample is None
+    if add_sample:
+        sample = ValueSample(DEFAULT_SAMPLE_SIZE)
+    geometries = {}
+    for cnt, (key, val) in enumerate(items):
+        if time_bin is None:
+            cell = key
+        else:
+            cell, t = key
+        geom = geometries.get(cell)
+        if geom is None:
+            geom = cell_geometry(cell)
+            if geom is None:
+                continue
+            if time_bin is not None:
+                geometries[cell] = geom
+        if isinstance(val, CellAggregate):
+            attr = [cnt, cell_name(cell), val.count, val.value()]
+            val = val.count
+        else:
+            attr = [cnt, cell_name(cell), val]
+        if entities is not None:
+            attr.append(entities[key].count())
+        if time_bin is not None:
+            attr.extend(timeBinRange(t, time_bin))
+        f = QgsFeature()
+        f.setGeometry(geom)
+        f.setAttributes(attr)
+        sink.addFeature(f)
+        if add_sample:
+            sample.add(val)
+        if cnt % 100 == 0:
+            feedback.setProgress(int(cnt * total) + progress_start)
+    return sample
+
+def cellCount(val):
+    return val.count if isinstance(val, CellAggregate) else val
+
+def writeDensity(ghash, cell_type, sink, cell_geometry, cell_name, feedback, time_bin=None, entities=None,
+        min_count=0, store_path=None, parquet_path=None, parquet_geometry=False):
+    '''
+    Writes the binned cells with at least min_count points, or weight, to the sink and
+    returns a ValueSample of NUMPOINTS or None if no cells remain. ghash is either the
+    CellStore of plain cell counts from binCellStore or the dictionary from binPoints.
+    A CellStore is saved to store_path if given, the threshold is applied to its arrays
+    and geometry is only created for the remaining cells. If parquet_path is given the
+    cells are also written as a Parquet table, with their polygons only if
+    parquet_geometry is True, and sink may be None.
+    '''
+    sample = None
+    if isinstance(ghash, CellStore):
+        store = ghash
+        if min_count > 0:
+            store = store.threshold(min_count)
+        if store_path and not feedback.isCanceled():
+            store.save(store_path)
+        if len(store) == 0:
+            return None
+        items = store.cells()
+        num_cells = len(store)
+        sample = store.sample()
+    else:
+        if store_path:
+            feedback.reportError('The cell store only holds plain counts without time bins, aggregates or entities and was not saved.')
+        if min_count > 0:
+            for key in [k for k, v in ghash.items() if cellCount(v) < min_count]:
+                del ghash[key]
+        if len(ghash) == 0:
+            return None
+        items = ghash.items()
+        num_cells = len(ghash)
+    if parquet_path and not feedback.isCanceled():
+        items = list(items)
+        feedback.pushInfo('Writing {} cells to {}'.format(num_cells, parquet_path))
+        writeDensityParquet(parquet_path, cell_type, items, cell_name, cell_geometry if parquet_geometry else None,
+            entities, TIME_BIN_SECONDS[time_bin] if time_bin is not None else None, feedback)
+    if sink is None:
+        if sample is None:
+            sample = ValueSample(DEFAULT_SAMPLE_SIZE)
+            for key, val in items:
+                sample.add(cellCount(val))
+        return sample
+    return writeCells(items, num_cells, sink, cell_geometry, cell_name, feedback,
+        time_bin=time_bin, entities=entities, sample=sample)
+
+def geohashGeometry(key):
+    lat1, lat2, lon1, lon2 = geohash.decode_extent(key)
+    return QgsGeometry.fromRect(QgsRectangle(lon1, lat1, lon2, lat2))
+
+def h3CellGeometry(h3):
+    '''Returns a function that creates the hexagon of an H3 cell or None if it is invalid.'''
+    def h3Geometry(key):
+        try:
+            coords = h3.h3_to_geo_boundary(key)
+        except Exception:
+            return None
+        pts = []
+        for p in coords:
+            pts.append(QgsPointXY(p[1], p[0]))
+        return QgsGeometry.fromPolygonXY([pts])
+    return h3Geometry
+
+def geohashDensity(sources, resolution, weight_field, sink, feedback, time_field=None, time_bin=1, aggregate_factory=None,
+        entity_field=None, min_count=0, store_path=None, parquet_path=None, parquet_geometry=False,
+        extent=None, extent_crs=None, cell_field=None):
+    '''
+    Creates the geohash density map of the point sources in sink. Returns a ValueSample
+    of NUMPOINTS, or None if there were no points. If time_field is given the output
+    has one feature per cell and time bin and needs densityFields(hash_name, True).
+    If aggregate_factory is given the weight field is aggregated in each cell and the
+    sink needs the aggregate field. If entity_field is given the distinct values of the
+    entity field in each cell are counted in NUMENTITIES. If parquet_path is given the
+    cells are also written to a Parquet file and sink may be None. If extent is given
+    only the points within it, in extent_crs, are counted. If cell_field is given the cells
+    are read from its precomputed geohash attribute, and coarsened to resolution, instead
+    of from the point geometry.
+    '''
+    entities = {} if entity_field else None
+    cell_key = geohashFieldKey(resolution) if cell_field else geohashCellKey(resolution)
+    if time_field or aggregate_factory or entity_field:
+        ghash = binPoints(sources, cell_key, weight_field, feedback,
+            time_field=time_field, time_bin=time_bin, aggregate_factory=aggregate_factory,
+            entity_field=entity_field, entities=entities, extent=extent, extent_crs=extent_crs,
+            cell_field=cell_field)
+    else:
+        ghash = binCellStore(sources, CELL_GEOHASH, cell_key, weight_field, feedback,
+            extent=extent, extent_crs=extent_crs, cell_field=cell_field)
+    if len(ghash) == 0:
+        return None
+    return writeDensity(ghash, CELL_GEOHASH, sink, geohashGeometry, str, feedback,
+        time_bin=time_bin if time_field else None, entities=entities, min_count=min_count, store_path=store_path,
+        parquet_path=parquet_path, parquet_geometry=parquet_geometry)
+
+def h3Density(sources, h3, resolution, weight_field, sink, feedback, time_field=None, time_bin=1, aggregate_factory=None,
+        entity_field=None, min_count=0, store_path=None, parquet_path=None, parquet_geometry=False,
+        extent=None, extent_crs=None, cell_field=None):
+    '''
+    Creates the H3 density map of the point sources in sink. Returns a ValueSample
+    of NUMPOINTS, or None if there were no points. If time_field is given the output
+    has one feature per cell and time bin and needs densityFields(hash_name, True).
+    If aggregate_factory is given the weight field is aggregated in each cell and the
+    sink needs the aggregate field. If entity_field is given the distinct values of the
+    entity field in each cell are counted in NUMENTITIES. If parquet_path is given the
+    cells are also written to a Parquet file and sink may be None. If extent is given
+    only the points within it, in extent_crs, are counted. If cell_field is given the cells
+    are read from its precomputed H3 index attribute, and coarsened to resolution, instead
+    of from the point geometry.
+    '''
+    entities = {} if entity_field else None
+    cell_key = h3FieldKey(h3, resolution) if cell_field else h3CellKey(h3, resolution)
+    if time_field or aggregate_factory or entity_field:
+        ghash = binPoints(sources, cell_key, weight_field, feedback,
+            time_field=time_field, time_bin=time_bin, aggregate_factory=aggregate_factory,
+            entity_field=entity_field, entities=entities, extent=extent, extent_crs=extent_crs,
+            cell_field=cell_field)
+    else:
+        ghash = binCellStore(sources, CELL_H3, cell_key, weight_field, feedback,
+            extent=extent, extent_crs=extent_crs, cell_field=cell_field)
+    if len(ghash) == 0:
+        return None
+    return writeDensity(ghash, CELL_H3, sink, h3CellGeometry(h3), h3.h3_to_string, feedback,
+        time_bin=time_bin if time_field else None, entities=entities, min_count=min_count, store_path=store_path,
+        parquet_path=parquet_path, parquet_geometry=parquet_geometry)
+
+class TemporalLayerPostProcessor(QgsProcessingLayerPostProcessorInterface):
+    '''
+    Sets the temporal properties of a space-time density layer when it is loaded
+    so that it can be animated with the temporal controller.
+    '''
+    instance = None
+
+    def postProcessLayer(self, layer, context, feedback):
+        # Temporal properties were added in QGIS 3.14
+        from qgis.core import QgsVectorLayerTemporalProperties
+        props = layer.temporalProperties()
+        props.setMode(QgsVectorLayerTemporalProperties.ModeFeatureDateTimeStartAndEndFromFields)
+        props.setStartField('TIME_START')
+        props.setEndField('TIME_END')
+        props.setIsActive(True)
+
+    @staticmethod
+    def create():
+        # The post processor must be kept alive until the layer has been loaded
+        TemporalLayerPostProcessor.instance = TemporalLayerPostProcessor()
+        return TemporalLayerPostProcessor.instance
+
+def setTemporalPostProcessor(dest_id, context):
+    '''Animates the space-time density output when it is loaded into the project.'''
+    if Qgis.QGIS_VERSION_INT >= 31400 and context.willLoadLayerOnCompletion(dest_id):
+        context.layerToLoadOnCompletionDetails(dest_id).setPostProcessor(TemporalLayerPostProcessor.create())
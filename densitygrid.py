@@ -11,7 +11,7 @@
 import os
 from qgis.PyQt.QtCore import QUrl
 from qgis.PyQt.QtGui import QIcon
-from qgis.core import Qgis, QgsStyle
+from qgis.core import Qgis, QgsStyle, QgsProcessingUtils
 
 from qgis.core import (
     QgsProcessing,
@@ -30,6 +30,8 @@ from qgis.core import (
     )
 import processing
 from .settings import settings, UNIT_LABELS, COLOR_RAMP_MODE, conversionToCrsUnits, conversionFromCrsUnits
+from .graduatedstyle import applyGraduatedStyle
+from .densityengine import MEMORY_OUTPUT, copyToSink
 
 class StyledDensityGridAlgorithm(QgsProcessingAlgorithm):
 
@@ -130,6 +132,8 @@ class StyledDensityGridAlgorithm(QgsProcessingAlgorithm):
         min_grid_cnt = self.parameterAsInt(parameters, 'MIN_GRID_COUNT', context)
         extent = self.parameterAsExtent(parameters, 'EXTENT', context)
         extent_crs = self.parameterAsExtentCrs(parameters, 'EXTENT', context)
+        # Only a user supplied extent needs the points to be filtered
+        filter_extent = not extent.isNull()
         if extent.isNull():
             extent = layer.sourceExtent()
             extent_crs = layer.sourceCrs()
@@ -138,8 +142,8 @@ class StyledDensityGridAlgorithm(QgsProcessingAlgorithm):
             # In this case ramp_name will be the name
             ramp_name = self.parameterAsString(parameters, 'RAMP_NAMES', context)
         else:
-            # In this case ramp_name will be an index into ramp_names
-            ramp_name = self.parameterAsEnum(parameters, 'RAMP_NAMES', context)
+            # In this case RAMP_NAMES is an index into ramp_names
+            ramp_name = settings.ramp_names[self.parameterAsEnum(parameters, 'RAMP_NAMES', context)]
         ramp_mode = self.parameterAsInt(parameters, 'COLOR_RAMP_MODE', context)
         no_outline = self.parameterAsBool(parameters, 'NO_OUTLINE', context)
         invert = self.parameterAsBool(parameters, 'INVERT', context)
@@ -184,7 +188,7 @@ class StyledDensityGridAlgorithm(QgsProcessingAlgorithm):
 
         # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
         # overall progress through the model
-        feedback = QgsProcessingMultiStepFeedback(4, model_feedback)
+        feedback = QgsProcessingMultiStepFeedback(5, model_feedback)
         results = {}
         outputs = {}
         
@@ -197,7 +201,7 @@ class StyledDensityGridAlgorithm(QgsProcessingAlgorithm):
             'TYPE': grid_type,
             'VOVERLAY': 0,
             'VSPACING': cell_height_extent,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            'OUTPUT': MEMORY_OUTPUT
         }
         outputs['CreateGrid'] = processing.run('native:creategrid', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
 
@@ -205,13 +209,29 @@ class StyledDensityGridAlgorithm(QgsProcessingAlgorithm):
         if feedback.isCanceled():
             return {}
 
+        # Extract the points within the extent with a filter rectangle request that can use the
+        # spatial index of the provider so that points outside of the extent are never read
+        points = parameters['INPUT']
+        if filter_extent:
+            alg_params = {
+                'INPUT': parameters['INPUT'],
+                'EXTENT': parameters['EXTENT'],
+                'CLIP': False,
+                'OUTPUT': MEMORY_OUTPUT
+            }
+            points = processing.run('native:extractbyextent', alg_params, context=context, feedback=feedback, is_child_algorithm=True)['OUTPUT']
+
+        feedback.setCurrentStep(2)
+        if feedback.isCanceled():
+            return {}
+
         # Count points in polygon
         alg_params = {
             'CLASSFIELD': '',
             'FIELD': 'NUMPOINTS',
-            'POINTS': parameters['INPUT'],
+            'POINTS': points,
             'POLYGONS': outputs['CreateGrid']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            'OUTPUT': MEMORY_OUTPUT
         }
         if use_weight:
             alg_params['WEIGHT'] = weight_field
@@ -219,36 +239,26 @@ class StyledDensityGridAlgorithm(QgsProcessingAlgorithm):
             alg_params['WEIGHT'] = ''
         outputs['CountPointsInPolygon'] = processing.run('native:countpointsinpolygon', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
 
-        feedback.setCurrentStep(2)
+        feedback.setCurrentStep(3)
         if feedback.isCanceled():
             return {}
 
-        # Extract by attribute
-        alg_params = {
-            'FIELD': 'NUMPOINTS',
-            'INPUT': outputs['CountPointsInPolygon']['OUTPUT'],
-            'OPERATOR': 3,  # ≥
-            'VALUE': min_grid_cnt,
-            'OUTPUT': parameters['OUTPUT']
-        }
-        outputs['ExtractByAttribute'] = processing.run('native:extractbyattribute', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results['OUTPUT'] = outputs['ExtractByAttribute']['OUTPUT']
+        # Write the cells with at least min_grid_cnt points to the output in one pass
+        counts = QgsProcessingUtils.mapLayerFromString(outputs['CountPointsInPolygon']['OUTPUT'], context)
+        (sink, dest_id) = self.parameterAsSink(
+            parameters, 'OUTPUT', context, counts.fields(), counts.wkbType(), counts.crs())
+        copyToSink(counts, sink, feedback, '"NUMPOINTS" >= {}'.format(min_grid_cnt))
+        del sink
+        results['OUTPUT'] = dest_id
 
-        feedback.setCurrentStep(3)
+        feedback.setCurrentStep(4)
         if feedback.isCanceled():
             return {}
 
-        # Apply a graduated style
-        alg_params = {
-            'NO_OUTLINE': no_outline,
-            'INVERT': invert,
-            'CLASSES': num_classes,
-            'GROUP_FIELD': 'NUMPOINTS',
-            'INPUT': outputs['ExtractByAttribute']['OUTPUT'],
-            'MODE': ramp_mode,  # Equal Count (Quantile)
-            'RAMP_NAMES': ramp_name
-        }
-        outputs['GraduatedStyle'] = processing.run('densityanalysis:graduatedstyle', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        # Apply a graduated style directly to the output layer
+        layer = QgsProcessingUtils.mapLayerFromString(results['OUTPUT'], context)
+        if layer:
+            applyGraduatedStyle(layer, 'NUMPOINTS', ramp_name, invert, num_classes, ramp_mode, no_outline, feedback=feedback)
         return results
 
     def name(self):
@@ -20,8 +20,6 @@ License along with Geohash.  If not, see
 """
 from math import log10
 
-from qgis.core import QgsPointXY, QgsRectangle, QgsFeature, QgsGeometry, QgsProject
-
 #  Note: the alphabet in geohash differs from the common base32
 #  alphabet described in IETF's RFC 4648
 #  (http://tools.ietf.org/html/rfc4648)
@@ -133,3 +131,83 @@ def decode_extent(geohash):
                     lat_interval = (lat_interval[0], (lat_interval[0]+lat_interval[1])/2)
             is_even = not is_even
     return lat_interval[0], lat_interval[1], lon_interval[0], lon_interval[1]
+
+#  Neighbor and border lookup tables indexed by the direction and by whether
+#  the geohash has an odd or even number of characters.
+__neighbors = {
+    'n': ['p0r21436x8zb9dcf5h7kjnmqesgutwvy', 'bc01fg45238967deuvhjyznpkmstqrwx'],
+    's': ['14365h7k9dcfesgujnmqp0r2twvyx8zb', '238967debc01fg45kmstqrwxuvhjyznp'],
+    'e': ['bc01fg45238967deuvhjyznpkmstqrwx', 'p0r21436x8zb9dcf5h7kjnmqesgutwvy'],
+    'w': ['238967debc01fg45kmstqrwxuvhjyznp', '14365h7k9dcfesgujnmqp0r2twvyx8zb']
+}
+__borders = {
+    'n': ['prxz', 'bcfguvyz'],
+    's': ['028b', '0145hjnp'],
+    'e': ['bcfguvyz', 'prxz'],
+    'w': ['0145hjnp', '028b']
+}
+
+def adjacent(geohash, direction):
+    """
+    Return the geohash of the same precision that is adjacent in the
+    direction 'n', 's', 'e' or 'w'. Longitude wraps around the
+    antimeridian. None is returned past the poles.
+    """
+    if not geohash:
+        return None
+    last = geohash[-1]
+    parent = geohash[:-1]
+    odd = len(geohash) % 2
+    if last in __borders[direction][odd]:
+        if not parent:
+            if direction in ('n', 's'):
+                return None
+        else:
+            parent = adjacent(parent, direction)
+            if parent is None:
+                return None
+    return parent + __base32[__neighbors[direction][odd].index(last)]
+
+def neighbors(geohash):
+    """
+    Return the geohashes of the up to eight cells surrounding the
+    geohash.
+    """
+    result = []
+    n = adjacent(geohash, 'n')
+    s = adjacent(geohash, 's')
+    for h in (n, s):
+        if h is not None:
+            result.append(h)
+            result.append(adjacent(h, 'e'))
+            result.append(adjacent(h, 'w'))
+    result.append(adjacent(geohash, 'e'))
+    result.append(adjacent(geohash, 'w'))
+    return result
+
+def to_int(geohash):
+    """
+    Return the geohash packed into an integer with 5 bits per character
+    below a leading 1 bit, so that geohashes of different precisions have
+    different values. A 12 character geohash fits in 61 bits.
+    """
+    value = 1
+    for c in geohash:
+        value = (value << 5) | __decodemap[c]
+    return value
+
+def from_int(value):
+    """
+    Return the geohash of an integer created by to_int.
+    """
+    chars = []
+    while value > 1:
+        chars.append(__base32[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+def is_valid(geohash):
+    """
+    Return True if every character of the geohash is in the geohash base32 alphabet.
+    """
+    return all(c in __decodemap for c in geohash)
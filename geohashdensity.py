@@ -10,26 +10,39 @@
 """
 import os
 from qgis.PyQt.QtGui import QIcon
-from qgis.PyQt.QtCore import QVariant, QUrl
-from qgis.core import Qgis, QgsWkbTypes, QgsFields, QgsField, QgsCoordinateTransform, QgsCoordinateReferenceSystem, QgsRectangle, QgsFeature, QgsGeometry, QgsProject
+from qgis.PyQt.QtCore import QUrl
+from qgis.core import Qgis, QgsWkbTypes
 
 from qgis.core import (
     QgsProcessing,
     QgsProcessingAlgorithm,
+    QgsProcessingException,
     QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterExtent,
     QgsProcessingParameterField,
     QgsProcessingParameterNumber,
-    QgsProcessingParameterFeatureSink
+    QgsProcessingParameterEnum,
+    QgsProcessingParameterFeatureSink,
+    QgsProcessingParameterFileDestination,
+    QgsProcessingParameterBoolean,
+    QgsProcessingParameterDefinition
     )
 import processing
-
-from . import geohash
+from .densityengine import densityFields, geohashDensity, epsg4326, setTemporalPostProcessor
+from .settings import TIME_BIN_LABELS, AGGREGATE_LABELS
+from .cellstore import CELL_STORE_FILTER
+from .geoparquet import PARQUET_FILTER, pyarrowInstallString, pyarrowAvailable, needsPyarrow
+from .aggregates import AGG_COUNT, AGG_SUM, AGGREGATE_FIELDS, aggregateFactory
 
 class GeohashDensityAlgorithm(QgsProcessingAlgorithm):
 
     def initAlgorithm(self, config=None):
         self.addParameter(
-            QgsProcessingParameterFeatureSource('INPUT', 'Input point vector layer', [QgsProcessing.TypeVectorPoint])
+            QgsProcessingParameterFeatureSource('INPUT', 'Input point vector layer or table',
+                [QgsProcessing.TypeVectorPoint, QgsProcessing.TypeVector])
+        )
+        self.addParameter(
+            QgsProcessingParameterExtent('EXTENT', 'Only count points within extent (defaults to all points)', optional=True)
         )
         param = QgsProcessingParameterNumber('RESOLUTION', 'Geohash resolution',
                 type=QgsProcessingParameterNumber.Integer, minValue=1, defaultValue=6, maxValue=12, optional=False)
@@ -98,14 +111,65 @@ class GeohashDensityAlgorithm(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterField(
                 'WEIGHT',
-                'Weight field',
+                'Weight or aggregate field',
                 parentLayerParameterName='INPUT',
                 type=QgsProcessingParameterField.Numeric,
                 optional=True)
         )
+        param = QgsProcessingParameterEnum('AGGREGATE', 'Aggregate',
+            options=AGGREGATE_LABELS, defaultValue=0, optional=False)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterNumber('PERCENTILE', 'Percentile',
+            type=QgsProcessingParameterNumber.Double, minValue=0, maxValue=100, defaultValue=95, optional=False)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterField(
+            'ENTITY_FIELD',
+            'Entity field for distinct entity counts',
+            parentLayerParameterName='INPUT',
+            type=QgsProcessingParameterField.Any,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterField(
+            'INPUT_CELL_FIELD',
+            'Precomputed geohash field (skips reading the point geometry)',
+            parentLayerParameterName='INPUT',
+            type=QgsProcessingParameterField.Any,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterField(
+            'TIME_FIELD',
+            'Time field for space-time density',
+            parentLayerParameterName='INPUT',
+            type=QgsProcessingParameterField.DateTime,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterEnum('TIME_BIN', 'Time bin size',
+            options=TIME_BIN_LABELS, defaultValue=1, optional=False)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterNumber('MIN_COUNT', 'Minimum cell count',
+            type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=0, optional=False)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterFileDestination('CELL_STORE', 'Sparse cell count store',
+            fileFilter=CELL_STORE_FILTER, optional=True, createByDefault=False)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterFileDestination('PARQUET', 'Parquet cell table',
+            fileFilter=PARQUET_FILTER, optional=True, createByDefault=False)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterBoolean('PARQUET_GEOMETRY', 'Include cell polygons in the Parquet table', False, optional=False)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
         self.addParameter(
             QgsProcessingParameterFeatureSink('OUTPUT', 'Output geohash density map',
-                type=QgsProcessing.TypeVectorPolygon, createByDefault=True, defaultValue=None)
+                type=QgsProcessing.TypeVectorPolygon, createByDefault=True, defaultValue=None, optional=True)
         )
 
     def processAlgorithm(self, parameters, context, feedback):
@@ -116,73 +180,59 @@ class GeohashDensityAlgorithm(QgsProcessingAlgorithm):
             weight_field = self.parameterAsString(parameters, 'WEIGHT', context)
         else:
             use_weight = False
+        if 'TIME_FIELD' in parameters and parameters['TIME_FIELD']:
+            time_field = self.parameterAsString(parameters, 'TIME_FIELD', context)
+        else:
+            time_field = None
+        time_bin = self.parameterAsEnum(parameters, 'TIME_BIN', context)
+        min_count = self.parameterAsDouble(parameters, 'MIN_COUNT', context)
+        store_path = self.parameterAsFileOutput(parameters, 'CELL_STORE', context)
+        parquet_path = self.parameterAsFileOutput(parameters, 'PARQUET', context)
+        parquet_geometry = self.parameterAsBool(parameters, 'PARQUET_GEOMETRY', context)
+        if 'ENTITY_FIELD' in parameters and parameters['ENTITY_FIELD']:
+            entity_field = self.parameterAsString(parameters, 'ENTITY_FIELD', context)
+        else:
+            entity_field = None
+        if 'INPUT_CELL_FIELD' in parameters and parameters['INPUT_CELL_FIELD']:
+            cell_field = self.parameterAsString(parameters, 'INPUT_CELL_FIELD', context)
+        else:
+            cell_field = None
+            if QgsWkbTypes.geometryType(source.wkbType()) != QgsWkbTypes.PointGeometry:
+                raise QgsProcessingException('A table without point geometry requires a precomputed cell field')
+        aggregate = self.parameterAsEnum(parameters, 'AGGREGATE', context)
+        percentile = self.parameterAsDouble(parameters, 'PERCENTILE', context)
+        if aggregate != AGG_COUNT and not use_weight:
+            raise QgsProcessingException('The {} aggregate requires a weight or aggregate field'.format(AGGREGATE_LABELS[aggregate]))
         
-        epsg4326 = QgsCoordinateReferenceSystem("EPSG:4326")
-        fields = QgsFields()
-        fields.append(QgsField('ID', QVariant.Int))
-        fields.append(QgsField('GEOHASH', QVariant.String))
-        fields.append(QgsField('NUMPOINTS', QVariant.Double))
         (sink, dest_id) = self.parameterAsSink(
             parameters, 'OUTPUT',
-            context, fields, QgsWkbTypes.Polygon, epsg4326)
-        src_crs = source.sourceCrs()
-        
-        if src_crs != epsg4326:
-            transform = QgsCoordinateTransform(src_crs, epsg4326, QgsProject.instance())
-
-        total = 85.0 / source.featureCount() if source.featureCount() else 0
-        ghash = {}
-
-        iterator = source.getFeatures()
-        if use_weight:
-            for cnt, feature in enumerate(iterator):
-                if feedback.isCanceled():
-                    break
-                try:
-                    pt = feature.geometry().asPoint()
-                    if src_crs != epsg4326:
-                        pt = transform.transform(pt)
-                    h = geohash.encode(pt.y(), pt.x(), resolution)
-                    weight = feature[weight_field]
-                    if h in ghash:
-                        ghash[h] += weight
-                    else:
-                        ghash[h] = weight
-                except Exception:
-                    pass
-                if cnt % 1000 == 0:
-                    feedback.setProgress(int(cnt * total))
-        else:
-            for cnt, feature in enumerate(iterator):
-                if feedback.isCanceled():
-                    break
-                try:
-                    pt = feature.geometry().asPoint()
-                    if src_crs != epsg4326:
-                        pt = transform.transform(pt)
-                    h = geohash.encode(pt.y(), pt.x(), resolution)
-                    if h in ghash:
-                        ghash[h] += 1
-                    else:
-                        ghash[h] = 1
-                except Exception:
-                    pass
-                if cnt % 1000 == 0:
-                    feedback.setProgress(int(cnt * total))
-        if len(ghash) == 0:
+            context, densityFields('GEOHASH', time_field is not None, AGGREGATE_FIELDS[aggregate],
+                entity_field is not None), QgsWkbTypes.Polygon, epsg4326())
+        if sink is None and not parquet_path:
+            raise QgsProcessingException('Select an output density layer or a Parquet cell table')
+        # Check for pyarrow before the points are read rather than once they have all been binned
+        if needsPyarrow(parquet_path, store_path) and not pyarrowAvailable():
+            raise QgsProcessingException(pyarrowInstallString)
+        extent = self.parameterAsExtent(parameters, 'EXTENT', context)
+        extent_crs = self.parameterAsExtentCrs(parameters, 'EXTENT', context)
+        sample = geohashDensity([source], resolution, weight_field if use_weight else None, sink, feedback, time_field, time_bin,
+            aggregateFactory(aggregate, percentile), entity_field, min_count, store_path, parquet_path, parquet_geometry,
+            extent=extent, extent_crs=extent_crs, cell_field=cell_field)
+        if sample is None:
             return {}
-        total = 15 / len(ghash)
-        for cnt, key in enumerate(ghash.keys()):
-            val = ghash[key]
-            lat1, lat2, lon1, lon2 = geohash.decode_extent(key)
-            rect = QgsRectangle(lon1, lat1, lon2, lat2)
-            f = QgsFeature()
-            f.setGeometry(QgsGeometry.fromRect(rect))
-            f.setAttributes([cnt, key, val])
-            sink.addFeature(f)
-            if cnt % 100 == 0:
-                feedback.setProgress(int(cnt * total)+85)
-        return {'OUTPUT': dest_id}
+        results = {}
+        if sink is not None:
+            results['OUTPUT'] = dest_id
+            if time_field:
+                setTemporalPostProcessor(dest_id, context)
+        # The files are only written when the algorithm was not canceled, and the cell
+        # store only for plain counts without time bins, aggregates or entities
+        plain_counts = time_field is None and entity_field is None and aggregate in (AGG_COUNT, AGG_SUM)
+        if store_path and plain_counts and not feedback.isCanceled():
+            results['CELL_STORE'] = store_path
+        if parquet_path and not feedback.isCanceled():
+            results['PARQUET'] = parquet_path
+        return results
 
     def group(self):
         return 'Geohash density'
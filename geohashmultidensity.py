@@ -10,21 +10,22 @@
 """
 import os
 from qgis.PyQt.QtGui import QIcon
-from qgis.PyQt.QtCore import QVariant, QUrl
-from qgis.core import Qgis, QgsWkbTypes, QgsFields, QgsField, QgsCoordinateTransform, QgsCoordinateReferenceSystem, QgsRectangle, QgsFeature, QgsGeometry, QgsProject
+from qgis.PyQt.QtCore import QUrl
+from qgis.core import Qgis, QgsWkbTypes
 
 from qgis.core import (
     QgsProcessing,
     QgsProcessingAlgorithm,
     QgsProcessingException,
     QgsProcessingParameterMultipleLayers,
+    QgsProcessingParameterExtent,
     QgsProcessingParameterField,
     QgsProcessingParameterNumber,
-    QgsProcessingParameterFeatureSink
+    QgsProcessingParameterFeatureSink,
+    QgsProcessingParameterDefinition
     )
 import processing
-
-from . import geohash
+from .densityengine import densityFields, geohashDensity, epsg4326
 
 class GeohashMultiLayerDensityAlgorithm(QgsProcessingAlgorithm):
 
@@ -32,6 +33,9 @@ class GeohashMultiLayerDensityAlgorithm(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterMultipleLayers('INPUT', 'Input point vector layers', QgsProcessing.TypeVectorPoint)
         )
+        self.addParameter(
+            QgsProcessingParameterExtent('EXTENT', 'Only count points within extent (defaults to all points)', optional=True)
+        )
         param = QgsProcessingParameterNumber('RESOLUTION', 'Geohash resolution',
                 type=QgsProcessingParameterNumber.Integer, minValue=1, defaultValue=6, maxValue=12, optional=False)
         if Qgis.QGIS_VERSION_INT >= 31600:
@@ -104,6 +108,14 @@ class GeohashMultiLayerDensityAlgorithm(QgsProcessingAlgorithm):
                 type=QgsProcessingParameterField.Numeric,
                 optional=True)
         )
+        param = QgsProcessingParameterField(
+            'ENTITY_FIELD',
+            'Entity field for distinct entity counts',
+            parentLayerParameterName='INPUT',
+            type=QgsProcessingParameterField.Any,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
         self.addParameter(
             QgsProcessingParameterFeatureSink('OUTPUT', 'Output geohash density map',
                 type=QgsProcessing.TypeVectorPolygon, createByDefault=True, defaultValue=None)
@@ -119,79 +131,20 @@ class GeohashMultiLayerDensityAlgorithm(QgsProcessingAlgorithm):
             weight_field = self.parameterAsString(parameters, 'WEIGHT', context)
         else:
             use_weight = False
+        if 'ENTITY_FIELD' in parameters and parameters['ENTITY_FIELD']:
+            entity_field = self.parameterAsString(parameters, 'ENTITY_FIELD', context)
+        else:
+            entity_field = None
         
-        epsg4326 = QgsCoordinateReferenceSystem("EPSG:4326")
-        fields = QgsFields()
-        fields.append(QgsField('ID', QVariant.Int))
-        fields.append(QgsField('GEOHASH', QVariant.String))
-        fields.append(QgsField('NUMPOINTS', QVariant.Double))
         (sink, dest_id) = self.parameterAsSink(
             parameters, 'OUTPUT',
-            context, fields, QgsWkbTypes.Polygon, epsg4326)
-
-        ghash = {}
-        num_layers = len(layer_list)
-        cumulative = 0
-        incremental = 85 / num_layers
-        for layer in layer_list:
-            src_crs = layer.sourceCrs()
-            
-            if src_crs != epsg4326:
-                transform = QgsCoordinateTransform(src_crs, epsg4326, QgsProject.instance())
-
-            total = incremental / layer.featureCount() if layer.featureCount() else 0
-
-            iterator = layer.getFeatures()
-            if use_weight:
-                for cnt, feature in enumerate(iterator):
-                    if feedback.isCanceled():
-                        break
-                    try:
-                        pt = feature.geometry().asPoint()
-                        if src_crs != epsg4326:
-                            pt = transform.transform(pt)
-                        h = geohash.encode(pt.y(), pt.x(), resolution)
-                        weight = feature[weight_field]
-                        if h in ghash:
-                            ghash[h] += weight
-                        else:
-                            ghash[h] = weight
-                    except Exception:
-                        pass
-                    if cnt % 1000 == 0:
-                        feedback.setProgress(int(cnt * total + cumulative))
-            else:
-                for cnt, feature in enumerate(iterator):
-                    if feedback.isCanceled():
-                        break
-                    try:
-                        pt = feature.geometry().asPoint()
-                        if src_crs != epsg4326:
-                            pt = transform.transform(pt)
-                        h = geohash.encode(pt.y(), pt.x(), resolution)
-                        if h in ghash:
-                            ghash[h] += 1
-                        else:
-                            ghash[h] = 1
-                    except Exception:
-                        pass
-                    if cnt % 1000 == 0:
-                        feedback.setProgress(int(cnt * total + cumulative))
-            cumulative += incremental
-
-        if len(ghash) == 0:
+            context, densityFields('GEOHASH', entities=entity_field is not None), QgsWkbTypes.Polygon, epsg4326())
+        extent = self.parameterAsExtent(parameters, 'EXTENT', context)
+        extent_crs = self.parameterAsExtentCrs(parameters, 'EXTENT', context)
+        sample = geohashDensity(layer_list, resolution, weight_field if use_weight else None, sink, feedback,
+            entity_field=entity_field, extent=extent, extent_crs=extent_crs)
+        if sample is None:
             return {}
-        total = 15 / len(ghash)
-        for cnt, key in enumerate(ghash.keys()):
-            val = ghash[key]
-            lat1, lat2, lon1, lon2 = geohash.decode_extent(key)
-            rect = QgsRectangle(lon1, lat1, lon2, lat2)
-            f = QgsFeature()
-            f.setGeometry(QgsGeometry.fromRect(rect))
-            f.setAttributes([cnt, key, val])
-            sink.addFeature(f)
-            if cnt % 100 == 0:
-                feedback.setProgress(int(cnt * total)+85)
         return {'OUTPUT': dest_id}
 
     def group(self):
@@ -11,24 +11,27 @@
 import os
 from qgis.PyQt.QtCore import QUrl
 from qgis.PyQt.QtGui import QIcon
-from qgis.core import Qgis
+from qgis.core import Qgis, QgsWkbTypes, QgsProcessingUtils
 
 from qgis.core import (
     QgsProcessing,
     QgsProcessingAlgorithm,
+    QgsProcessingException,
     QgsProcessingParameterBoolean,
     QgsProcessingParameterEnum,
     QgsProcessingParameterField,
     QgsProcessingParameterMultipleLayers,
+    QgsProcessingParameterExtent,
     QgsProcessingParameterNumber,
     QgsProcessingParameterString,
     QgsProcessingParameterDefinition,
     QgsProcessingParameterFeatureSink
     )
-import processing
 
 from . import geohash
 from .settings import settings, COLOR_RAMP_MODE
+from .densityengine import densityFields, geohashDensity, epsg4326
+from .graduatedstyle import applyGraduatedStyle
 
 class GeohashMultiLayerDensityMapAlgorithm(QgsProcessingAlgorithm):
 
@@ -36,6 +39,9 @@ class GeohashMultiLayerDensityMapAlgorithm(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterMultipleLayers('INPUT', 'Input point vector layers', QgsProcessing.TypeVectorPoint)
         )
+        self.addParameter(
+            QgsProcessingParameterExtent('EXTENT', 'Only count points within extent (defaults to all points)', optional=True)
+        )
         param = QgsProcessingParameterNumber('RESOLUTION', 'Geohash resolution',
                 type=QgsProcessingParameterNumber.Integer, minValue=1, defaultValue=6, maxValue=12, optional=False)
         if Qgis.QGIS_VERSION_INT >= 31600:
@@ -169,37 +175,32 @@ class GeohashMultiLayerDensityMapAlgorithm(QgsProcessingAlgorithm):
             # In this case ramp_name will be the name
             ramp_name = self.parameterAsString(parameters, 'RAMP_NAMES', context)
         else:
-            # In this case ramp_name will be an index into ramp_names
-            ramp_name = self.parameterAsEnum(parameters, 'RAMP_NAMES', context)
+            # In this case RAMP_NAMES is an index into ramp_names
+            ramp_name = settings.ramp_names[self.parameterAsEnum(parameters, 'RAMP_NAMES', context)]
         ramp_mode = self.parameterAsInt(parameters, 'COLOR_RAMP_MODE', context)
         no_outline = self.parameterAsBool(parameters, 'NO_OUTLINE', context)
         invert = self.parameterAsBool(parameters, 'INVERT', context)
         
-        results = {}
-        outputs = {}
-
-        alg_params = {
-            'INPUT':  parameters['INPUT'],
-            'RESOLUTION': resolution,
-            'OUTPUT': parameters['OUTPUT']
-        }
-        if use_weight:
-            alg_params['WEIGHT'] = weight_field
-        outputs['CreateGrid'] = processing.run('densityanalysis:geohashmultidensity', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results['OUTPUT'] = outputs['CreateGrid']['OUTPUT']
-
-        # Apply a graduated style
-        alg_params = {
-            'NO_OUTLINE': no_outline,
-            'INVERT': invert,
-            'CLASSES': num_classes,
-            'GROUP_FIELD': 'NUMPOINTS',
-            'INPUT': outputs['CreateGrid']['OUTPUT'],
-            'MODE': ramp_mode,
-            'RAMP_NAMES': ramp_name
-        }
-        processing.run('densityanalysis:graduatedstyle', alg_params, context=context, feedback=feedback, is_child_algorithm=False)
-        return results
+        layer_list = self.parameterAsLayerList(parameters, 'INPUT', context)
+        if layer_list is None or len(layer_list) == 0:
+            raise QgsProcessingException('No point layers were selected.')
+        (sink, dest_id) = self.parameterAsSink(
+            parameters, 'OUTPUT',
+            context, densityFields('GEOHASH'), QgsWkbTypes.Polygon, epsg4326())
+        # The density engine and styler are called in process. The output is styled with the
+        # cell values sampled while it was written, so it is never read back.
+        extent = self.parameterAsExtent(parameters, 'EXTENT', context)
+        extent_crs = self.parameterAsExtentCrs(parameters, 'EXTENT', context)
+        sample = geohashDensity(layer_list, resolution, weight_field if use_weight else None, sink, feedback,
+            extent=extent, extent_crs=extent_crs)
+        # Release the sink so that all the features are written before the layer is styled
+        del sink
+        if sample is None or feedback.isCanceled():
+            return {}
+        layer = QgsProcessingUtils.mapLayerFromString(dest_id, context)
+        if layer:
+            applyGraduatedStyle(layer, 'NUMPOINTS', ramp_name, invert, num_classes, ramp_mode, no_outline, sample, feedback=feedback)
+        return {'OUTPUT': dest_id}
 
     def group(self):
         return 'Geohash density'
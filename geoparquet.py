@@ -0,0 +1,110 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import json
+import numpy as np
+from .aggregates import CellAggregate, AGGREGATE_FIELDS
+from .cellstore import cellId
+from .hotspots import CELL_GEOHASH
+
+PARQUET_FILTER = 'Parquet (*.parquet)'
+# Rows are sorted by cell id so each row group covers a narrow range of ids
+PARQUET_ROW_GROUP_SIZE = 100000
+
+pyarrowInstallString = 'Writing Parquet files requires the pyarrow Python package. It can be installed with "pip install pyarrow".'
+
+def pyarrowAvailable():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        return True
+    except Exception:
+        return False
+
+def needsPyarrow(*paths):
+    '''Returns True if any of the output paths is a Parquet file.'''
+    return any(path and os.path.splitext(path)[1].lower() == '.parquet' for path in paths)
+
+def geoMetadata(geometry_column):
+    '''Returns the GeoParquet metadata of WKB polygons in longitude, latitude order.'''
+    return json.dumps({
+        'version': '1.0.0',
+        'primary_column': geometry_column,
+        'columns': {
+            geometry_column: {
+                'encoding': 'WKB',
+                'geometry_types': ['Polygon']
+            }
+        }
+    })
+
+def writeDensityParquet(path, cell_type, items, cell_name, cell_geometry=None, entities=None, time_bin_seconds=None, feedback=None):
+    '''
+    Writes the (key, value) cell items of a geohash or H3 density map as a Parquet
+    table sorted by cell id, and by time bin within a cell. The columns match the
+    attributes of the density layer with an additional int64 CELL_ID. The polygon
+    of each cell is only created when cell_geometry is given and is then written
+    as a GeoParquet WKB geometry column. Returns False if it was canceled before the
+    file was written.
+    '''
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except Exception:
+        raise ImportError(pyarrowInstallString)
+    n = len(items)
+    temporal = time_bin_seconds is not None
+    if temporal:
+        cells = [key[0] for key, val in items]
+        times = np.fromiter((key[1] for key, val in items), dtype=np.int64, count=n)
+    else:
+        cells = [key for key, val in items]
+    ids = np.fromiter((cellId(cell_type, c) for c in cells), dtype=np.int64, count=n)
+    order = np.lexsort((times, ids)) if temporal else np.argsort(ids, kind='stable')
+    cells = [cells[i] for i in order.tolist()]
+    values = [items[i][1] for i in order.tolist()]
+
+    columns = {}
+    columns['CELL_ID'] = pa.array(ids[order])
+    columns['GEOHASH' if cell_type == CELL_GEOHASH else 'H3HASH'] = pa.array([cell_name(c) for c in cells], type=pa.string())
+    if n and isinstance(values[0], CellAggregate):
+        columns['NUMPOINTS'] = pa.array([v.count for v in values], type=pa.float64())
+        columns[AGGREGATE_FIELDS[values[0].aggregate]] = pa.array([v.value() for v in values], type=pa.float64())
+    else:
+        columns['NUMPOINTS'] = pa.array(values, type=pa.float64())
+    if entities is not None:
+        keys = [items[i][0] for i in order.tolist()]
+        columns['NUMENTITIES'] = pa.array([entities[k].count() for k in keys], type=pa.int64())
+    if temporal:
+        start = times[order]
+        columns['TIME_START'] = pa.array(start, type=pa.timestamp('s', tz='UTC'))
+        columns['TIME_END'] = pa.array(start + time_bin_seconds, type=pa.timestamp('s', tz='UTC'))
+    metadata = None
+    if cell_geometry:
+        wkb = []
+        last_cell = None
+        last_wkb = None
+        for cnt, c in enumerate(cells):
+            if feedback and cnt % 10000 == 0 and feedback.isCanceled():
+                return False
+            # The rows of a cell are adjacent so its polygon is only created once for all of its time bins
+            if c != last_cell:
+                geom = cell_geometry(c)
+                last_wkb = bytes(geom.asWkb()) if geom is not None else None
+                last_cell = c
+            wkb.append(last_wkb)
+        columns['geometry'] = pa.array(wkb, type=pa.binary())
+        metadata = {b'geo': geoMetadata('geometry').encode('utf-8')}
+    table = pa.table(columns)
+    if metadata:
+        table = table.replace_schema_metadata(metadata)
+    pq.write_table(table, path, row_group_size=PARQUET_ROW_GROUP_SIZE, compression='zstd')
+    return True
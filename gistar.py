@@ -0,0 +1,132 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+from qgis.PyQt.QtGui import QIcon
+from qgis.PyQt.QtCore import QVariant, QUrl
+from qgis.core import QgsFields, QgsField, QgsFeature
+
+from qgis.core import (
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterField,
+    QgsProcessingParameterFeatureSink
+    )
+from .hotspots import cellType, readCells, giStar, CELL_H3
+
+class GetisOrdGiStarAlgorithm(QgsProcessingAlgorithm):
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterFeatureSource('INPUT', 'Input density map layer', [QgsProcessing.TypeVectorPolygon])
+        )
+        self.addParameter(
+            QgsProcessingParameterField(
+                'FIELD',
+                'Density field',
+                defaultValue='NUMPOINTS',
+                parentLayerParameterName='INPUT',
+                type=QgsProcessingParameterField.Numeric,
+                optional=False)
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSink('OUTPUT', 'Output Gi* hotspots',
+                type=QgsProcessing.TypeVectorPolygon, createByDefault=True, defaultValue=None)
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        source = self.parameterAsSource(parameters, 'INPUT', context)
+        field = self.parameterAsString(parameters, 'FIELD', context)
+        src_fields = source.fields()
+        if cellType(src_fields) == CELL_H3:
+            try:
+                import h3.api.basic_int as h3
+            except Exception:
+                from .utils import h3InstallString
+                feedback.reportError(h3InstallString)
+                return {}
+
+        fields = QgsFields(src_fields)
+        fields.append(QgsField('GI_ZSCORE', QVariant.Double))
+        fields.append(QgsField('GI_PVALUE', QVariant.Double))
+        (sink, dest_id) = self.parameterAsSink(
+            parameters, 'OUTPUT',
+            context, fields, source.wkbType(), source.sourceCrs())
+
+        feedback.pushInfo('Reading density cells')
+        # The features are kept so that the layer is only read once
+        features = []
+        cells = readCells(source, src_fields, None, field, feedback=feedback, features=features)
+        if feedback.isCanceled():
+            return {}
+        feedback.setProgress(30)
+        feedback.pushInfo('Finding the neighbors of {} cells'.format(len(cells)))
+        src, dst = cells.edges(feedback)
+        empty_neighbors, num_empty = cells.emptyNeighbors(feedback)
+        if feedback.isCanceled():
+            return {}
+        feedback.pushInfo('{} empty neighboring cells are counted as 0'.format(num_empty))
+        feedback.setProgress(60)
+        zscores, pvalues = giStar(cells.scores, src, dst, empty_neighbors, num_empty)
+        del src, dst, empty_neighbors
+        index = {}
+        for i, fid in enumerate(cells.fids):
+            index[fid] = i
+        total = 40.0 / len(features) if features else 0
+        for cnt, feature in enumerate(features):
+            if feedback.isCanceled():
+                break
+            attr = feature.attributes()
+            i = index.get(feature.id())
+            if i is None or zscores[i] != zscores[i]:
+                attr.extend([None, None])
+            else:
+                attr.extend([float(zscores[i]), float(pvalues[i])])
+            f = QgsFeature()
+            f.setGeometry(feature.geometry())
+            f.setAttributes(attr)
+            sink.addFeature(f)
+            if cnt % 1000 == 0:
+                feedback.setProgress(60 + int(cnt * total))
+        return {'OUTPUT': dest_id}
+
+    def shortHelpString(self):
+        return (
+            'Calculates the Getis-Ord Gi* hotspot statistic of a geohash, H3 or styled density map. '
+            'The neighbors of each cell are the surrounding geohash or H3 cells, or the grid cells it touches. '
+            'Empty geohash and H3 neighbors, and the empty cells of rectangular grids, are counted as 0. '
+            'Diamond and hexagon grids need to be created with a minimum cell count of 0 so that their empty cells are included. '
+            'GI_ZSCORE and GI_PVALUE are added to the input attributes. Large positive z-scores are statistically '
+            'significant hotspots and can be used as the score in the density map analysis tool.')
+
+    def group(self):
+        return 'Hotspot analysis'
+
+    def groupId(self):
+        return 'hotspotanalysis'
+
+    def name(self):
+        return 'gistar'
+
+    def displayName(self):
+        return 'Getis-Ord Gi* hotspot statistic'
+
+    def icon(self):
+        return QIcon(os.path.join(os.path.dirname(__file__), 'icons/densityexplorer.svg'))
+
+    def helpUrl(self):
+        file = os.path.dirname(__file__) + '/index.html'
+        if not os.path.exists(file):
+            return ''
+        return QUrl.fromLocalFile(file).toString(QUrl.FullyEncoded)
+
+    def createInstance(self):
+        return GetisOrdGiStarAlgorithm()
@@ -19,10 +19,73 @@ from qgis.core import (
     QgsProcessingParameterEnum,
     QgsProcessingParameterNumber,
     QgsProcessingParameterString,
+    QgsProcessingParameterDefinition,
     QgsProcessingParameterVectorLayer,
     QgsProcessingParameterField)
 import processing
 from .settings import settings, COLOR_RAMP_MODE
+from .classbreaks import sampleLayerValues, createGraduatedRenderer
+
+
+def applyGraduatedStyle(layer, attr, ramp_name, invert, num_classes, mode, no_outline, sample=None, max_sample=0, feedback=None):
+    '''
+    Applies a graduated style to a vector layer. This is used by the graduated style
+    algorithm and called directly by the styled density map algorithms. If a ValueSample
+    is given, the class breaks are calculated from it and the layer is not read.
+    '''
+    if mode == 0: # Quantile
+        grad_mode = QgsGraduatedSymbolRenderer.Quantile
+    elif mode == 1: # Equal Interval
+        grad_mode = QgsGraduatedSymbolRenderer.EqualInterval
+    elif mode == 2: # Logarithmic scale
+        grad_mode = QgsGraduatedSymbolRenderer.Quantile
+    elif mode == 3: # Natural Breaks (Jenks)
+        grad_mode = QgsGraduatedSymbolRenderer.Jenks
+    elif mode == 4: # Pretty Breaks
+        grad_mode = QgsGraduatedSymbolRenderer.Pretty
+    elif mode == 5: # Standard Deviation
+        grad_mode = QgsGraduatedSymbolRenderer.StdDev
+
+    geomtype = layer.geometryType()
+    symbol = QgsSymbol.defaultSymbol(geomtype)
+    if no_outline:
+        symbol.symbolLayer(0).setStrokeStyle(Qt.PenStyle(Qt.NoPen))
+    style = QgsStyle.defaultStyle()
+    ramp = style.colorRamp(ramp_name)
+    if invert:
+        ramp.invert()
+    if sample is not None or max_sample > 0:
+        # Calculate the class breaks from a bounded sample of the field values and build
+        # the renderer from the explicit ranges so that large layers are not fully classified.
+        # A density algorithm may have already sampled its output in which case the layer
+        # is not read at all.
+        if sample is None:
+            sample = sampleLayerValues(layer, attr, max_sample, feedback)
+        if sample.isEmpty():
+            if feedback:
+                feedback.reportError('No numeric values were found in field {}'.format(attr))
+            return
+        if feedback:
+            feedback.pushInfo('Classified using {} of {} values'.format(len(sample.values), sample.count))
+        new_renderer = createGraduatedRenderer(attr, sample, num_classes, mode, symbol, ramp)
+        layer.setRenderer(new_renderer)
+        layer.triggerRepaint()
+        return
+    new_renderer = QgsGraduatedSymbolRenderer.createRenderer(
+        layer, # The layer
+        attr, # Attribute name
+        num_classes, # Number of classes
+        grad_mode, # Mode
+        symbol, # QgsSymbol
+        ramp # Our color ramp
+    )
+    if mode == 2:
+        new_renderer.setClassificationMethod(QgsClassificationLogarithmic())
+        new_renderer.updateClasses(layer, num_classes)
+    layer.setRenderer(new_renderer)
+    # feedback.pushInfo('dump: {}'.format(new_renderer.dump()))
+    # new_renderer.updateClasses(layer, num_classes)
+    layer.triggerRepaint()
 
 
 class GraduatedStyleAlgorithm(QgsProcessingAlgorithm):
@@ -83,6 +146,15 @@ class GraduatedStyleAlgorithm(QgsProcessingAlgorithm):
                 True,
                 optional=False)
         )
+        param = QgsProcessingParameterNumber(
+            'MAX_SAMPLE',
+            'Maximum number of values sampled for classification (0 uses all features)',
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=0,
+            minValue=0,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
 
     def processAlgorithm(self, parameters, context, feedback):
         layer = self.parameterAsVectorLayer(parameters, 'INPUT', context)
@@ -95,43 +167,9 @@ class GraduatedStyleAlgorithm(QgsProcessingAlgorithm):
         num_classes = self.parameterAsInt(parameters, 'CLASSES', context)
         no_outline = self.parameterAsBool(parameters, 'NO_OUTLINE', context)
         invert = self.parameterAsBool(parameters, 'INVERT', context)
+        max_sample = self.parameterAsInt(parameters, 'MAX_SAMPLE', context)
         
-        if mode == 0: # Quantile
-            grad_mode = QgsGraduatedSymbolRenderer.Quantile
-        elif mode == 1: # Equal Interval
-            grad_mode = QgsGraduatedSymbolRenderer.EqualInterval
-        elif mode == 2: # Logarithmic scale
-            grad_mode = QgsGraduatedSymbolRenderer.Quantile
-        elif mode == 3: # Natural Breaks (Jenks)
-            grad_mode = QgsGraduatedSymbolRenderer.Jenks
-        elif mode == 4: # Pretty Breaks
-            grad_mode = QgsGraduatedSymbolRenderer.Pretty
-        elif mode == 5: # Standard Deviation
-            grad_mode = QgsGraduatedSymbolRenderer.StdDev
-
-        geomtype = layer.geometryType()
-        symbol = QgsSymbol.defaultSymbol(geomtype)
-        if no_outline:
-            symbol.symbolLayer(0).setStrokeStyle(Qt.PenStyle(Qt.NoPen))
-        style = QgsStyle.defaultStyle()
-        ramp = style.colorRamp(ramp_name)
-        if invert:
-            ramp.invert()
-        new_renderer = QgsGraduatedSymbolRenderer.createRenderer(
-            layer, # The layer
-            attr, # Attribute name
-            num_classes, # Number of classes
-            grad_mode, # Mode
-            symbol, # QgsSymbol
-            ramp # Our color ramp
-        )
-        if mode == 2:
-            new_renderer.setClassificationMethod(QgsClassificationLogarithmic())
-            new_renderer.updateClasses(layer, num_classes)
-        layer.setRenderer(new_renderer)
-        # feedback.pushInfo('dump: {}'.format(new_renderer.dump()))
-        # new_renderer.updateClasses(layer, num_classes)
-        layer.triggerRepaint()
+        applyGraduatedStyle(layer, attr, ramp_name, invert, num_classes, mode, no_outline, max_sample=max_sample, feedback=feedback)
         return({})
 
     def group(self):
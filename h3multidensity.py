@@ -10,18 +10,22 @@
 """
 import os
 from qgis.PyQt.QtGui import QIcon
-from qgis.PyQt.QtCore import QVariant, QUrl
-from qgis.core import Qgis, QgsWkbTypes, QgsFields, QgsField, QgsCoordinateTransform, QgsCoordinateReferenceSystem,  QgsFeature, QgsGeometry, QgsPointXY, QgsProject
+from qgis.PyQt.QtCore import QUrl
+from qgis.core import Qgis, QgsWkbTypes
 
 from qgis.core import (
     QgsProcessing,
     QgsProcessingAlgorithm,
+    QgsProcessingException,
     QgsProcessingParameterMultipleLayers,
+    QgsProcessingParameterExtent,
     QgsProcessingParameterNumber,
     QgsProcessingParameterField,
-    QgsProcessingParameterFeatureSink
+    QgsProcessingParameterFeatureSink,
+    QgsProcessingParameterDefinition
     )
 import processing
+from .densityengine import densityFields, h3Density, epsg4326
 
 class H3MultiLayerDensityAlgorithm(QgsProcessingAlgorithm):
 
@@ -29,6 +33,9 @@ class H3MultiLayerDensityAlgorithm(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterMultipleLayers('INPUT', 'Input point vector layers', QgsProcessing.TypeVectorPoint)
         )
+        self.addParameter(
+            QgsProcessingParameterExtent('EXTENT', 'Only count points within extent (defaults to all points)', optional=True)
+        )
         param = QgsProcessingParameterNumber('RESOLUTION', 'H3 Resolution',
                 type=QgsProcessingParameterNumber.Integer, minValue=0, defaultValue=9, maxValue=15, optional=False)
         if Qgis.QGIS_VERSION_INT >= 31600:
@@ -117,6 +124,14 @@ class H3MultiLayerDensityAlgorithm(QgsProcessingAlgorithm):
                 type=QgsProcessingParameterField.Numeric,
                 optional=True)
         )
+        param = QgsProcessingParameterField(
+            'ENTITY_FIELD',
+            'Entity field for distinct entity counts',
+            parentLayerParameterName='INPUT',
+            type=QgsProcessingParameterField.Any,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
         self.addParameter(
             QgsProcessingParameterFeatureSink('OUTPUT', 'Output H3 density map',
                 type=QgsProcessing.TypeVectorPolygon, createByDefault=True, defaultValue=None)
@@ -138,91 +153,20 @@ class H3MultiLayerDensityAlgorithm(QgsProcessingAlgorithm):
             weight_field = self.parameterAsString(parameters, 'WEIGHT', context)
         else:
             use_weight = False
+        if 'ENTITY_FIELD' in parameters and parameters['ENTITY_FIELD']:
+            entity_field = self.parameterAsString(parameters, 'ENTITY_FIELD', context)
+        else:
+            entity_field = None
         
-        epsg4326 = QgsCoordinateReferenceSystem("EPSG:4326")
-        fields = QgsFields()
-        fields.append(QgsField('ID', QVariant.Int))
-        fields.append(QgsField('H3HASH', QVariant.String))
-        fields.append(QgsField('NUMPOINTS', QVariant.Double))
         (sink, dest_id) = self.parameterAsSink(
             parameters, 'OUTPUT',
-            context, fields, QgsWkbTypes.Polygon, epsg4326)
-
-        
-        ghash = {}
-        num_layers = len(layer_list)
-        cumulative = 0
-        incremental = 85 / num_layers
-        for layer in layer_list:
-            src_crs = layer.sourceCrs()
-            
-            if src_crs != epsg4326:
-                transform = QgsCoordinateTransform(src_crs, epsg4326, QgsProject.instance())
-
-            total = incremental / layer.featureCount() if layer.featureCount() else 0
-
-            iterator = layer.getFeatures()
-            if use_weight:
-                for cnt, feature in enumerate(iterator):
-                    if feedback.isCanceled():
-                        break
-                    try:
-                        pt = feature.geometry().asPoint()
-                        if src_crs != epsg4326:
-                            pt = transform.transform(pt)
-                        h = h3.geo_to_h3(pt.y(), pt.x(), resolution)
-                        if h == 0: # Check to see if the input coordinates were invalid
-                            continue
-                        weight = feature[weight_field]
-                        if h in ghash:
-                            ghash[h] += weight
-                        else:
-                            ghash[h] = weight
-                    except Exception:
-                        pass
-                    if cnt % 1000 == 0:
-                        feedback.setProgress(int(cnt * total + cumulative))
-            else:
-                for cnt, feature in enumerate(iterator):
-                    if feedback.isCanceled():
-                        break
-                    try:
-                        pt = feature.geometry().asPoint()
-                        if src_crs != epsg4326:
-                            pt = transform.transform(pt)
-                        h = h3.geo_to_h3(pt.y(), pt.x(), resolution)
-                        if h == 0: # Check to see if the input coordinates were invalid
-                            continue
-                        if h in ghash:
-                            ghash[h] += 1
-                        else:
-                            ghash[h] = 1
-                    except Exception:
-                        pass
-                    if cnt % 1000 == 0:
-                        feedback.setProgress(int(cnt * total + cumulative))
-            cumulative += incremental
-
-        if len(ghash) == 0:
+            context, densityFields('H3HASH', entities=entity_field is not None), QgsWkbTypes.Polygon, epsg4326())
+        extent = self.parameterAsExtent(parameters, 'EXTENT', context)
+        extent_crs = self.parameterAsExtentCrs(parameters, 'EXTENT', context)
+        sample = h3Density(layer_list, h3, resolution, weight_field if use_weight else None, sink, feedback,
+            entity_field=entity_field, extent=extent, extent_crs=extent_crs)
+        if sample is None:
             return {}
-        total = 15 / len(ghash)
-        for cnt, key in enumerate(ghash.keys()):
-            val = ghash[key]
-            try:
-                coords = h3.h3_to_geo_boundary(key)
-            except:
-                continue
-            pts = []
-            for p in coords:
-                pt = QgsPointXY(p[1], p[0])
-                pts.append(pt)
-            # pts.append(pts[0])
-            f = QgsFeature()
-            f.setGeometry(QgsGeometry.fromPolygonXY([pts]))
-            f.setAttributes([cnt, h3.h3_to_string(key), val])
-            sink.addFeature(f)
-            if cnt % 100 == 0:
-                feedback.setProgress(int(cnt * total)+85)
         return {'OUTPUT': dest_id}
 
     def group(self):
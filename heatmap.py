@@ -9,26 +9,265 @@
  ***************************************************************************/
 """
 import os
+from array import array
+import numpy as np
 
 from qgis.PyQt.uic import loadUiType
-from qgis.PyQt.QtCore import Qt, QTimer
+from qgis.PyQt.QtCore import Qt, QTimer, QAbstractTableModel, QModelIndex, pyqtSignal
 from qgis.PyQt.QtGui import QIcon
-from qgis.PyQt.QtWidgets import QDockWidget, QAbstractItemView, QTableWidget, QTableWidgetItem
-from qgis.core import Qgis, QgsMapLayerProxyModel, QgsFieldProxyModel, QgsWkbTypes, QgsFeatureRequest, QgsCoordinateTransform, QgsProject, QgsRectangle, QgsPoint, QgsPointXY, QgsGeometry
+from qgis.PyQt.QtWidgets import QDockWidget, QAbstractItemView, QHeaderView
+from qgis.core import Qgis, QgsMapLayerProxyModel, QgsFieldProxyModel, QgsWkbTypes, QgsFeatureRequest, QgsCoordinateTransform, QgsProject, QgsRectangle, QgsPoint, QgsPointXY, QgsGeometry, QgsTask, QgsApplication, QgsVectorLayerFeatureSource, QgsMessageLog
 from qgis.gui import QgsRubberBand
 from qgis.utils import isPluginLoaded, plugins
 from .settings import settings
+from .hotspots import readCells, clusterCells, topFeatures
 import traceback
 
-MAX_LIST_SIZE = 5000
+MAX_LIST_SIZE = 500000
+# Number of ranked rows sent at a time from the background task to the results table
+RESULTS_CHUNK_SIZE = 5000
+# Providers that translate an ordered and limited feature request into SQL
+SQL_ORDER_PROVIDERS = ['postgres', 'spatialite', 'mssql', 'oracle', 'hana']
+SQL_ORDER_OGR_FORMATS = ['GPKG', 'SQLite']
 
 FORM_CLASS, _ = loadUiType(os.path.join(
     os.path.dirname(__file__), 'ui/density.ui'))
 
 
+def canPushOrderBy(layer):
+    '''Returns True if the layer's provider can sort and limit features in the database.'''
+    provider = layer.dataProvider()
+    if provider.name() in SQL_ORDER_PROVIDERS:
+        return True
+    return provider.name() == 'ogr' and provider.storageType() in SQL_ORDER_OGR_FORMATS
+
+def topScores(source, fields, id_field, score_field, k, push_order=False, task=None, num_features=0):
+    '''
+    Returns the feature ids, ids and scores of the k highest scoring features. Only the id and
+    score attributes are read. Where possible the ordering and limit are done by the database;
+    otherwise the features are streamed through a bounded heap rather than sorting the whole layer.
+    The source may be a layer or a QgsVectorLayerFeatureSource when run from a task.
+    '''
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes([id_field, score_field], fields)
+    fids = array('q')
+    ids = []
+    scores = []
+    if push_order:
+        request.addOrderBy('"{}"'.format(score_field), ascending=False, nullsfirst=False)
+        request.setLimit(k)
+        for f in source.getFeatures(request):
+            if task and task.isCanceled():
+                break
+            fids.append(f.id())
+            ids.append(f[id_field])
+            scores.append(f[score_field])
+        return fids, ids, scores
+    return topFeatures(source.getFeatures(request), id_field, score_field, k, task, num_features)
+
+def cellExtents(source, fids):
+    '''
+    Returns a flat array of the xmin, ymin, xmax, ymax bounding box of each feature id
+    in the order of fids. Only the geometry of the listed features is read.
+    '''
+    rows = {}
+    for row, fid in enumerate(fids):
+        rows[fid] = row
+    nan = float('nan')
+    extents = array('d', [nan]) * (4 * len(fids))
+    request = QgsFeatureRequest().setFilterFids(list(fids))
+    request.setSubsetOfAttributes([])
+    for f in source.getFeatures(request):
+        geom = f.geometry()
+        if geom.isNull():
+            continue
+        bbox = geom.boundingBox()
+        i = 4 * rows[f.id()]
+        extents[i] = bbox.xMinimum()
+        extents[i + 1] = bbox.yMinimum()
+        extents[i + 2] = bbox.xMaximum()
+        extents[i + 3] = bbox.yMaximum()
+    return extents
+
+class DensityRankingTask(QgsTask):
+    '''
+    Ranks the density cells in a background thread. The layer is read through a
+    QgsVectorLayerFeatureSource so that QGIS stays responsive, and the ranked rows
+    are sent back in chunks with their bounding boxes so the table fills progressively.
+    When clustering, neighboring cells whose score is greater than min_score are merged
+    into hotspots that are ranked by their summed score.
+    '''
+    resultsReady = pyqtSignal(object, object, object, object, object)
+
+    def __init__(self, layer, id_field, score_field, k, cluster=False, min_score=0):
+        super(DensityRankingTask, self).__init__('Ranking density cells of {}'.format(layer.name()), QgsTask.CanCancel)
+        # The feature source must be created in the main thread
+        self.source = QgsVectorLayerFeatureSource(layer)
+        self.fields = layer.fields()
+        self.push_order = canPushOrderBy(layer)
+        self.num_features = layer.featureCount()
+        self.id_field = id_field
+        self.score_field = score_field
+        self.k = k
+        self.cluster = cluster
+        self.min_score = min_score
+        self.exception = None
+
+    def run(self):
+        try:
+            if self.cluster:
+                return self.rankClusters()
+            return self.rankCells()
+        except Exception as e:
+            self.exception = e
+            return False
+
+    def finished(self, result):
+        if self.exception:
+            QgsMessageLog.logMessage('Ranking density cells failed: {}'.format(self.exception), 'Density analysis', Qgis.Warning)
+
+    def rankCells(self):
+        fids, ids, scores = topScores(
+            self.source, self.fields, self.id_field, self.score_field, self.k,
+            self.push_order, self, self.num_features)
+        if self.isCanceled():
+            return False
+        num_rows = len(fids)
+        for start in range(0, num_rows, RESULTS_CHUNK_SIZE):
+            if self.isCanceled():
+                return False
+            end = start + RESULTS_CHUNK_SIZE
+            extents = cellExtents(self.source, fids[start:end])
+            self.resultsReady.emit(fids[start:end], ids[start:end], scores[start:end], extents, None)
+            self.setProgress(50 + min(end, num_rows) * 50 / num_rows)
+        return True
+
+    def rankClusters(self):
+        cells = readCells(self.source, self.fields, self.id_field, self.score_field, self.min_score, self)
+        if self.isCanceled():
+            return False
+        self.setProgress(50)
+        clusters = clusterCells(cells, self)[:self.k]
+        if self.isCanceled():
+            return False
+        num_rows = len(clusters)
+        cell_fids = np.frombuffer(cells.fids, dtype=np.int64)
+        cell_scores = np.frombuffer(cells.scores, dtype=np.float64)
+        cell_extents = np.frombuffer(cells.extents, dtype=np.float64).reshape(len(cells), 4)
+        for start in range(0, num_rows, RESULTS_CHUNK_SIZE):
+            if self.isCanceled():
+                return False
+            fids = array('q')
+            ids = []
+            scores = []
+            extents = array('d')
+            members = []
+            for cluster in clusters[start:start + RESULTS_CHUNK_SIZE]:
+                # The highest scoring cell represents the cluster
+                top = cluster[0]
+                fids.append(cells.fids[top])
+                ids.append(cells.ids[top])
+                scores.append(float(cell_scores[cluster].sum()))
+                ext = cell_extents[cluster]
+                extents.extend([ext[:, 0].min(), ext[:, 1].min(), ext[:, 2].max(), ext[:, 3].max()])
+                members.append(array('q', cell_fids[cluster].tolist()))
+            self.resultsReady.emit(fids, ids, scores, extents, members)
+            self.setProgress(50 + min(start + RESULTS_CHUNK_SIZE, num_rows) * 50 / num_rows)
+        return True
+
+class DensityResultsModel(QAbstractTableModel):
+    '''
+    Table model of the ranked density cells. The rows are kept in flat arrays and the
+    view only asks for the rows that are visible, so very long lists scroll instantly.
+    When the rows are hotspot clusters, the feature ids of the member cells are also kept.
+    '''
+    headers = ['ID', 'Score', 'Cells']
+
+    def __init__(self, parent=None):
+        super(DensityResultsModel, self).__init__(parent)
+        self.fids = array('q')
+        self.ids = []
+        self.scores = []
+        self.extents = array('d')
+        self.members = None
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.fids)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return 2 if self.members is None else 3
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        row = index.row()
+        if index.column() == 0:
+            return '{}'.format(self.ids[row])
+        if index.column() == 2:
+            return '{}'.format(len(self.members[row]))
+        try:
+            return '{}'.format(self.scores[row])
+        except Exception:
+            return ''
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return super(DensityResultsModel, self).headerData(section, orientation, role)
+
+    def setResults(self, fids, ids, scores, extents, members=None):
+        self.beginResetModel()
+        self.fids = fids
+        self.ids = ids
+        self.scores = scores
+        self.extents = extents
+        self.members = members
+        self.endResetModel()
+
+    def clear(self, clustered=False):
+        self.setResults(array('q'), [], [], array('d'), [] if clustered else None)
+
+    def appendResults(self, fids, ids, scores, extents, members=None):
+        if len(fids) == 0:
+            return
+        first = len(self.fids)
+        self.beginInsertRows(QModelIndex(), first, first + len(fids) - 1)
+        self.fids.extend(fids)
+        self.ids.extend(ids)
+        self.scores.extend(scores)
+        self.extents.extend(extents)
+        if members is not None:
+            self.members.extend(members)
+        self.endInsertRows()
+
+    def rowFids(self, rows):
+        '''Returns the feature ids of the cells shown in rows.'''
+        if self.members is None:
+            return [self.fids[row] for row in rows]
+        fids = []
+        for row in rows:
+            fids.extend(self.members[row])
+        return fids
+
+    def extent(self, rows):
+        '''Returns the combined bounding box of the cells in rows from the cached extents.'''
+        rect = QgsRectangle()
+        rect.setMinimal()
+        for row in rows:
+            i = 4 * row
+            if self.extents[i] != self.extents[i]:  # NaN, no geometry
+                continue
+            rect.combineExtentWith(self.extents[i], self.extents[i + 1], self.extents[i + 2], self.extents[i + 3])
+        return rect
+
+
 class HeatmapAnalysis(QDockWidget, FORM_CLASS):
     selected_layer = None
-    density_layer = None
+    density_layer_id = None
     selected_score_field = None
 
     def __init__(self, iface, parent):
@@ -46,14 +285,20 @@ class HeatmapAnalysis(QDockWidget, FORM_CLASS):
         self.countComboBox.setFilters(QgsFieldProxyModel.Numeric)
         self.countComboBox.fieldChanged.connect(self.fieldChanged)
         self.zoomComboBox.currentIndexChanged.connect(self.zoomModeChanged)
-        self.resultsTable.setEditTriggers(QTableWidget.NoEditTriggers)
-        self.resultsTable.setColumnCount(2)
+        self.clusterCheckBox.toggled.connect(self.minScoreSpinBox.setEnabled)
+        self.clusterCheckBox.toggled.connect(self.clusteringChanged)
+        self.minScoreSpinBox.valueChanged.connect(self.clusteringChanged)
+        self.results_model = DensityResultsModel(self)
+        self.centroids = {}
+        self.task = None
+        self.resultsTable.setModel(self.results_model)
+        self.resultsTable.setEditTriggers(QAbstractItemView.NoEditTriggers)
         self.resultsTable.setSortingEnabled(False)
-        self.resultsTable.setHorizontalHeaderLabels(['ID','Score'])
+        # Fixed row heights keep the view from measuring every row of a long list
+        self.resultsTable.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
         self.resultsTable.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.resultsTable.setSelectionBehavior(QAbstractItemView.SelectRows)
-        self.resultsTable.itemSelectionChanged.connect(self.select_feature)
-        # self.resultsTable.itemClicked.connect(self.select_feature)
+        self.resultsTable.selectionModel().selectionChanged.connect(self.select_feature)
         self.rb = QgsRubberBand(self.canvas, QgsWkbTypes.LineGeometry)
         self.rb.setColor(settings.line_flash_color)
         self.rb.setWidth(settings.line_flash_width)
@@ -62,20 +307,25 @@ class HeatmapAnalysis(QDockWidget, FORM_CLASS):
         self.layerChanged()
 
     def closeEvent(self, e):
+        self.cancelTask()
         layer = self.densityHeatmapComboBox.currentLayer()
         if layer:
-            layer.setSubsetString('')
+            layer.removeSelection()
         QDockWidget.closeEvent(self, e)
 
     def fieldChanged(self, fieldName):
         self.layerChanged()
 
+    def clusteringChanged(self, value):
+        # The listed results no longer match the clustering settings
+        self.clearResults()
+
     def zoomModeChanged(self, index):
         if index == 2:
             self.resultsTable.setSelectionMode(QAbstractItemView.SingleSelection)
             layer = self.densityHeatmapComboBox.currentLayer()
             if layer:
-                layer.setSubsetString('')
+                layer.removeSelection()
         else:
             self.resultsTable.setSelectionMode(QAbstractItemView.ExtendedSelection)
 
@@ -88,9 +338,12 @@ class HeatmapAnalysis(QDockWidget, FORM_CLASS):
             reset_results = True
             self.selected_layer = layer
         density_layer = self.densityHeatmapComboBox.currentLayer()
-        if density_layer != self.density_layer:
-            if density_layer:
-                density_layer.setSubsetString('')
+        density_layer_id = density_layer.id() if density_layer else None
+        if density_layer_id != self.density_layer_id:
+            # The previous layer is tracked by id because it may have been removed from the project
+            previous_layer = QgsProject.instance().mapLayer(self.density_layer_id) if self.density_layer_id else None
+            if previous_layer:
+                previous_layer.removeSelection()
             self.idComboBox.blockSignals(True)
             self.idComboBox.setLayer(density_layer)
             self.idComboBox.setField('id')
@@ -100,7 +353,7 @@ class HeatmapAnalysis(QDockWidget, FORM_CLASS):
             self.countComboBox.setField('NUMPOINTS')
             self.countComboBox.blockSignals(False)
             reset_results = True
-            self.density_layer = density_layer
+            self.density_layer_id = density_layer_id
         
         score_field = self.countComboBox.currentField()
         if score_field != self.selected_score_field:
@@ -108,25 +361,47 @@ class HeatmapAnalysis(QDockWidget, FORM_CLASS):
             self.selected_score_field = score_field
 
         if reset_results:
-            self.resultsTable.setRowCount(0)
+            self.clearResults()
 
-    def select_feature(self):
+    def clearResults(self):
+        self.cancelTask()
+        self.results_model.clear()
+        self.centroids = {}
+
+    def cancelTask(self):
+        if self.task:
+            try:
+                self.task.resultsReady.disconnect(self.appendResults)
+                self.task.cancel()
+            except Exception:
+                # The task manager has already deleted a finished task
+                pass
+            self.task = None
+
+    def appendResults(self, fids, ids, scores, extents, members):
+        if self.sender() is not self.task:
+            return
+        self.results_model.appendResults(fids, ids, scores, extents, members)
+
+    def centroid(self, row):
+        '''Returns the centroid of the cell in a row. It is only calculated when the row is first selected.'''
+        fid = self.results_model.fids[row]
+        if fid not in self.centroids:
+            f = self.densityHeatmapComboBox.currentLayer().getFeature(fid)
+            self.centroids[fid] = f.geometry().centroid().asPoint()
+        return self.centroids[fid]
+
+    def select_feature(self, selected=None, deselected=None):
         density_layer = self.densityHeatmapComboBox.currentLayer()
-        selectedItems = self.resultsTable.selectedItems()
+        selected_rows = sorted([index.row() for index in self.resultsTable.selectionModel().selectedRows()])
         auto_zoom = self.zoomComboBox.currentIndex()
-        if len(selectedItems) == 0:
+        if len(selected_rows) == 0:
             if density_layer:
-                density_layer.setSubsetString('')
+                density_layer.removeSelection()
             return
         if auto_zoom != 2:
-            id_field_name = self.idComboBox.currentField()
-            ids = set()
-            for item in selectedItems:
-                selectedRow = item.row()
-                ids.add(self.resultsTable.item(selectedRow, 0).text())
-            ids_str = ",".join(ids)
-            exp = '"{}" IN ({})'.format(id_field_name, ids_str)
-            density_layer.setSubsetString(exp)
+            # Selecting by feature id does not make the provider requery the layer
+            density_layer.selectByIds(self.results_model.rowFids(selected_rows))
         
         if auto_zoom:
             density_crs = density_layer.crs()
@@ -135,46 +410,41 @@ class HeatmapAnalysis(QDockWidget, FORM_CLASS):
             # center = xform.transform(density_layer.extent()).center()
             # rect = QgsRectangle(center.x(), center.y(), center.x(), center.y())
             if auto_zoom == 1:  # Auto pan to center of selected features
-                rect = xform.transform(density_layer.extent())
+                rect = xform.transform(self.results_model.extent(selected_rows))
                 center = rect.center()
                 rect = QgsRectangle(center.x(), center.y(), center.x(), center.y())
                 self.canvas.setExtent(rect)
             elif auto_zoom == 2:  # Pan and flash point
-                pt = self.resultsTable.item(selectedItems[0].row(), 0).data(Qt.UserRole)
+                pt = self.centroid(selected_rows[0])
                 pt = xform.transform(pt.x(), pt.y())
                 rect = QgsRectangle(pt.x(), pt.y(), pt.x(), pt.y())
                 self.canvas.setExtent(rect)
                 self.highlight(pt)
                 self.canvas.refresh()
             else:  # Zoom to selected features
-                rect = xform.transform(density_layer.extent())
+                rect = xform.transform(self.results_model.extent(selected_rows))
                 self.canvas.setExtent(rect)
                 
 
     def on_applyButton_pressed(self):
-        self.resultsTable.setRowCount(0)
+        self.clearResults()
         density_layer = self.densityHeatmapComboBox.currentLayer()
         score_field = self.countComboBox.currentField()
         id_field = self.idComboBox.currentField()
         if not id_field or not score_field:
             return
 
-        request=QgsFeatureRequest().addOrderBy(score_field, ascending=False)
-        iter = density_layer.getFeatures(request)
-        for i, f in enumerate(iter):
-            score = f[score_field]
-            id = f[id_field]
-            self.resultsTable.insertRow(i)
-            item = QTableWidgetItem('{}'.format(id))
-            item.setData(Qt.UserRole, f.geometry().centroid().asPoint())
-            self.resultsTable.setItem(i, 0, item)
-            try:
-                item = QTableWidgetItem('{}'.format(score))
-            except:
-                item = QTableWidgetItem('')
-            self.resultsTable.setItem(i, 1, item)
-            if i >= MAX_LIST_SIZE - 1:
-                break
+        density_layer.removeSelection()
+        # Geometry is not needed to rank the cells. Only the bounding boxes of the listed
+        # cells are read and centroids are calculated when rows are selected. Clustering
+        # reads the geometry of the cells above the minimum score to find their neighbors.
+        cluster = self.clusterCheckBox.isChecked()
+        self.results_model.clear(cluster)
+        self.task = DensityRankingTask(
+            density_layer, id_field, score_field, MAX_LIST_SIZE,
+            cluster, self.minScoreSpinBox.value())
+        self.task.resultsReady.connect(self.appendResults)
+        QgsApplication.taskManager().addTask(self.task)
 
     def on_clearButton_pressed(self):
         """"
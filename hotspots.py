@@ -0,0 +1,407 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import math
+import heapq
+from array import array
+import numpy as np
+from . import geohash
+
+CELL_GRID = 0
+CELL_GEOHASH = 1
+CELL_H3 = 2
+
+def cellType(fields):
+    '''Determines from its attributes whether a density layer is made of geohash, H3 or grid cells.'''
+    if fields.indexOf('GEOHASH') != -1:
+        return CELL_GEOHASH
+    if fields.indexOf('H3HASH') != -1:
+        return CELL_H3
+    return CELL_GRID
+
+def geohashNeighborInts(values, precision):
+    '''
+    Returns an (n, 8) numpy array with the geohash.to_int values of the cells surrounding
+    each of the geohash.to_int values of the given precision. The geohash bits alternate
+    between longitude and latitude, so they are split into a column and a row that are
+    offset and interleaved again. Longitude wraps around the antimeridian and neighbors
+    past the poles are -1.
+    '''
+    num_bits = 5 * precision
+    lon_bits = (num_bits + 1) // 2
+    lat_bits = num_bits // 2
+    col = np.zeros(len(values), dtype=np.int64)
+    row = np.zeros(len(values), dtype=np.int64)
+    for k in range(num_bits):
+        bit = (values >> (num_bits - 1 - k)) & 1
+        if k % 2 == 0:
+            col = (col << 1) | bit
+        else:
+            row = (row << 1) | bit
+    result = []
+    for dr in (1, -1, 0):
+        for dc in (0, 1, -1):
+            if dr == 0 and dc == 0:
+                continue
+            c = (col + dc) % (1 << lon_bits)
+            r = row + dr
+            value = np.ones(len(values), dtype=np.int64)
+            lon_shift = lon_bits
+            lat_shift = lat_bits
+            for k in range(num_bits):
+                if k % 2 == 0:
+                    lon_shift -= 1
+                    bit = (c >> lon_shift) & 1
+                else:
+                    lat_shift -= 1
+                    bit = (r >> lat_shift) & 1
+                value = (value << 1) | bit
+            value[(r < 0) | (r >= (1 << lat_bits))] = -1
+            result.append(value)
+    return np.stack(result, axis=1)
+
+class DensityCells():
+    '''
+    The cells of a density layer that are kept in flat arrays together with the
+    information needed to find the neighbors of each cell. Geohash and H3 cells
+    are related through their hash, and grid cells through their geometry.
+    '''
+    def __init__(self, cell_type):
+        self.cell_type = cell_type
+        self.fids = array('q')
+        self.ids = []
+        self.scores = array('d')
+        self.extents = array('d')
+        self.hashes = []
+        self.rings = []
+
+    def __len__(self):
+        return len(self.fids)
+
+    def edges(self, feedback=None):
+        '''
+        Returns two numpy arrays with the indexes of every pair of neighboring cells.
+        Each pair is listed once in each direction.
+        '''
+        if self.cell_type in (CELL_GEOHASH, CELL_H3):
+            src, dst, _, _ = self.hashNeighbors(feedback)
+        elif self.isRectangleGrid():
+            src, dst = self.rectangleEdges()
+        else:
+            src, dst = self.vertexEdges()
+        return src, dst
+
+    def hashNeighbors(self, feedback=None):
+        '''
+        Finds the surrounding cells of the geohash and H3 cells as integers and looks them up
+        in the sorted hashes of the layer. Returns the indexes of the neighboring pairs of
+        cells followed by the index of each cell that has an empty neighbor and the hash of
+        that neighbor. Geohash neighbors are calculated with numpy and H3 neighbors with one
+        k_ring call per cell.
+        '''
+        n = len(self.hashes)
+        if self.cell_type == CELL_GEOHASH:
+            keys = np.fromiter((geohash.to_int(h) for h in self.hashes), dtype=np.int64, count=n)
+            lengths = np.fromiter((len(h) for h in self.hashes), dtype=np.int64, count=n)
+            src = []
+            targets = []
+            for precision in np.unique(lengths).tolist():
+                cells = np.flatnonzero(lengths == precision)
+                nb = geohashNeighborInts(keys[cells], precision)
+                src.append(np.repeat(cells, nb.shape[1]))
+                targets.append(nb.ravel())
+            src = np.concatenate(src) if src else np.zeros(0, dtype=np.int64)
+            targets = np.concatenate(targets) if targets else np.zeros(0, dtype=np.int64)
+            valid = targets >= 0
+            src = src[valid]
+            targets = targets[valid]
+        else:
+            import h3.api.basic_int as h3
+            keys = np.array(self.hashes, dtype=np.int64)
+            src = array('q')
+            targets = array('q')
+            for i, h in enumerate(self.hashes):
+                if feedback and i % 10000 == 0 and feedback.isCanceled():
+                    break
+                ring = [nb for nb in h3.k_ring(h, 1) if nb != h]
+                src.extend([i] * len(ring))
+                targets.extend(ring)
+            src = np.frombuffer(src, dtype=np.int64)
+            targets = np.frombuffer(targets, dtype=np.int64)
+        if n == 0 or len(src) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, src, targets
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        pos = np.minimum(np.searchsorted(sorted_keys, targets), n - 1)
+        found = sorted_keys[pos] == targets
+        return src[found], order[pos[found]], src[~found], targets[~found]
+
+    def isRectangleGrid(self):
+        '''Grid cells without vertex rings are axis aligned rectangles.'''
+        return len(self.rings) == 0
+
+    def emptyNeighbors(self, feedback=None):
+        '''
+        Returns a numpy array with the number of neighbors of each cell that are not in the
+        layer, and the number of distinct empty cells that are part of the study area. For
+        geohash and H3 cells these are the empty neighbors of the cells. For rectangular grids
+        they are all of the empty cells within the rows and columns that the grid spans. The
+        cells of diamond and hexagon grids are used as given so their empty cells need to be
+        kept in the layer.
+        '''
+        n = len(self.fids)
+        counts = np.zeros(n, dtype=np.int64)
+        if n == 0:
+            return counts, 0
+        if self.cell_type in (CELL_GEOHASH, CELL_H3):
+            _, _, src, targets = self.hashNeighbors(feedback)
+            return np.bincount(src, minlength=n), len(np.unique(targets))
+        if not self.isRectangleGrid():
+            return counts, 0
+        rows, cols = self.gridPositions()
+        num_rows = rows.max() + 1
+        num_cols = cols.max() + 1
+        src, _ = self.rectangleEdges()
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                if dr or dc:
+                    r = rows + dr
+                    c = cols + dc
+                    counts += (r >= 0) & (r < num_rows) & (c >= 0) & (c < num_cols)
+        counts -= np.bincount(src, minlength=n)
+        return counts, int(num_rows * num_cols - n)
+
+    def gridPositions(self):
+        '''Returns the row and column of each rectangular grid cell from its bounding box and the cell size.'''
+        n = len(self.fids)
+        ext = np.frombuffer(self.extents, dtype=np.float64).reshape(n, 4)
+        width = np.median(ext[:, 2] - ext[:, 0])
+        height = np.median(ext[:, 3] - ext[:, 1])
+        cols = np.rint((ext[:, 0] - ext[:, 0].min()) / width).astype(np.int64)
+        rows = np.rint((ext[:, 3].max() - ext[:, 3]) / height).astype(np.int64)
+        return rows, cols
+
+    def rectangleEdges(self):
+        '''
+        Uses the 8-neighborhood of each cell. The neighbors are looked up in the sorted
+        linear indexes of the cells so memory only grows with the number of cells.
+        '''
+        n = len(self.fids)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        rows, cols = self.gridPositions()
+        # A border column on each side keeps the neighbors of edge cells from wrapping to another row
+        num_cols = cols.max() + 3
+        index = (rows + 1) * num_cols + cols + 1
+        order = np.argsort(index, kind='stable')
+        sorted_index = index[order]
+        src = []
+        dst = []
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                if dr == 0 and dc == 0:
+                    continue
+                target = index + dr * num_cols + dc
+                pos = np.minimum(np.searchsorted(sorted_index, target), n - 1)
+                valid = sorted_index[pos] == target
+                src.append(np.nonzero(valid)[0])
+                dst.append(order[pos[valid]])
+        return np.concatenate(src), np.concatenate(dst)
+
+    def vertexEdges(self):
+        '''
+        Diamond and hexagon grid cells are neighbors when they share a vertex. The vertices
+        are snapped to a small fraction of the cell size so that rounding errors do not matter.
+        '''
+        n = len(self.fids)
+        ext = np.frombuffer(self.extents, dtype=np.float64).reshape(n, 4)
+        tolerance = max(np.median(ext[:, 2] - ext[:, 0]), np.median(ext[:, 3] - ext[:, 1])) * 1e-6
+        vertices = {}
+        for i, ring in enumerate(self.rings):
+            for x, y in ring:
+                key = (round(x / tolerance), round(y / tolerance))
+                if key in vertices:
+                    vertices[key].append(i)
+                else:
+                    vertices[key] = [i]
+        pairs = set()
+        for cells in vertices.values():
+            for i in cells:
+                for j in cells:
+                    if i != j:
+                        pairs.add((i, j))
+        src = np.fromiter((p[0] for p in pairs), dtype=np.int64, count=len(pairs))
+        dst = np.fromiter((p[1] for p in pairs), dtype=np.int64, count=len(pairs))
+        return src, dst
+
+def topFeatures(features, id_field, score_field, k, task=None, num_features=0):
+    '''
+    Streams the features through a bounded heap rather than sorting them all and returns
+    the feature ids, ids and scores of the k highest scoring ones in decreasing order of
+    score. Features whose score is not a number are skipped.
+    '''
+    fids = array('q')
+    ids = []
+    scores = []
+    heap = []
+    for cnt, f in enumerate(features):
+        if task:
+            if task.isCanceled():
+                return fids, ids, scores
+            if num_features and cnt % 10000 == 0:
+                task.setProgress(cnt * 50 / num_features)
+        score = f[score_field]
+        try:
+            score = float(score)
+        except Exception:
+            continue
+        if len(heap) < k:
+            heapq.heappush(heap, (score, f.id(), f[id_field]))
+        elif score > heap[0][0]:
+            heapq.heappushpop(heap, (score, f.id(), f[id_field]))
+    for score, fid, id in sorted(heap, reverse=True):
+        fids.append(fid)
+        ids.append(id)
+        scores.append(score)
+    return fids, ids, scores
+
+def readCells(source, fields, id_field, score_field, min_score=None, feedback=None, features=None):
+    '''
+    Reads the cells of a density layer whose score is greater than min_score. Only
+    the id, score and hash attributes are requested and id_field may be None. The geometry is kept as a bounding
+    box except for non-rectangular grid cells whose vertices are needed for adjacency. If features is a list,
+    all of the attributes are requested and every feature that is read is appended to it so that the layer
+    does not need to be read again.
+    '''
+    cell_type = cellType(fields)
+    cells = DensityCells(cell_type)
+    attributes = [score_field]
+    if id_field:
+        attributes.append(id_field)
+    if cell_type == CELL_GEOHASH:
+        hash_field = 'GEOHASH'
+    elif cell_type == CELL_H3:
+        import h3.api.basic_int as h3
+        hash_field = 'H3HASH'
+    else:
+        hash_field = None
+    if hash_field:
+        attributes.append(hash_field)
+    # QGIS is only needed to read a layer, so the cell adjacency can be used without it
+    from qgis.core import QgsFeatureRequest
+    request = QgsFeatureRequest()
+    if features is None:
+        request.setSubsetOfAttributes(attributes, fields)
+    rectangles = True
+    for cnt, f in enumerate(source.getFeatures(request)):
+        if feedback and cnt % 10000 == 0 and feedback.isCanceled():
+            break
+        if features is not None:
+            features.append(f)
+        try:
+            score = float(f[score_field])
+        except Exception:
+            continue
+        if score != score or (min_score is not None and score <= min_score):
+            continue
+        geom = f.geometry()
+        if geom.isNull():
+            continue
+        bbox = geom.boundingBox()
+        if cell_type == CELL_GEOHASH:
+            cells.hashes.append(f[hash_field])
+        elif cell_type == CELL_H3:
+            cells.hashes.append(h3.string_to_h3(f[hash_field]))
+        else:
+            ring = [(v.x(), v.y()) for v in geom.vertices()]
+            if rectangles and abs(geom.area() - bbox.area()) > bbox.area() * 1e-6:
+                rectangles = False
+            cells.rings.append(ring)
+        cells.fids.append(f.id())
+        if id_field:
+            cells.ids.append(f[id_field])
+        cells.scores.append(score)
+        cells.extents.extend([bbox.xMinimum(), bbox.yMinimum(), bbox.xMaximum(), bbox.yMaximum()])
+    if cell_type == CELL_GRID and rectangles:
+        cells.rings = []
+    return cells
+
+def connectedComponents(n, src, dst):
+    '''
+    Labels the connected components of a graph with n nodes whose edges are listed in
+    both directions by src and dst. Each label is the smallest node of its component.
+    The labels are propagated with numpy by hooking the label of each node to the
+    smallest label of its neighbors and then following the labels to their roots, so
+    the number of passes grows with the logarithm of the component size.
+    '''
+    labels = np.arange(n, dtype=np.int64)
+    while True:
+        lower = np.minimum(labels[src], labels[dst])
+        new = labels.copy()
+        np.minimum.at(new, labels[src], lower)
+        while True:
+            jumped = new[new]
+            if np.array_equal(jumped, new):
+                break
+            new = jumped
+        if np.array_equal(new, labels):
+            return labels
+        labels = new
+
+def clusterCells(cells, feedback=None):
+    '''
+    Merges neighboring cells into clusters of connected components of the cell adjacency.
+    Returns a list of numpy arrays of cell indexes, one per cluster, ordered by
+    decreasing summed score. Within a cluster the cells are ordered by decreasing score.
+    '''
+    n = len(cells)
+    if n == 0:
+        return []
+    src, dst = cells.edges(feedback)
+    roots = connectedComponents(n, src, dst)
+    scores = np.frombuffer(cells.scores, dtype=np.float64)
+    totals = np.bincount(roots, weights=scores, minlength=n)
+    # Sort by cluster and then by decreasing score within the cluster
+    order = np.lexsort((-scores, roots))
+    sorted_roots = roots[order]
+    starts = np.flatnonzero(np.r_[True, sorted_roots[1:] != sorted_roots[:-1]])
+    members = np.split(order, starts[1:])
+    cluster_totals = totals[sorted_roots[starts]]
+    return [members[i] for i in np.argsort(-cluster_totals, kind='stable')]
+
+def giStar(scores, src, dst, empty_neighbors=None, num_empty=0):
+    '''
+    Getis-Ord Gi* statistic with binary weights where each cell is its own neighbor.
+    The neighbor sums are calculated with a weighted bincount over the neighbor pairs.
+    empty_neighbors and num_empty are the zero valued cells from DensityCells.emptyNeighbors
+    that are part of the study area but not of scores.
+    Returns numpy arrays of the z-scores and the two tailed p-values; both are NaN where
+    the statistic is undefined.
+    '''
+    x = np.asarray(scores, dtype=np.float64)
+    n = len(x)
+    z = np.full(n, np.nan)
+    p = np.full(n, np.nan)
+    # The empty cells have a score of 0 so they only add to the neighbor counts and to n
+    total = n + num_empty
+    if total < 2:
+        return z, p
+    local_sum = x + np.bincount(src, weights=x[dst], minlength=n)
+    num_neighbors = 1.0 + np.bincount(src, minlength=n)
+    if empty_neighbors is not None:
+        num_neighbors += empty_neighbors
+    mean = x.sum() / total
+    std = math.sqrt(max((x * x).sum() / total - mean * mean, 0.0))
+    denom = std * np.sqrt((total * num_neighbors - num_neighbors * num_neighbors) / (total - 1))
+    valid = denom > 0
+    z[valid] = (local_sum[valid] - mean * num_neighbors[valid]) / denom[valid]
+    p[valid] = [math.erfc(abs(v) / math.sqrt(2.0)) for v in z[valid].tolist()]
+    return z, p
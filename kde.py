@@ -0,0 +1,137 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+from array import array
+import numpy as np
+from osgeo import gdal
+from qgis.core import QgsFeatureRequest, QgsFeatureSource, QgsRasterFileWriter, QgsRectangle
+from .kdekernels import kernelWindow, convolve, binPoints
+
+NODATA = -9999
+# Output block size used by the tiled kernel density estimation
+KDE_TILE_SIZE = 2048
+TILED_GTIFF_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COMPRESS=DEFLATE', 'PREDICTOR=3', 'BIGTIFF=IF_SAFER']
+
+def readPoints(layer, request=None, feedback=None):
+    '''Returns the x and y coordinates of all the points in the layer as numpy arrays.'''
+    if request is None:
+        request = QgsFeatureRequest()
+    request.setSubsetOfAttributes([])
+    xs = array('d')
+    ys = array('d')
+    for feature in layer.getFeatures(request):
+        if feedback and feedback.isCanceled():
+            break
+        geom = feature.geometry()
+        if geom.isNull():
+            continue
+        if geom.isMultipart():
+            pts = geom.asMultiPoint()
+        else:
+            pts = [geom.asPoint()]
+        for pt in pts:
+            xs.append(pt.x())
+            ys.append(pt.y())
+    return np.frombuffer(xs, dtype=np.float64), np.frombuffer(ys, dtype=np.float64)
+
+def gdalDriverName(path):
+    ext = os.path.splitext(path)[1].lower().lstrip('.')
+    driver = QgsRasterFileWriter.driverForExtension(ext)
+    return driver if driver else 'GTiff'
+
+def createRaster(path, crs, x_min, y_max, pixel_size, rows, cols, options=None):
+    '''Creates a single band Float32 raster for the heatmap.'''
+    driver = gdal.GetDriverByName(gdalDriverName(path))
+    ds = driver.Create(path, cols, rows, 1, gdal.GDT_Float32, options or [])
+    ds.SetGeoTransform((x_min, pixel_size, 0, y_max, 0, -pixel_size))
+    ds.SetProjection(crs.toWkt())
+    ds.GetRasterBand(1).SetNoDataValue(NODATA)
+    return ds
+
+def kernelDensity(layer, path, x_min, y_max, pixel_size, rows, cols, radius, shape, decay, scaled, feedback):
+    '''
+    Kernel density estimation that bins the points onto the output grid and then convolves
+    the grid once with the kernel. The cost depends on the number of pixels and not on the
+    number of points times the kernel area. Points are located at the center of their pixel.
+    '''
+    feedback.pushInfo('Reading points')
+    xs, ys = readPoints(layer, feedback=feedback)
+    if feedback.isCanceled():
+        return
+    grid = binPoints(xs, ys, x_min, y_max, pixel_size, rows, cols)
+    del xs, ys
+    kernel = kernelWindow(shape, radius, pixel_size, decay, scaled)
+    feedback.pushInfo('Convolving {} x {} grid with a {} x {} kernel'.format(cols, rows, kernel.shape[1], kernel.shape[0]))
+    out = convolve(grid, kernel, feedback)
+    if feedback.isCanceled():
+        return
+    ds = createRaster(path, layer.sourceCrs(), x_min, y_max, pixel_size, rows, cols)
+    ds.GetRasterBand(1).WriteArray(out)
+    ds.FlushCache()
+    ds = None
+
+def tiledKernelDensity(layer, path, x_min, y_max, pixel_size, rows, cols, radius, shape, decay, scaled, feedback):
+    '''
+    Kernel density estimation of arbitrarily large images. The output is processed in blocks
+    that are padded with a halo equal to the kernel radius. Each block only reads the points
+    within its padded extent using the layer's spatial index. A GeoTIFF output is tiled and
+    compressed and its overviews are built once all the blocks have been written. Other
+    formats are written with the default options of their driver.
+    '''
+    if layer.hasSpatialIndex() == QgsFeatureSource.SpatialIndexNotPresent:
+        feedback.pushInfo('The input layer does not have a spatial index. Creating one will make the tiled heatmap much faster.')
+    kernel = kernelWindow(shape, radius, pixel_size, decay, scaled)
+    halo = kernel.shape[0] // 2
+    tile = KDE_TILE_SIZE
+    # The creation options and AVERAGE overviews only apply to GeoTIFF
+    gtiff = gdalDriverName(path) == 'GTiff'
+    ds = createRaster(path, layer.sourceCrs(), x_min, y_max, pixel_size, rows, cols, TILED_GTIFF_OPTIONS if gtiff else None)
+    band = ds.GetRasterBand(1)
+    row_blocks = range(0, rows, tile)
+    col_blocks = range(0, cols, tile)
+    num_blocks = len(row_blocks) * len(col_blocks)
+    feedback.pushInfo('Processing {} blocks with a {} pixel halo'.format(num_blocks, halo))
+    cnt = 0
+    for r0 in row_blocks:
+        for c0 in col_blocks:
+            if feedback.isCanceled():
+                ds = None
+                return
+            th = min(tile, rows - r0)
+            tw = min(tile, cols - c0)
+            # Padded block extent in map coordinates
+            bx_min = x_min + (c0 - halo) * pixel_size
+            by_max = y_max - (r0 - halo) * pixel_size
+            prows = th + 2 * halo
+            pcols = tw + 2 * halo
+            rect = QgsRectangle(bx_min, by_max - prows * pixel_size, bx_min + pcols * pixel_size, by_max)
+            request = QgsFeatureRequest().setFilterRect(rect)
+            xs, ys = readPoints(layer, request)
+            if len(xs):
+                grid = binPoints(xs, ys, bx_min, by_max, pixel_size, prows, pcols)
+                out = convolve(grid, kernel)[halo:halo + th, halo:halo + tw]
+            else:
+                out = np.zeros((th, tw), dtype=np.float32)
+            band.WriteArray(out, c0, r0)
+            cnt += 1
+            feedback.setProgress(int(cnt * 90 / num_blocks))
+    if gtiff:
+        feedback.pushInfo('Building overviews')
+        levels = []
+        factor = 2
+        while max(rows, cols) / factor >= 256:
+            levels.append(factor)
+            factor *= 2
+        if levels:
+            ds.BuildOverviews('AVERAGE', levels)
+    ds.FlushCache()
+    ds = None
+    feedback.setProgress(100)
@@ -0,0 +1,108 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import math
+import numpy as np
+
+# Kernels with more non-zero cells than this are convolved with an FFT
+DIRECT_KERNEL_LIMIT = 81
+FFT_TILE_SIZE = 1024
+
+def kernelWindow(shape, radius, pixel_size, decay=0, scaled=False):
+    '''
+    Returns a square array of kernel values sampled at the pixel centers around a point.
+    The kernel formulas and scaling constants match those of the QGIS heatmap algorithm.
+    '''
+    r_px = int(math.ceil(radius / pixel_size))
+    offsets = np.arange(-r_px, r_px + 1) * pixel_size
+    dist = np.hypot(offsets[np.newaxis, :], offsets[:, np.newaxis])
+    u = dist / radius
+    if shape == 0: # Quartic
+        k = (1.0 - u**2)**2
+        if scaled:
+            k *= 116.0 / (5.0 * math.pi * radius**2) * (15.0 / 16.0)
+    elif shape == 1: # Triangular
+        k = 1.0 - (1.0 - decay) * u
+        if scaled and decay >= 0:
+            k *= 3.0 / ((1.0 + 2.0 * decay) * math.pi * radius**2)
+    elif shape == 2: # Uniform
+        k = np.ones_like(u)
+        if scaled:
+            k *= 2.0 / (math.pi * radius) * (0.5 / radius)
+    elif shape == 3: # Triweight
+        k = (1.0 - u**2)**3
+        if scaled:
+            k *= 128.0 / (35.0 * math.pi * radius**2) * (35.0 / 32.0)
+    else: # Epanechnikov
+        k = 1.0 - u**2
+        if scaled:
+            k *= 8.0 / (3.0 * math.pi * radius**2) * (3.0 / 4.0)
+    k[dist > radius] = 0
+    return k
+
+def directConvolve(grid, kernel):
+    '''Convolves by adding a shifted copy of the grid for every non-zero kernel cell.'''
+    kr = kernel.shape[0] // 2
+    rows, cols = grid.shape
+    out = np.zeros(grid.shape, dtype=np.float32)
+    for ky, kx in zip(*np.nonzero(kernel)):
+        oy = ky - kr
+        ox = kx - kr
+        if abs(oy) >= rows or abs(ox) >= cols:
+            continue
+        out[max(0, oy):rows + min(0, oy), max(0, ox):cols + min(0, ox)] += kernel[ky, kx] * grid[
+            max(0, -oy):rows - max(0, oy), max(0, -ox):cols - max(0, ox)]
+    return out
+
+def fftConvolve(grid, kernel, feedback=None):
+    '''
+    Convolves using overlap-add FFT blocks so that memory is bounded by the block
+    size. Empty blocks are skipped, which is common for clustered point data.
+    '''
+    kr = kernel.shape[0] // 2
+    rows, cols = grid.shape
+    tile = FFT_TILE_SIZE
+    fshape = (tile + 2 * kr, tile + 2 * kr)
+    kernel_fft = np.fft.rfft2(kernel, fshape)
+    out = np.zeros((rows + 2 * kr, cols + 2 * kr), dtype=np.float32)
+    row_blocks = range(0, rows, tile)
+    col_blocks = range(0, cols, tile)
+    num_blocks = len(row_blocks) * len(col_blocks)
+    cnt = 0
+    for r0 in row_blocks:
+        for c0 in col_blocks:
+            cnt += 1
+            if feedback:
+                if feedback.isCanceled():
+                    return out[kr:kr + rows, kr:kr + cols]
+                feedback.setProgress(int(cnt * 100 / num_blocks))
+            block = grid[r0:r0 + tile, c0:c0 + tile]
+            if not block.any():
+                continue
+            br, bc = block.shape
+            res = np.fft.irfft2(np.fft.rfft2(block, fshape) * kernel_fft, fshape)
+            out[r0:r0 + br + 2 * kr, c0:c0 + bc + 2 * kr] += res[:br + 2 * kr, :bc + 2 * kr]
+    return out[kr:kr + rows, kr:kr + cols]
+
+def convolve(grid, kernel, feedback=None):
+    '''Picks the cheaper of the direct or FFT convolution for the kernel size.'''
+    if np.count_nonzero(kernel) <= DIRECT_KERNEL_LIMIT:
+        return directConvolve(grid, kernel)
+    return fftConvolve(grid, kernel, feedback)
+
+def binPoints(xs, ys, x_min, y_max, pixel_size, rows, cols):
+    '''Counts the points falling in each pixel of a north up grid.'''
+    grid = np.zeros((rows, cols), dtype=np.float32)
+    c = np.floor((xs - x_min) / pixel_size).astype(np.int64)
+    r = np.floor((y_max - ys) / pixel_size).astype(np.int64)
+    valid = (c >= 0) & (c < cols) & (r >= 0) & (r < rows)
+    index, counts = np.unique(r[valid] * cols + c[valid], return_counts=True)
+    grid.flat[index] += counts
+    return grid
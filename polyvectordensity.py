@@ -11,6 +11,7 @@
 import os
 from qgis.PyQt.QtCore import QUrl
 from qgis.PyQt.QtGui import QIcon
+from qgis.core import QgsProcessingUtils
 
 from qgis.core import (
     QgsProcessing,
@@ -22,6 +23,7 @@ from qgis.core import (
     QgsProcessingParameterFeatureSink
     )
 import processing
+from .densityengine import MEMORY_OUTPUT, copyToSink
 
 class PolygonVectorDensityAlgorithm(QgsProcessingAlgorithm):
 
@@ -62,7 +64,7 @@ class PolygonVectorDensityAlgorithm(QgsProcessingAlgorithm):
 
         # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
         # overall progress through the model
-        feedback = QgsProcessingMultiStepFeedback(4, model_feedback)
+        feedback = QgsProcessingMultiStepFeedback(3, model_feedback)
         results = {}
         outputs = {}
         
@@ -72,7 +74,7 @@ class PolygonVectorDensityAlgorithm(QgsProcessingAlgorithm):
             'OVERLAY':None,
             'OVERLAY_FIELDS_PREFIX':'',
             'GRID_SIZE':None,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            'OUTPUT': MEMORY_OUTPUT
         }
         outputs['Union'] = processing.run('native:union', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
 
@@ -85,37 +87,28 @@ class PolygonVectorDensityAlgorithm(QgsProcessingAlgorithm):
             unique_param = [{'aggregate': 'count','delimiter': ',','input': '1','length': 0,'name': 'NUMPOINTS','precision': 0,'sub_type': 0,'type': 4,'type_name': 'int8'},{'aggregate': 'concatenate','delimiter': ',','input': 'to_string("'+unique_id_field+'")','length': 0,'name': 'ID_LIST','precision': 0,'sub_type': 0,'type': 10,'type_name': 'text'}]
         else:
             unique_param = [{'aggregate': 'count','delimiter': ',','input': '1','length': 0,'name': 'NUMPOINTS','precision': 0,'sub_type': 0,'type': 4,'type_name': 'int8'}]
-        # Check to see if the polygons are going to be filtered out. If not (filter == 1) we will skip
-        # the last algorithm.
-        if filter == 1:
-            alg_output = parameters['OUTPUT']
-        else:
-            alg_output = QgsProcessing.TEMPORARY_OUTPUT
         alg_params = {
             'INPUT': outputs['Union']['OUTPUT'],
             'GROUP_BY':'$geometry',
             'AGGREGATES': unique_param,
-            'OUTPUT': alg_output
+            'OUTPUT': MEMORY_OUTPUT
         }
         outputs['Aggregate'] = processing.run('native:aggregate', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
 
         feedback.setCurrentStep(2)
         if feedback.isCanceled():
             return {}
+        # Write the polygons to the output in one pass. If filter == 1 all the split
+        # polygons are kept.
+        overlaps = QgsProcessingUtils.mapLayerFromString(outputs['Aggregate']['OUTPUT'], context)
+        (sink, dest_id) = self.parameterAsSink(
+            parameters, 'OUTPUT', context, overlaps.fields(), overlaps.wkbType(), overlaps.crs())
         if filter == 1:
-            # All the split polygons will be returned so we can skip the last algorithm
-            results['OUTPUT'] = outputs['Aggregate']['OUTPUT']
+            expression = None
         else:
-            # Extract by attribute
-            alg_params = {
-                'FIELD': 'NUMPOINTS',
-                'INPUT': outputs['Aggregate']['OUTPUT'],
-                'OPERATOR': 3,  # ≥
-                'VALUE': filter,
-                'OUTPUT': parameters['OUTPUT']
-            }
-            outputs['ExtractByAttribute'] = processing.run('native:extractbyattribute', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-            results['OUTPUT'] = outputs['ExtractByAttribute']['OUTPUT']
+            expression = '"NUMPOINTS" >= {}'.format(filter)
+        copyToSink(overlaps, sink, feedback, expression)
+        results['OUTPUT'] = dest_id
         return results
 
     def group(self):
@@ -29,6 +29,7 @@ from .rasterstyle import RasterStyleAlgorithm
 from .styledkde import StyledKdeAlgorithm
 from .polyvectordensity import PolygonVectorDensityAlgorithm
 from .styledpolyvectordensity import StyledPolygonVectorDensityAlgorithm
+from .gistar import GetisOrdGiStarAlgorithm
 
 class DensityAnalysisProvider(QgsProcessingProvider):
 
@@ -54,6 +55,7 @@ class DensityAnalysisProvider(QgsProcessingProvider):
         self.addAlgorithm(StyledPolygonRasterDensityAlgorithm())
         self.addAlgorithm(StyledPolygonVectorDensityAlgorithm())
         self.addAlgorithm(StyledKdeAlgorithm())
+        self.addAlgorithm(GetisOrdGiStarAlgorithm())
 
     def icon(self):
         return QIcon(os.path.dirname(__file__) + '/icons/densitygrid.svg')
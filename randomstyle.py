@@ -11,15 +11,46 @@
 import os
 from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtCore import Qt, QUrl
-from qgis.core import QgsCategorizedSymbolRenderer, QgsSymbol, QgsRendererCategory, QgsRandomColorRamp
+from qgis.core import Qgis, QgsCategorizedSymbolRenderer, QgsSymbol, QgsRendererCategory, QgsRandomColorRamp, QgsLimitedRandomColorRamp
 from qgis.core import (
     QgsProcessing,
     QgsProcessingAlgorithm,
     QgsProcessingParameterBoolean,
+    QgsProcessingParameterDefinition,
+    QgsProcessingParameterNumber,
     QgsProcessingParameterVectorLayer,
     QgsProcessingParameterField)
 import processing
 
+# Number of distinct symbols that the categories share
+PALETTE_SIZE = 256
+# Number of values of the leading three hexadecimal digits of an md5 hash
+MAX_HASH_BUCKETS = 4096
+
+def symbolPalette(geomtype, size, no_outline):
+    '''Creates a palette of symbols with random colors that is shared by the categories.'''
+    base = QgsSymbol.defaultSymbol(geomtype)
+    if no_outline:
+        base.symbolLayer(0).setStrokeStyle(Qt.PenStyle(Qt.NoPen))
+    palette = []
+    for color in QgsLimitedRandomColorRamp.randomColors(size):
+        symbol = base.clone()
+        symbol.setColor(color)
+        palette.append(symbol)
+    return palette
+
+def hashBucketExpression(attr, max_categories):
+    '''
+    Returns the expression that maps values to integer buckets from the leading three
+    hexadecimal digits of their md5 hash modulo the number of buckets, along with the
+    number of buckets, which is max_categories up to 4096.
+    '''
+    num_buckets = min(max_categories, MAX_HASH_BUCKETS)
+    digit = '(strpos(\'0123456789abcdef\', substr(@hash, {}, 1)) - 1)'
+    exp = 'with_variable(\'hash\', md5(coalesce(to_string("{}"), \'\')), ({} * 256 + {} * 16 + {}) % {})'.format(
+        attr.replace('"', '""'), digit.format(1), digit.format(2), digit.format(3), num_buckets)
+    return exp, num_buckets
+
 
 class RandomStyleAlgorithm(QgsProcessingAlgorithm):
     def initAlgorithm(self, config=None):
@@ -42,26 +73,44 @@ class RandomStyleAlgorithm(QgsProcessingAlgorithm):
                 True,
                 optional=False)
         )
+        param = QgsProcessingParameterNumber('MAX_CATEGORIES', 'Maximum number of categories (0 for no limit)',
+            type=QgsProcessingParameterNumber.Integer, minValue=0, defaultValue=0, optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
 
     def processAlgorithm(self, parameters, context, feedback):
         layer = self.parameterAsVectorLayer(parameters, 'INPUT', context)
         attr = self.parameterAsString(parameters, 'GROUP_FIELD', context)
         no_outline = self.parameterAsBool(parameters, 'NO_OUTLINE', context)
-        renderer = layer.renderer()
+        max_categories = self.parameterAsInt(parameters, 'MAX_CATEGORIES', context)
         geomtype = layer.geometryType()
         idx = layer.fields().indexOf(attr)
-        values = layer.uniqueValues(idx)
+        # The unique values are read with a single DISTINCT query by providers that support it.
+        # With a limit the scan stops as soon as there are more values than categories.
+        if max_categories > 0:
+            values = layer.uniqueValues(idx, max_categories + 1)
+        else:
+            values = layer.uniqueValues(idx)
         categories = []
-        for value in values:
-            symbol = QgsSymbol.defaultSymbol(geomtype)
-            if no_outline:
-                symbol.symbolLayer(0).setStrokeStyle(Qt.PenStyle(Qt.NoPen))
-            category = QgsRendererCategory(value, symbol, str(value))
-            categories.append(category)
-
-        new_renderer = QgsCategorizedSymbolRenderer (attr, categories)
-        ramp = QgsRandomColorRamp()
-        new_renderer.updateColorRamp(ramp)
+        if max_categories > 0 and len(values) > max_categories and Qgis.QGIS_VERSION_INT >= 31200:
+            # Too many values so they are grouped into hashed buckets
+            exp, num_buckets = hashBucketExpression(attr, max_categories)
+            feedback.pushInfo('{} has more than {} unique values. They are grouped into {} categories.'.format(attr, max_categories, num_buckets))
+            palette = symbolPalette(geomtype, min(num_buckets, PALETTE_SIZE), no_outline)
+            for i in range(num_buckets):
+                category = QgsRendererCategory(i, palette[i % len(palette)].clone(), str(i))
+                categories.append(category)
+            new_renderer = QgsCategorizedSymbolRenderer(exp, categories)
+        else:
+            if max_categories > 0 and len(values) > max_categories:
+                feedback.reportError('Grouping values requires QGIS 3.12 or later. Only {} values will be styled.'.format(max_categories))
+                values = list(values)[:max_categories]
+            palette = symbolPalette(geomtype, max(1, min(len(values), PALETTE_SIZE)), no_outline)
+            for i, value in enumerate(values):
+                category = QgsRendererCategory(value, palette[i % len(palette)].clone(), str(value))
+                categories.append(category)
+            new_renderer = QgsCategorizedSymbolRenderer(attr, categories)
+        new_renderer.setSourceColorRamp(QgsRandomColorRamp())
         layer.setRenderer(new_renderer)
         layer.triggerRepaint()
         return({})
@@ -11,11 +11,13 @@
 import os
 from qgis.PyQt.QtCore import QUrl
 from qgis.PyQt.QtGui import QIcon
-from qgis.core import Qgis, QgsStyle, QgsMapLayerType, QgsRasterBandStats, QgsColorRampShader, QgsRasterShader, QgsSingleBandPseudoColorRenderer
+from qgis.core import Qgis, QgsStyle, QgsMapLayerType, QgsRaster, QgsRasterBandStats, QgsRectangle, QgsColorRampShader, QgsRasterShader, QgsSingleBandPseudoColorRenderer
 from qgis.core import (
     QgsProcessing,
     QgsProcessingAlgorithm,
+    QgsProcessingException,
     QgsProcessingParameterBoolean,
+    QgsProcessingParameterDefinition,
     QgsProcessingParameterEnum,
     QgsProcessingParameterNumber,
     QgsProcessingParameterString,
@@ -24,6 +26,99 @@ import processing
 from .settings import settings
 
 
+def buildOverviews(provider, feedback):
+    '''Builds external GeoTIFF overviews for a GDAL raster data provider.'''
+    pyramids = provider.buildPyramidList()
+    for pyramid in pyramids:
+        if Qgis.QGIS_VERSION_INT >= 32000:
+            pyramid.setBuild(True)
+        else:
+            pyramid.build = True
+    # Nearest neighbour keeps the sampled values equal to actual pixel values
+    err = provider.buildPyramids(pyramids, 'NEAREST', QgsRaster.PyramidsGTiff)
+    if err:
+        feedback.reportError('Overviews could not be built: {}'.format(err))
+
+def sampledQuantileItems(provider, ramp, num_classes, interpolation, sample_size):
+    '''
+    Returns the quantile color ramp items calculated from a histogram of at most sample_size
+    pixels. This mirrors QgsColorRampShader.classifyColorRamp which always uses a large sample.
+    '''
+    extent = QgsRectangle()
+    values = []
+    if interpolation == QgsColorRampShader.Discrete:
+        interval = 1.0 / num_classes
+        for i in range(1, num_classes):
+            lower, upper = provider.cumulativeCut(1, 0.0, i * interval, extent, sample_size)
+            values.append(upper)
+        values.append(float('inf'))
+    else:
+        interval = 1.0 / (num_classes - 1)
+        for i in range(num_classes):
+            lower, upper = provider.cumulativeCut(1, 0.0, i * interval, extent, sample_size)
+            values.append(upper)
+    items = []
+    num_values = len(values)
+    for i, value in enumerate(values):
+        color = ramp.color(i / (num_values - 1) if num_values > 1 else 0)
+        label = '> {:g}'.format(values[-2]) if value == float('inf') else '{:g}'.format(value)
+        items.append(QgsColorRampShader.ColorRampItem(value, color, label))
+    return items
+
+def applyRasterStyle(layer, ramp_name, invert, interp, mode, num_classes, sample_size=0, build_overviews=False, feedback=None):
+    '''
+    Applies a single band pseudocolor style to a raster layer. This is used by the raster
+    style algorithm and called directly by the styled raster density algorithms.
+    '''
+    rnd = layer.renderer()
+    if layer.type() != QgsMapLayerType.RasterLayer or rnd.bandCount() != 1:
+        feedback.reportError('This is only for single band raster images.')
+        raise QgsProcessingException()
+        
+    if interp == 0: # Discrete
+        interpolation = QgsColorRampShader.Discrete
+    elif interp == 1: # Interpolated
+        interpolation = QgsColorRampShader.Interpolated
+    elif interp == 2: # Exact
+        interpolation = QgsColorRampShader.Exact
+
+    if mode == 0: # Continuous
+        shader_mode = QgsColorRampShader.Continuous
+    elif mode == 1: # Equal Interval
+        shader_mode = QgsColorRampShader.EqualInterval
+    elif mode == 2: # Quantile
+        shader_mode = QgsColorRampShader.Quantile
+
+    provider = layer.dataProvider()
+    if build_overviews and provider.name() == 'gdal' and not provider.hasPyramids():
+        # Sampled statistics are read from the overviews so they no longer need to scan the full resolution band
+        feedback.pushInfo('Building overviews')
+        buildOverviews(provider, feedback)
+    # A sample size of 0 reads every pixel
+    stats = provider.bandStatistics(1, QgsRasterBandStats.Min | QgsRasterBandStats.Max, QgsRectangle(), sample_size)
+    
+    style = QgsStyle.defaultStyle()
+    ramp = style.colorRamp(ramp_name)
+    if invert:
+        ramp.invert()
+    color_ramp = QgsColorRampShader(stats.minimumValue, stats.maximumValue, ramp, interpolation, shader_mode)
+    if shader_mode == QgsColorRampShader.Quantile:
+        if sample_size > 0:
+            color_ramp.setColorRampItemList(sampledQuantileItems(provider, ramp, num_classes, interpolation, sample_size))
+        else:
+            color_ramp.classifyColorRamp(classes=num_classes, band=1, input=provider)
+    else:
+        color_ramp.classifyColorRamp(classes=num_classes)
+
+    raster_shader = QgsRasterShader()
+    raster_shader.setRasterShaderFunction(color_ramp)
+
+    # Create a new single band pseudocolor renderer
+    renderer = QgsSingleBandPseudoColorRenderer(provider, layer.type(), raster_shader)
+
+    layer.setRenderer(renderer)
+    layer.triggerRepaint()
+
 class RasterStyleAlgorithm(QgsProcessingAlgorithm):
     def initAlgorithm(self, config=None):
         self.addParameter(
@@ -74,6 +169,22 @@ class RasterStyleAlgorithm(QgsProcessingAlgorithm):
                 minValue=2,
                 optional=False)
         )
+        param = QgsProcessingParameterNumber(
+            'SAMPLE_SIZE',
+            'Number of pixels sampled for statistics (0 uses all pixels)',
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=0,
+            minValue=0,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterBoolean(
+            'BUILD_OVERVIEWS',
+            'Build overviews if they are missing',
+            False,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
 
     def processAlgorithm(self, parameters, context, feedback):
         layer = self.parameterAsRasterLayer(parameters, 'INPUT', context)
@@ -85,47 +196,10 @@ class RasterStyleAlgorithm(QgsProcessingAlgorithm):
         interp = self.parameterAsInt(parameters, 'INTERPOLATION', context)
         mode = self.parameterAsInt(parameters, 'MODE', context)
         num_classes = self.parameterAsInt(parameters, 'CLASSES', context)
+        sample_size = self.parameterAsInt(parameters, 'SAMPLE_SIZE', context)
+        build_overviews = self.parameterAsBool(parameters, 'BUILD_OVERVIEWS', context)
         
-        rnd = layer.renderer()
-        if layer.type() != QgsMapLayerType.RasterLayer or rnd.bandCount() != 1:
-            feedback.reportError('This is only for single band raster images.')
-            raise QgsProcessingException()
-            
-        if interp == 0: # Discrete
-            interpolation = QgsColorRampShader.Discrete
-        elif interp == 1: # Interpolated
-            interpolation = QgsColorRampShader.Interpolated
-        elif interp == 2: # Exact
-            interpolation = QgsColorRampShader.Exact
-
-        if mode == 0: # Continuous
-            shader_mode = QgsColorRampShader.Continuous
-        elif mode == 1: # Equal Interval
-            shader_mode = QgsColorRampShader.EqualInterval
-        elif mode == 2: # Quantile
-            shader_mode = QgsColorRampShader.Quantile
-
-        provider = layer.dataProvider()
-        stats = provider.bandStatistics(1, QgsRasterBandStats.Min | QgsRasterBandStats.Max)
-        
-        style = QgsStyle.defaultStyle()
-        ramp = style.colorRamp(ramp_name)
-        if invert:
-            ramp.invert()
-        color_ramp = QgsColorRampShader(stats.minimumValue, stats.maximumValue, ramp, interpolation, shader_mode)
-        if shader_mode == QgsColorRampShader.Quantile:
-            color_ramp.classifyColorRamp(classes=num_classes, band=1, input=provider)
-        else:
-            color_ramp.classifyColorRamp(classes=num_classes)
-
-        raster_shader = QgsRasterShader()
-        raster_shader.setRasterShaderFunction(color_ramp)
-
-        # Create a new single band pseudocolor renderer
-        renderer = QgsSingleBandPseudoColorRenderer(provider, layer.type(), raster_shader)
-
-        layer.setRenderer(renderer)
-        layer.triggerRepaint()
+        applyRasterStyle(layer, ramp_name, invert, interp, mode, num_classes, sample_size, build_overviews, feedback)
         return({})
 
     def group(self):
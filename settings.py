@@ -16,6 +16,8 @@ from qgis.PyQt.QtGui import QColor
 
 POLYGON_UNIT_LABELS = ["Kilometers", "Meters", "Miles", 'Yards', "Feet", "Nautical Miles", "Degrees", "Dimensions in pixels"]
 UNIT_LABELS = ["Kilometers", "Meters", "Miles", 'Yards', "Feet", "Nautical Miles", "Degrees"]
+TIME_BIN_LABELS = ['Hour', 'Day', 'Week']
+AGGREGATE_LABELS = ['Count, or sum of the weight field if one is selected', 'Sum', 'Mean', 'Minimum', 'Maximum', 'Standard deviation', 'Distinct count (approximate)', 'Percentile (approximate)']
 COLOR_RAMP_MODE = ['Equal Count (Quantile)','Equal Interval','Logarithmic scale','Natural Breaks (Jenks)','Pretty Breaks','Standard Deviation']
 
 def conversionToCrsUnits(selected_unit, crs_unit, value):
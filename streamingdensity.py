@@ -0,0 +1,353 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+from collections import deque
+
+from qgis.PyQt.uic import loadUiType
+from qgis.PyQt.QtCore import Qt, QObject, QTimer, QDateTime, pyqtSignal
+from qgis.PyQt.QtWidgets import QDialog, QMessageBox
+from qgis.core import (
+    Qgis,
+    QgsMapLayerProxyModel,
+    QgsFieldProxyModel,
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsExpression,
+    QgsVectorLayer,
+    QgsCoordinateTransform,
+    QgsProject)
+from .densityengine import epsg4326, densityFields, geohashCellKey, h3CellKey, geohashGeometry, h3CellGeometry, toDateTime, timeSeconds
+from .graduatedstyle import applyGraduatedStyle
+from .settings import settings
+from .utils import h3InstallString
+
+FORM_CLASS, _ = loadUiType(os.path.join(
+    os.path.dirname(__file__), 'ui/streamingdensity.ui'))
+
+class SlidingWindowCounts():
+    '''
+    Point counts per cell over a sliding time window. Arrivals are appended to a time
+    ordered ring buffer and expire from its front once they are older than the window.
+    The window ends at the latest arrival or at the clock time given to expire, whichever
+    is later, so the cells still empty out when no more points arrive. Each update costs
+    the number of arrivals plus the number of expirations, and the cells whose counts
+    changed are kept until published.
+    '''
+    def __init__(self, window):
+        self.window = window
+        self.buffer = deque()
+        # cell: [number of points, sum of their weights]
+        self.counts = {}
+        self.dirty = set()
+        self.latest = None
+        self.clock = None
+
+    def __len__(self):
+        return len(self.counts)
+
+    def end(self):
+        '''Returns the time that the window ends at or None before the first arrival.'''
+        if self.clock is None or (self.latest is not None and self.latest > self.clock):
+            return self.latest
+        return self.clock
+
+    def add(self, t, cell, weight=1):
+        '''Adds a point and returns False if it arrived too late to be in the window.'''
+        end = self.end()
+        if end is not None and t <= end - self.window:
+            # Late arrivals that are already outside of the window are ignored
+            return False
+        self.buffer.append((t, cell, weight))
+        entry = self.counts.get(cell)
+        if entry is None:
+            self.counts[cell] = [1, weight]
+        else:
+            entry[0] += 1
+            entry[1] += weight
+        self.dirty.add(cell)
+        if self.latest is None or t > self.latest:
+            self.latest = t
+        return True
+
+    def expire(self, now=None):
+        '''
+        Removes the points that have left the window and returns how many there were. If now
+        is given the window ends at least at that time in seconds since the epoch.
+        '''
+        if now is not None and (self.clock is None or now > self.clock):
+            self.clock = now
+        end = self.end()
+        if end is None:
+            return 0
+        cutoff = end - self.window
+        buffer = self.buffer
+        counts = self.counts
+        cnt = 0
+        while buffer and buffer[0][0] <= cutoff:
+            t, cell, weight = buffer.popleft()
+            entry = counts[cell]
+            entry[0] -= 1
+            entry[1] -= weight
+            if entry[0] == 0:
+                del counts[cell]
+            self.dirty.add(cell)
+            cnt += 1
+        return cnt
+
+    def takeDirty(self):
+        dirty = self.dirty
+        self.dirty = set()
+        return dirty
+
+class StreamingDensity(QObject):
+    '''
+    Keeps a geohash or H3 density memory layer up to date with a point layer that is
+    being appended to. At every refresh only the points at or after the latest time read,
+    less the lateness allowance in seconds, are requested, ordered by time, and only the
+    cells whose counts changed are written. Points that arrive with a time more than the
+    allowance before the latest time read are not counted. The window ends at the latest
+    point time or at the current time less the allowance, whichever is later, so cells
+    expire even when the layer stops being appended to.
+    '''
+    # Number of points counted, points skipped, points expired and cells
+    updated = pyqtSignal(int, int, int, int)
+
+    def __init__(self, layer, time_field, weight_field, h3, resolution, window, interval, lateness=0, parent=None):
+        super(StreamingDensity, self).__init__(parent)
+        self.layer = layer
+        self.time_field = time_field
+        self.weight_field = weight_field
+        if h3:
+            self.cell_key = h3CellKey(h3, resolution)
+            self.cell_geometry = h3CellGeometry(h3)
+            self.cell_name = h3.h3_to_string
+            hash_name = 'H3HASH'
+        else:
+            self.cell_key = geohashCellKey(resolution)
+            self.cell_geometry = geohashGeometry
+            self.cell_name = str
+            hash_name = 'GEOHASH'
+        self.counts = SlidingWindowCounts(window)
+        self.lateness = lateness
+        dest_crs = epsg4326()
+        if layer.crs() != dest_crs:
+            self.transform = QgsCoordinateTransform(layer.crs(), dest_crs, QgsProject.instance())
+        else:
+            self.transform = None
+        self.output = QgsVectorLayer('Polygon?crs=epsg:4326', '{} streaming density'.format(layer.name()), 'memory')
+        self.output.dataProvider().addAttributes(densityFields(hash_name).toList())
+        self.output.updateFields()
+        self.num_points_idx = self.output.fields().indexOf('NUMPOINTS')
+        self.cell_fids = {}
+        self.next_id = 0
+        self.styled = False
+        # Latest time that was read and the times of the points read within the lateness allowance of it
+        self.last_time = None
+        self.seen = {}
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.refresh)
+
+    def start(self):
+        # The first refresh only reads the points within one window of the latest point
+        idx = self.layer.fields().indexOf(self.time_field)
+        latest = toDateTime(self.layer.maximumValue(idx))
+        if latest is not None:
+            self.last_time = latest.addSecs(-self.counts.window)
+        self.refresh()
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def isActive(self):
+        return self.timer.isActive()
+
+    def arrivals(self):
+        '''Returns the request for the points at or after the latest time read less the lateness allowance.'''
+        quoted_field = QgsExpression.quotedColumnRef(self.time_field)
+        request = QgsFeatureRequest()
+        attributes = [self.time_field]
+        if self.weight_field:
+            attributes.append(self.weight_field)
+        request.setSubsetOfAttributes(attributes, self.layer.fields())
+        if self.last_time is not None:
+            request.setFilterExpression('{} >= {}'.format(
+                quoted_field, QgsExpression.quotedValue(self.last_time.addSecs(-self.lateness).toString(Qt.ISODateWithMs))))
+        request.addOrderBy(quoted_field, ascending=True)
+        return request
+
+    def readArrivals(self):
+        '''
+        Counts the new points and returns how many were counted and how many were skipped
+        because their time, geometry or cell was invalid or they arrived too late.
+        '''
+        cnt = 0
+        skipped = 0
+        last_time = self.last_time
+        seen = self.seen
+        for f in self.layer.getFeatures(self.arrivals()):
+            if f.id() in seen:
+                continue
+            dt = toDateTime(f[self.time_field])
+            if dt is None:
+                skipped += 1
+                continue
+            t = timeSeconds(dt)
+            seen[f.id()] = t
+            if last_time is None or dt > last_time:
+                last_time = dt
+            try:
+                pt = f.geometry().asPoint()
+                if self.transform:
+                    pt = self.transform.transform(pt)
+                cell = self.cell_key(pt.y(), pt.x())
+                if cell is None:
+                    skipped += 1
+                    continue
+                weight = f[self.weight_field] if self.weight_field else 1
+                if self.counts.add(t, cell, weight):
+                    cnt += 1
+                else:
+                    skipped += 1
+            except Exception:
+                skipped += 1
+        self.last_time = last_time
+        if last_time is not None:
+            # Only the points that the next request can return again need to be remembered
+            cutoff = timeSeconds(last_time) - self.lateness
+            self.seen = {fid: t for fid, t in seen.items() if t >= cutoff}
+        return cnt, skipped
+
+    def publish(self):
+        '''Writes the cells whose counts changed since the last refresh to the memory layer.'''
+        provider = self.output.dataProvider()
+        counts = self.counts.counts
+        changes = {}
+        deletes = []
+        cells = []
+        features = []
+        for cell in self.counts.takeDirty():
+            fid = self.cell_fids.get(cell)
+            entry = counts.get(cell)
+            if entry is None:
+                if fid is not None:
+                    deletes.append(fid)
+                    del self.cell_fids[cell]
+            elif fid is None:
+                geom = self.cell_geometry(cell)
+                if geom is None:
+                    continue
+                f = QgsFeature(self.output.fields())
+                f.setGeometry(geom)
+                f.setAttributes([self.next_id, self.cell_name(cell), entry[1]])
+                self.next_id += 1
+                cells.append(cell)
+                features.append(f)
+            else:
+                changes[fid] = {self.num_points_idx: entry[1]}
+        if deletes:
+            provider.deleteFeatures(deletes)
+        if changes:
+            provider.changeAttributeValues(changes)
+        if features:
+            ok, added = provider.addFeatures(features)
+            if ok:
+                for cell, f in zip(cells, added):
+                    self.cell_fids[cell] = f.id()
+        if deletes or changes or features:
+            self.output.triggerRepaint()
+
+    def refresh(self):
+        arrivals, skipped = self.readArrivals()
+        expired = self.counts.expire(QDateTime.currentDateTimeUtc().toSecsSinceEpoch() - self.lateness)
+        self.publish()
+        if not self.styled and len(self.counts):
+            # Style the layer once it has cells using the default color ramp settings
+            applyGraduatedStyle(self.output, 'NUMPOINTS', settings.defaultColorRamp(), False,
+                settings.num_ramp_classes, settings.color_ramp_mode, True)
+            self.styled = True
+        self.updated.emit(arrivals, skipped, expired, len(self.counts))
+
+class StreamingDensityDialog(QDialog, FORM_CLASS):
+    def __init__(self, iface, parent):
+        super(StreamingDensityDialog, self).__init__(parent)
+        self.setupUi(self)
+        self.iface = iface
+        self.stream = None
+        self.layerComboBox.setFilters(QgsMapLayerProxyModel.PointLayer)
+        self.layerComboBox.layerChanged.connect(self.layerChanged)
+        self.timeComboBox.setFilters(QgsFieldProxyModel.Date | QgsFieldProxyModel.DateTime | QgsFieldProxyModel.String)
+        self.weightComboBox.setFilters(QgsFieldProxyModel.Numeric)
+        self.weightComboBox.setAllowEmptyFieldName(True)
+        self.cellTypeComboBox.currentIndexChanged.connect(self.cellTypeChanged)
+        self.startButton.clicked.connect(self.start)
+        self.stopButton.clicked.connect(self.stop)
+        self.closeButton.clicked.connect(self.close)
+        self.layerChanged()
+
+    def showEvent(self, e):
+        self.layerChanged()
+
+    def layerChanged(self):
+        layer = self.layerComboBox.currentLayer()
+        self.timeComboBox.setLayer(layer)
+        self.weightComboBox.setLayer(layer)
+
+    def cellTypeChanged(self, index):
+        # Geohash resolutions go to 12 and H3 resolutions to 15
+        self.resolutionSpinBox.setMaximum(15 if index == 1 else 12)
+
+    def start(self):
+        layer = self.layerComboBox.currentLayer()
+        time_field = self.timeComboBox.currentField()
+        if not layer or not time_field:
+            self.iface.messageBar().pushMessage("", "Select a point layer and its time field", level=Qgis.Warning, duration=4)
+            return
+        h3 = None
+        if self.cellTypeComboBox.currentIndex() == 1:
+            try:
+                import h3.api.basic_int as h3
+            except Exception:
+                QMessageBox.information(self, 'H3 Install Instructions', h3InstallString)
+                return
+        self.stop()
+        self.stream = StreamingDensity(layer, time_field, self.weightComboBox.currentField(), h3,
+            self.resolutionSpinBox.value(), self.windowSpinBox.value() * 60,
+            self.refreshSpinBox.value() * 1000, self.lateSpinBox.value(), self)
+        self.stream.updated.connect(self.updated)
+        self.stream.output.willBeDeleted.connect(self.outputDeleted)
+        QgsProject.instance().addMapLayer(self.stream.output)
+        self.stream.start()
+        self.startButton.setEnabled(False)
+        self.stopButton.setEnabled(True)
+
+    def outputDeleted(self):
+        # Only the removal of the running stream's layer stops it
+        if self.stream and self.sender() is self.stream.output:
+            self.stop()
+
+    def stop(self):
+        if self.stream:
+            self.stream.stop()
+            self.stream.updated.disconnect(self.updated)
+            try:
+                self.stream.output.willBeDeleted.disconnect(self.outputDeleted)
+            except (TypeError, RuntimeError):
+                # The layer has already been deleted
+                pass
+            self.stream = None
+        self.statusLabel.setText('Stopped')
+        self.startButton.setEnabled(True)
+        self.stopButton.setEnabled(False)
+
+    def updated(self, arrivals, skipped, expired, num_cells):
+        self.statusLabel.setText('{} new points, {} skipped, {} expired, {} cells'.format(arrivals, skipped, expired, num_cells))
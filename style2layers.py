@@ -14,11 +14,84 @@ import re
 from qgis.PyQt.QtXml import QDomDocument
 from qgis.PyQt.QtWidgets import QDialog, QApplication
 from qgis.PyQt.uic import loadUiType
-from qgis.core import Qgis, QgsMapLayerType
+from qgis.core import Qgis, QgsMapLayerType, QgsProject, QgsPathResolver, QgsTask, QgsApplication, QgsVectorLayerFeatureSource, QgsRendererRange
+from .classbreaks import sampleLayerValues, DEFAULT_SAMPLE_SIZE
 
 FORM_CLASS, _ = loadUiType(os.path.join(
     os.path.dirname(__file__), 'ui/styleToLayer.ui'))
 
+def resolveRelativePaths(node, resolver):
+    '''
+    Replaces the ./ and ../ paths, such as SVG markers and fill images, in the attributes
+    and text of a parsed style with the absolute paths that resolver reads them as. This
+    lets importNamedStyle find files relative to the style file like loadNamedStyle does.
+    '''
+    if node.isElement():
+        attrs = node.attributes()
+        for i in range(attrs.count()):
+            attr = attrs.item(i).toAttr()
+            if attr.value().startswith(('./', '../')):
+                attr.setValue(resolver.readPath(attr.value()))
+    elif node.isText():
+        text = node.toText()
+        if text.data().startswith(('./', '../')):
+            text.setData(resolver.readPath(text.data()))
+    child = node.firstChild()
+    while not child.isNull():
+        resolveRelativePaths(child, resolver)
+        child = child.nextSibling()
+
+class LayerBreaksTask(QgsTask):
+    '''
+    Calculates the graduated class breaks of one layer in a background thread from a
+    sample of its classification attribute. The renderer is updated in the main thread.
+    '''
+    def __init__(self, layer, attr, num_classes, method):
+        super(LayerBreaksTask, self).__init__('Reclassifying {}'.format(layer.name()), QgsTask.CanCancel)
+        # The feature source must be created in the main thread
+        self.source = QgsVectorLayerFeatureSource(layer)
+        self.fields = layer.fields()
+        self.layer_id = layer.id()
+        self.attr = attr
+        self.num_classes = num_classes
+        self.method = method
+        self.ranges = None
+
+    def run(self):
+        sample = sampleLayerValues(self.source, self.attr, DEFAULT_SAMPLE_SIZE, self, self.fields)
+        if self.isCanceled():
+            return False
+        self.ranges = self.method.classes(sample.classValues(), self.num_classes)
+        return True
+
+
+class ReclassifyLayersTask(QgsTask):
+    '''
+    Parent task of the per layer break calculations. The subtasks run concurrently
+    and the progress of the parent task reflects all of them.
+    '''
+    def __init__(self, layer_tasks):
+        super(ReclassifyLayersTask, self).__init__('Reclassifying {} layers'.format(len(layer_tasks)), QgsTask.CanCancel)
+        self.layer_tasks = layer_tasks
+        for task in layer_tasks:
+            self.addSubTask(task, [], QgsTask.ParentDependsOnSubTask)
+
+    def run(self):
+        return not self.isCanceled()
+
+
+def applyBreaks(layer, ranges):
+    '''Replaces the class ranges of a graduated renderer while keeping its symbols.'''
+    renderer = layer.renderer()
+    symbols = [r.symbol().clone() for r in renderer.ranges()]
+    if not symbols:
+        symbols = [renderer.sourceSymbol().clone()]
+    renderer.deleteAllClasses()
+    for i, r in enumerate(ranges):
+        renderer.addClassRange(QgsRendererRange(r, symbols[min(i, len(symbols) - 1)].clone()))
+    if len(ranges) != len(symbols) and renderer.sourceColorRamp():
+        renderer.updateColorRamp(renderer.sourceColorRamp().clone())
+
 
 class StyleToLayers(QDialog, FORM_CLASS):
 
@@ -28,37 +101,88 @@ class StyleToLayers(QDialog, FORM_CLASS):
         self.iface = iface
         self.canvas = iface.mapCanvas()
         self.fileWidget.setFilter("*.qml")
+        self.task = None
 
     def accept(self):
         path = self.fileWidget.filePath().strip()
         reclassify = self.autoReclassifyCheckBox.isChecked()
-        if not path:
-            doc = QDomDocument()
+        # The style is parsed once and imported into each of the layers
+        doc = QDomDocument()
+        if path:
+            try:
+                with open(path, encoding='utf-8') as qml:
+                    text = qml.read()
+            except Exception:
+                text = ''
+            if not doc.setContent(text):
+                self.iface.messageBar().pushMessage("","Invalid style file {}".format(path), level=Qgis.Warning, duration=4)
+                return
+        else:
             text = QApplication.clipboard().text()
             if not doc.setContent(text):
                 self.iface.messageBar().pushMessage("","Invalid clipboard style content", level=Qgis.Warning, duration=4)
                 return
+        if path:
+            # Relative paths are resolved from the style file once, before it is imported into the layers
+            resolveRelativePaths(doc, QgsPathResolver(path))
         total_layers = 0
         success = 0
-        for layer in self.iface.layerTreeView().selectedLayersRecursive():
-            total_layers += 1
-            if path:
-                (msg, status) = layer.loadNamedStyle(path)
-            else:
+        layer_tasks = []
+        # Repaints are deferred until the canvas is refreshed once at the end
+        self.canvas.freeze(True)
+        try:
+            for layer in self.iface.layerTreeView().selectedLayersRecursive():
+                total_layers += 1
                 try:
                     (status, msg) = layer.importNamedStyle(doc)
                 except Exception:
                     status = False
 
-            if status:
-                layer_type = layer.type()
-                if reclassify and layer_type == QgsMapLayerType.VectorLayer and layer.renderer().type() == 'graduatedSymbol':
-                    renderer = layer.renderer()
-                    nclass = len(renderer.ranges())
-                    renderer.updateClasses(layer, nclass)
-                layer.triggerRepaint()
-                success += 1
+                if status:
+                    layer_type = layer.type()
+                    if reclassify and layer_type == QgsMapLayerType.VectorLayer and layer.renderer().type() == 'graduatedSymbol':
+                        renderer = layer.renderer()
+                        nclass = len(renderer.ranges())
+                        attr = renderer.classAttribute()
+                        if layer.fields().indexOf(attr) != -1 and renderer.classificationMethod():
+                            layer_tasks.append(LayerBreaksTask(layer, attr, nclass, renderer.classificationMethod().clone()))
+                        else:
+                            # Expressions are classified using all of the features
+                            renderer.updateClasses(layer, nclass)
+                    layer.triggerRepaint(True)
+                    success += 1
+        finally:
+            self.canvas.freeze(False)
+        self.canvas.refresh()
 
         self.iface.messageBar().pushMessage("","Style applied to {} out of {} layers".format(success, total_layers), level=Qgis.Info, duration=4)
+        if layer_tasks:
+            if self.task:
+                try:
+                    self.task.cancel()
+                except Exception:
+                    pass
+            self.task = ReclassifyLayersTask(layer_tasks)
+            self.task.taskCompleted.connect(self.reclassifyFinished)
+            self.task.taskTerminated.connect(self.reclassifyFinished)
+            QgsApplication.taskManager().addTask(self.task)
+
+        self.close()
 
-        self.close()
\ No newline at end of file
+    def reclassifyFinished(self):
+        task = self.sender()
+        if task is None:
+            return
+        count = 0
+        for layer_task in task.layer_tasks:
+            layer = QgsProject.instance().mapLayer(layer_task.layer_id)
+            if not layer or layer_task.ranges is None or layer.renderer().type() != 'graduatedSymbol':
+                continue
+            applyBreaks(layer, layer_task.ranges)
+            layer.triggerRepaint(True)
+            self.iface.layerTreeView().refreshLayerSymbology(layer.id())
+            count += 1
+        if task is self.task:
+            self.task = None
+        self.canvas.refresh()
+        self.iface.messageBar().pushMessage("","Reclassified {} out of {} layers".format(count, len(task.layer_tasks)), level=Qgis.Info, duration=4)
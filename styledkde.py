@@ -9,6 +9,7 @@
  ***************************************************************************/
 """
 import os
+import math
 from qgis.PyQt.QtCore import QUrl
 from qgis.PyQt.QtGui import QIcon
 from qgis.core import Qgis, QgsStyle, QgsUnitTypes, QgsProject
@@ -28,6 +29,8 @@ from qgis.core import (
 import processing
 from .settings import settings, UNIT_LABELS, conversionToCrsUnits, conversionFromCrsUnits
 
+TILED_STATISTICS_SAMPLE = 2500000
+
 class StyledKdeAlgorithm(QgsProcessingAlgorithm):
 
     def initAlgorithm(self, config=None):
@@ -71,6 +74,14 @@ class StyledKdeAlgorithm(QgsProcessingAlgorithm):
             type=QgsProcessingParameterNumber.Integer, minValue=1, defaultValue=settings.max_image_size, optional=False)
         param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
         self.addParameter(param)
+        param = QgsProcessingParameterEnum('ENGINE', 'Kernel density engine',
+            options=['QGIS heatmap', 'Native binned grid convolution (faster for large radii)'], defaultValue=0, optional=False)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterBoolean('TILED', 'Tiled output for very large images (native engine only, ignores maximum dimensions)',
+            False, optional=False)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
         param = QgsProcessingParameterEnum('KERNEL', 'Kernel shape',
             options=['Quartic', 'Triangular', 'Uniform', 'Triweight', 'Epanechnikov'], defaultValue=0, optional=False)
         param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
@@ -122,6 +133,8 @@ class StyledKdeAlgorithm(QgsProcessingAlgorithm):
         kernel_shape = self.parameterAsEnum(parameters, 'KERNEL', context)
         decay = self.parameterAsDouble(parameters, 'DECAY', context)
         output_value = self.parameterAsEnum(parameters, 'OUTPUT_VALUE', context)
+        engine = self.parameterAsEnum(parameters, 'ENGINE', context)
+        tiled = self.parameterAsBool(parameters, 'TILED', context) and engine == 1
         if Qgis.QGIS_VERSION_INT >= 32200:
             ramp_name = self.parameterAsString(parameters, 'RAMP_NAMES', context)
         else:
@@ -142,7 +155,7 @@ class StyledKdeAlgorithm(QgsProcessingAlgorithm):
         # Add one additional cell, half on each side to better encapsulate the data
         width = int(extent.width() / pixel_size_extent)
         height = int(extent.height() / pixel_size_extent)
-        if width > max_dimension or height > max_dimension:
+        if not tiled and (width > max_dimension or height > max_dimension):
             feedback.reportError('The grid pixel size exceeds the maximum output image dimensions as follows:')
             feedback.reportError('Output image width: {}'.format(width))
             feedback.reportError('Output image height: {}'.format(height))
@@ -163,19 +176,38 @@ class StyledKdeAlgorithm(QgsProcessingAlgorithm):
         unit_str = QgsUnitTypes.encodeUnit(layer_units)
         feedback.pushInfo('Grid pixel size: {} {}'.format(pixel_size_extent, unit_str))
         feedback.pushInfo('Kernel radius size: {} {}'.format(radius, unit_str))
-        # Heatmap (Kernel Density Estimation)
-        alg_params = {
-            'DECAY': decay,
-            'INPUT': parameters['INPUT'],
-            'KERNEL': kernel_shape,
-            'OUTPUT_VALUE': output_value,
-            'PIXEL_SIZE': pixel_size_extent,
-            'RADIUS': radius,
-            'RADIUS_FIELD': '',
-            'WEIGHT_FIELD': '',
-            'OUTPUT': parameters['OUTPUT']
-        }
-        outputs['HeatmapKDE'] = processing.run('qgis:heatmapkerneldensityestimation', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        if engine == 1:
+            try:
+                from . import kde
+            except Exception:
+                raise QgsProcessingException('The native kernel density engine requires the numpy python library.')
+            output = self.parameterAsOutputLayer(parameters, 'OUTPUT', context)
+            # Use the same grid as the QGIS heatmap algorithm which buffers the extent by the radius
+            x_min = extent.xMinimum() - radius
+            y_max = extent.yMaximum() + radius
+            cols = max(int(math.ceil((extent.width() + 2 * radius) / pixel_size_extent)) + 1, 1)
+            rows = max(int(math.ceil((extent.height() + 2 * radius) / pixel_size_extent)) + 1, 1)
+            if tiled:
+                kde.tiledKernelDensity(layer, output, x_min, y_max, pixel_size_extent, rows, cols, radius,
+                    kernel_shape, decay, output_value == 1, feedback)
+            else:
+                kde.kernelDensity(layer, output, x_min, y_max, pixel_size_extent, rows, cols, radius,
+                    kernel_shape, decay, output_value == 1, feedback)
+            outputs['HeatmapKDE'] = {'OUTPUT': output}
+        else:
+            # Heatmap (Kernel Density Estimation)
+            alg_params = {
+                'DECAY': decay,
+                'INPUT': parameters['INPUT'],
+                'KERNEL': kernel_shape,
+                'OUTPUT_VALUE': output_value,
+                'PIXEL_SIZE': pixel_size_extent,
+                'RADIUS': radius,
+                'RADIUS_FIELD': '',
+                'WEIGHT_FIELD': '',
+                'OUTPUT': parameters['OUTPUT']
+            }
+            outputs['HeatmapKDE'] = processing.run('qgis:heatmapkerneldensityestimation', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
         results['Heatmap'] = outputs['HeatmapKDE']['OUTPUT']
 
         if feedback.isCanceled():
@@ -190,6 +222,9 @@ class StyledKdeAlgorithm(QgsProcessingAlgorithm):
             'INVERT': invert,
             'RAMP_NAMES': ramp_name
         }
+        if tiled:
+            # Read the statistics of the large image from its overviews
+            alg_params['SAMPLE_SIZE'] = TILED_STATISTICS_SAMPLE
         outputs['Styled'] = processing.run('densityanalysis:rasterstyle', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
         return results
 
@@ -11,7 +11,7 @@
 import os
 from qgis.PyQt.QtCore import QUrl
 from qgis.PyQt.QtGui import QIcon
-from qgis.core import Qgis, QgsStyle
+from qgis.core import Qgis, QgsStyle, QgsProcessingUtils
 
 from qgis.core import (
     QgsProcessing,
@@ -28,6 +28,7 @@ from qgis.core import (
     )
 import processing
 from .settings import settings, POLYGON_UNIT_LABELS
+from .rasterstyle import applyRasterStyle
 
 class StyledPolygonRasterDensityAlgorithm(QgsProcessingAlgorithm):
 
@@ -118,7 +119,7 @@ class StyledPolygonRasterDensityAlgorithm(QgsProcessingAlgorithm):
         if Qgis.QGIS_VERSION_INT >= 32200:
             ramp_name = self.parameterAsString(parameters, 'RAMP_NAMES', context)
         else:
-            ramp_name = self.parameterAsEnum(parameters, 'RAMP_NAMES', context)
+            ramp_name = settings.ramp_names[self.parameterAsEnum(parameters, 'RAMP_NAMES', context)]
         invert = self.parameterAsBool(parameters, 'INVERT', context)
         interp = self.parameterAsInt(parameters, 'INTERPOLATION', context)
         mode = self.parameterAsInt(parameters, 'MODE', context)
@@ -143,16 +144,10 @@ class StyledPolygonRasterDensityAlgorithm(QgsProcessingAlgorithm):
         if feedback.isCanceled():
             return {}
 
-        # Apply pseudocolor raster style
-        alg_params = {
-            'CLASSES': num_classes,
-            'INPUT': outputs['PolygonDensity']['OUTPUT'],
-            'INTERPOLATION': interp,
-            'MODE': mode,
-            'INVERT': invert,
-            'RAMP_NAMES': ramp_name
-        }
-        outputs['PseudocolorStyle'] = processing.run('densityanalysis:rasterstyle', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        # Apply a pseudocolor raster style directly to the output layer
+        layer = QgsProcessingUtils.mapLayerFromString(results['Output'], context)
+        if layer:
+            applyRasterStyle(layer, ramp_name, invert, interp, mode, num_classes, feedback=feedback)
 
         return results
 
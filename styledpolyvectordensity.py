@@ -11,7 +11,7 @@
 import os
 from qgis.PyQt.QtCore import QUrl
 from qgis.PyQt.QtGui import QIcon
-from qgis.core import Qgis
+from qgis.core import Qgis, QgsProcessingUtils
 
 from qgis.core import (
     QgsProcessing,
@@ -27,6 +27,7 @@ from qgis.core import (
     )
 import processing
 from .settings import settings, COLOR_RAMP_MODE
+from .graduatedstyle import applyGraduatedStyle
 
 class StyledPolygonVectorDensityAlgorithm(QgsProcessingAlgorithm):
     def initAlgorithm(self, config=None):
@@ -112,8 +113,8 @@ class StyledPolygonVectorDensityAlgorithm(QgsProcessingAlgorithm):
             # In this case ramp_name will be the name
             ramp_name = self.parameterAsString(parameters, 'RAMP_NAMES', context)
         else:
-            # In this case ramp_name will be an index into ramp_names
-            ramp_name = self.parameterAsEnum(parameters, 'RAMP_NAMES', context)
+            # In this case RAMP_NAMES is an index into ramp_names
+            ramp_name = settings.ramp_names[self.parameterAsEnum(parameters, 'RAMP_NAMES', context)]
         ramp_mode = self.parameterAsInt(parameters, 'COLOR_RAMP_MODE', context)
         no_outline = self.parameterAsBool(parameters, 'NO_OUTLINE', context)
         invert = self.parameterAsBool(parameters, 'INVERT', context)
@@ -134,17 +135,10 @@ class StyledPolygonVectorDensityAlgorithm(QgsProcessingAlgorithm):
         if feedback.isCanceled():
             return {}
 
-        # Apply a graduated style
-        alg_params = {
-            'NO_OUTLINE': no_outline,
-            'INVERT': invert,
-            'CLASSES': num_classes,
-            'GROUP_FIELD': 'NUMPOINTS',
-            'INPUT': outputs['PolyVectorDensity']['OUTPUT'],
-            'MODE': ramp_mode,
-            'RAMP_NAMES': ramp_name
-        }
-        processing.run('densityanalysis:graduatedstyle', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        # Apply a graduated style directly to the output layer
+        layer = QgsProcessingUtils.mapLayerFromString(results['OUTPUT'], context)
+        if layer:
+            applyGraduatedStyle(layer, 'NUMPOINTS', ramp_name, invert, num_classes, ramp_mode, no_outline, feedback=feedback)
         return results
 
     def group(self):
@@ -0,0 +1,16 @@
+"""
+Loads the plugin directory as the densityanalysis package so that its modules, which use
+relative imports, can be imported by the tests without installing the plugin in QGIS.
+"""
+import os
+import sys
+import importlib.util
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'densityanalysis' not in sys.modules:
+    spec = importlib.util.spec_from_file_location('densityanalysis', os.path.join(PLUGIN_DIR, '__init__.py'),
+        submodule_search_locations=[PLUGIN_DIR])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['densityanalysis'] = module
+    spec.loader.exec_module(module)
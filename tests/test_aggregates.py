@@ -0,0 +1,102 @@
+import random
+
+import pytest
+
+from densityanalysis.aggregates import (
+    HyperLogLog, TDigest, CellAggregate, isNull, HLL_SPARSE_LIMIT,
+    AGG_MEAN, AGG_MIN, AGG_MAX, AGG_STDDEV, AGG_DISTINCT, AGG_PERCENTILE)
+
+
+def test_hyperloglog_is_exact_while_sparse():
+    hll = HyperLogLog()
+    for i in range(HLL_SPARSE_LIMIT):
+        hll.add('vessel{}'.format(i))
+        hll.add('vessel{}'.format(i))
+    assert hll.registers is None
+    assert hll.count() == HLL_SPARSE_LIMIT
+
+
+@pytest.mark.parametrize('n', [1000, 50000])
+def test_hyperloglog_estimate_is_within_its_error(n):
+    hll = HyperLogLog()
+    for i in range(n):
+        hll.add(i)
+    # The standard error is about 3% so 10% is more than three standard errors
+    assert abs(hll.count() - n) < 0.1 * n
+
+
+@pytest.mark.parametrize('sizes', [(50, 60), (50, 5000), (5000, 50), (5000, 7000)])
+def test_hyperloglog_merge_matches_a_single_sketch(sizes):
+    first = HyperLogLog()
+    second = HyperLogLog()
+    combined = HyperLogLog()
+    for i in range(sizes[0]):
+        first.add(i)
+        combined.add(i)
+    # The second set overlaps the first by half of its values
+    for i in range(sizes[0] // 2, sizes[0] // 2 + sizes[1]):
+        second.add(i)
+        combined.add(i)
+    first.merge(second)
+    assert first.count() == combined.count()
+
+
+def test_tdigest_percentiles_are_close():
+    rng = random.Random(1)
+    values = [rng.gauss(0, 1) for _ in range(20000)]
+    digest = TDigest()
+    for v in values:
+        digest.add(v)
+    values.sort()
+    for q in (0.01, 0.25, 0.5, 0.75, 0.95, 0.99):
+        exact = values[int(q * (len(values) - 1))]
+        assert digest.quantile(q) == pytest.approx(exact, abs=0.05)
+    assert digest.quantile(0) == values[0]
+    assert digest.quantile(1) == values[-1]
+
+
+def test_tdigest_empty_and_single_value():
+    digest = TDigest()
+    assert digest.quantile(0.5) is None
+    digest.add(3.0)
+    assert digest.quantile(0.5) == 3.0
+
+
+def test_cell_aggregate_statistics():
+    values = [4.0, 1.0, 7.0, 2.0]
+    results = {}
+    for aggregate in (AGG_MEAN, AGG_MIN, AGG_MAX, AGG_STDDEV):
+        agg = CellAggregate(aggregate)
+        for v in values + [None, 'abc']:
+            agg.add(v)
+        assert agg.count == 6
+        results[aggregate] = agg.value()
+    assert results[AGG_MEAN] == pytest.approx(3.5)
+    assert results[AGG_MIN] == 1.0
+    assert results[AGG_MAX] == 7.0
+    assert results[AGG_STDDEV] == pytest.approx(2.2912878)
+
+
+def test_cell_aggregate_distinct_and_percentile():
+    distinct = CellAggregate(AGG_DISTINCT)
+    for v in ['a', 'b', 'a', None, 'c']:
+        distinct.add(v)
+    assert distinct.count == 5
+    assert distinct.value() == 3
+    percentile = CellAggregate(AGG_PERCENTILE, 50)
+    for v in range(101):
+        percentile.add(v)
+    assert percentile.value() == pytest.approx(50, abs=1)
+
+
+def test_cell_aggregate_without_values():
+    agg = CellAggregate(AGG_MEAN)
+    agg.add(None)
+    assert agg.count == 1
+    assert agg.value() is None
+
+
+def test_is_null():
+    assert isNull(None)
+    assert not isNull(0)
+    assert not isNull('')
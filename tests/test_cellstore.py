@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from densityanalysis.cellstore import CellStore
+from densityanalysis.hotspots import CELL_GEOHASH, CELL_H3
+
+CELLS = {'u09tv': 5.0, 'u09tw': 1.0, '9q8yy': 12.0, 'dr5ru': 3.0}
+
+
+def test_from_cells_sorts_by_id():
+    store = CellStore.fromCells(CELL_GEOHASH, CELLS)
+    assert len(store) == 4
+    assert np.all(np.diff(store.ids) > 0)
+    assert dict(store.cells()) == CELLS
+
+
+def test_threshold():
+    store = CellStore.fromCells(CELL_GEOHASH, CELLS).threshold(3)
+    assert dict(store.cells()) == {'u09tv': 5.0, '9q8yy': 12.0, 'dr5ru': 3.0}
+
+
+def test_merge_sums_shared_cells():
+    first = CellStore.fromCells(CELL_GEOHASH, CELLS)
+    second = CellStore.fromCells(CELL_GEOHASH, {'u09tv': 2.0, 'c2b2q': 4.0})
+    merged = CellStore.fromCells(CELL_GEOHASH, {}).merge(first).merge(second)
+    expected = dict(CELLS)
+    expected['u09tv'] = 7.0
+    expected['c2b2q'] = 4.0
+    assert dict(merged.cells()) == expected
+    assert np.all(np.diff(merged.ids) > 0)
+
+
+def test_sample_keeps_exact_extremes():
+    store = CellStore(CELL_H3, np.arange(1000, dtype=np.int64), np.arange(1000, dtype=np.float64))
+    sample = store.sample(100)
+    assert sample.count == 1000
+    assert len(sample.values) == 100
+    assert (sample.minimum, sample.maximum) == (0.0, 999.0)
+    assert store.sample(0).values == list(range(1000))
+
+
+def test_npz_round_trip(tmp_path):
+    path = str(tmp_path / 'cells.npz')
+    store = CellStore.fromCells(CELL_GEOHASH, CELLS)
+    store.save(path)
+    loaded = CellStore.load(path)
+    assert loaded.cell_type == CELL_GEOHASH
+    np.testing.assert_array_equal(loaded.ids, store.ids)
+    np.testing.assert_array_equal(loaded.values, store.values)
+    assert dict(loaded.cells()) == CELLS
+
+
+def test_parquet_round_trip(tmp_path):
+    pytest.importorskip('pyarrow')
+    path = str(tmp_path / 'cells.parquet')
+    store = CellStore(CELL_H3, np.array([3, 1, 2], dtype=np.int64), np.array([3.0, 1.0, 2.0]))
+    store.save(path)
+    loaded = CellStore.load(path)
+    assert loaded.cell_type == CELL_H3
+    assert list(loaded.cells()) == [(1, 1.0), (2, 2.0), (3, 3.0)]
@@ -0,0 +1,53 @@
+import random
+
+import pytest
+
+from densityanalysis import geohash
+
+
+def randomHashes(precision, n=200, seed=0):
+    rng = random.Random(seed)
+    return [geohash.encode(rng.uniform(-90, 90), rng.uniform(-180, 180), precision) for _ in range(n)]
+
+
+@pytest.mark.parametrize('precision', range(1, 13))
+def test_to_int_round_trip(precision):
+    for h in randomHashes(precision):
+        value = geohash.to_int(h)
+        assert value < 1 << 63
+        assert geohash.from_int(value) == h
+
+
+def test_to_int_keeps_precisions_apart():
+    assert geohash.to_int('0') != geohash.to_int('00')
+    assert geohash.from_int(geohash.to_int('00')) == '00'
+
+
+def test_to_int_orders_like_the_hashes():
+    hashes = sorted(randomHashes(7))
+    values = [geohash.to_int(h) for h in hashes]
+    assert values == sorted(values)
+
+
+def test_neighbors_surround_the_cell():
+    lat, lon, lat_err, lon_err = geohash.decode_exactly('u09tvw')
+    expected = set()
+    for dlat in (-1, 0, 1):
+        for dlon in (-1, 0, 1):
+            if dlat or dlon:
+                expected.add(geohash.encode(lat + 2 * dlat * lat_err, lon + 2 * dlon * lon_err, 6))
+    assert set(geohash.neighbors('u09tvw')) == expected
+
+
+def test_neighbors_wrap_at_the_antimeridian_and_stop_at_the_poles():
+    east = geohash.encode(0.1, 179.99, 4)
+    assert any(geohash.decode_exactly(n)[1] < 0 for n in geohash.neighbors(east))
+    north = geohash.encode(89.99, 10.0, 4)
+    result = geohash.neighbors(north)
+    assert len(result) == 5
+    assert None not in result
+
+
+def test_is_valid():
+    assert geohash.is_valid('u09tvw')
+    assert not geohash.is_valid('u09a')
@@ -0,0 +1,128 @@
+import random
+
+import numpy as np
+import pytest
+
+from densityanalysis import geohash
+from densityanalysis.hotspots import DensityCells, CELL_GRID, CELL_GEOHASH, geohashNeighborInts, connectedComponents, clusterCells, giStar
+
+
+def gridCells(cells):
+    '''Creates rectangle grid cells of unit size from a dictionary of (row, column): score.'''
+    result = DensityCells(CELL_GRID)
+    for fid, ((row, col), score) in enumerate(cells.items()):
+        result.fids.append(fid)
+        result.scores.append(score)
+        result.extents.extend([col, -row - 1, col + 1, -row])
+    return result
+
+
+def edgeSet(src, dst):
+    return set(zip(src.tolist(), dst.tolist()))
+
+
+@pytest.mark.parametrize('precision', range(1, 13))
+def test_geohash_neighbor_ints_match_neighbors(precision):
+    rng = random.Random(precision)
+    hashes = [geohash.encode(rng.uniform(-90, 90), rng.uniform(-180, 180), precision) for _ in range(100)]
+    hashes.append(geohash.encode(89.9999, 179.9999, precision))
+    hashes.append(geohash.encode(-89.9999, -179.9999, precision))
+    values = np.array([geohash.to_int(h) for h in hashes], dtype=np.int64)
+    for h, row in zip(hashes, geohashNeighborInts(values, precision)):
+        assert sorted(v for v in row.tolist() if v >= 0) == sorted(geohash.to_int(n) for n in geohash.neighbors(h))
+
+
+def test_geohash_edges_and_empty_neighbors():
+    hashes = ['u09tv'] + geohash.neighbors('u09tv')[:3] + ['9q8yy']
+    cells = DensityCells(CELL_GEOHASH)
+    for fid, h in enumerate(hashes):
+        cells.hashes.append(h)
+        cells.fids.append(fid)
+        cells.scores.append(1.0)
+    index = {h: i for i, h in enumerate(hashes)}
+    expected = set()
+    empty = set()
+    counts = [0] * len(hashes)
+    for i, h in enumerate(hashes):
+        for n in geohash.neighbors(h):
+            if n in index:
+                expected.add((i, index[n]))
+            else:
+                empty.add(n)
+                counts[i] += 1
+    assert edgeSet(*cells.edges()) == expected
+    empty_neighbors, num_empty = cells.emptyNeighbors()
+    assert empty_neighbors.tolist() == counts
+    assert num_empty == len(empty)
+
+
+def test_rectangle_edges_use_the_eight_neighborhood():
+    cells = gridCells({(0, 0): 1, (0, 1): 1, (1, 1): 1, (2, 3): 1, (0, 3): 1})
+    assert edgeSet(*cells.edges()) == {(0, 1), (1, 0), (0, 2), (2, 0), (1, 2), (2, 1)}
+
+
+def test_connected_components_match_a_union_find():
+    rng = random.Random(3)
+    for _ in range(30):
+        n = rng.randint(1, 200)
+        pairs = [(rng.randrange(n), rng.randrange(n)) for _ in range(rng.randint(0, 250))]
+        src = np.array([a for a, b in pairs] + [b for a, b in pairs], dtype=np.int64)
+        dst = np.array([b for a, b in pairs] + [a for a, b in pairs], dtype=np.int64)
+        labels = connectedComponents(n, src, dst)
+        parent = list(range(n))
+        def find(i):
+            while parent[i] != i:
+                i = parent[i]
+            return i
+        for a, b in pairs:
+            parent[find(a)] = find(b)
+        components = {}
+        for i in range(n):
+            components.setdefault(find(i), []).append(i)
+        for members in components.values():
+            assert all(labels[i] == min(members) for i in members)
+
+
+def test_connected_components_of_a_long_shuffled_chain():
+    n = 100000
+    order = np.random.default_rng(0).permutation(n)
+    src = np.concatenate((order[:-1], order[1:]))
+    dst = np.concatenate((order[1:], order[:-1]))
+    assert np.all(connectedComponents(n, src, dst) == 0)
+
+
+def test_clusters_are_ranked_by_total_score():
+    cells = gridCells({(0, 0): 5, (0, 1): 4, (5, 5): 8, (9, 0): 1, (9, 1): 2})
+    clusters = clusterCells(cells)
+    assert [c.tolist() for c in clusters] == [[0, 1], [2], [4, 3]]
+
+
+def test_gi_star_counts_empty_grid_cells_as_zero():
+    scores = {(0, 0): 1.0, (0, 2): 2.0, (2, 1): 3.0, (3, 3): 6.0}
+    sparse = gridCells(scores)
+    src, dst = sparse.edges()
+    z, p = giStar(sparse.scores, src, dst, *sparse.emptyNeighbors())
+    dense = gridCells({(r, c): scores.get((r, c), 0.0) for r in range(4) for c in range(4)})
+    dense_src, dense_dst = dense.edges()
+    dense_z, dense_p = giStar(dense.scores, dense_src, dense_dst)
+    cells = [r * 4 + c for r, c in scores]
+    np.testing.assert_allclose(z, dense_z[cells])
+    np.testing.assert_allclose(p, dense_p[cells])
+
+
+def test_gi_star_of_a_lone_hotspot():
+    # One high cell surrounded by low ones is a significant hotspot
+    scores = {(r, c): 1.0 for r in range(9) for c in range(9)}
+    scores[(4, 4)] = 50.0
+    cells = gridCells(scores)
+    z, p = giStar(cells.scores, *cells.edges())
+    center = list(scores).index((4, 4))
+    assert z[center] == z.max()
+    assert z[center] > 1.96
+    assert p[center] < 0.05
+
+
+def test_gi_star_is_undefined_without_variance():
+    cells = gridCells({(0, 0): 2.0, (0, 1): 2.0})
+    z, p = giStar(cells.scores, *cells.edges())
+    assert np.isnan(z).all() and np.isnan(p).all()
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from densityanalysis import kdekernels
+from densityanalysis.kdekernels import kernelWindow, directConvolve, fftConvolve, convolve, binPoints
+
+
+def randomGrid(rows, cols, seed=0):
+    rng = np.random.default_rng(seed)
+    grid = np.zeros((rows, cols), dtype=np.float32)
+    grid.flat[rng.choice(rows * cols, rows * cols // 20, replace=False)] = rng.integers(1, 5, rows * cols // 20)
+    return grid
+
+
+@pytest.mark.parametrize('shape', [0, 1, 2, 3, 4])
+def test_direct_and_fft_convolution_agree(shape):
+    grid = randomGrid(60, 45)
+    kernel = kernelWindow(shape, 5.0, 1.0, scaled=True)
+    direct = directConvolve(grid, kernel)
+    fft = fftConvolve(grid, kernel)
+    assert direct.shape == grid.shape
+    np.testing.assert_allclose(fft, direct, rtol=1e-4, atol=1e-6)
+
+
+def test_fft_blocks_match_direct_convolution(monkeypatch):
+    # Small FFT blocks exercise the overlap-add across block edges
+    monkeypatch.setattr(kdekernels, 'FFT_TILE_SIZE', 16)
+    grid = randomGrid(50, 70, seed=1)
+    kernel = kernelWindow(0, 4.0, 1.0)
+    np.testing.assert_allclose(fftConvolve(grid, kernel), directConvolve(grid, kernel), rtol=1e-4, atol=1e-5)
+
+
+def test_single_point_spreads_the_kernel():
+    grid = np.zeros((21, 21), dtype=np.float32)
+    grid[10, 10] = 1
+    kernel = kernelWindow(4, 3.0, 1.0)
+    out = convolve(grid, kernel)
+    np.testing.assert_allclose(out[7:14, 7:14], kernel, rtol=1e-6)
+    assert out.sum() == pytest.approx(kernel.sum())
+
+
+def test_kernel_is_zero_outside_the_radius():
+    kernel = kernelWindow(2, 2.5, 1.0)
+    assert kernel.shape == (7, 7)
+    assert kernel[0, 0] == 0
+    assert kernel[3, 3] == 1
+
+
+def test_bin_points_counts_points_in_pixels():
+    xs = np.array([0.5, 0.6, 2.5, -1.0, 9.0])
+    ys = np.array([2.5, 2.4, 0.5, 1.0, 1.0])
+    grid = binPoints(xs, ys, 0.0, 3.0, 1.0, 3, 3)
+    assert grid[0, 0] == 2
+    assert grid[2, 2] == 1
+    assert grid.sum() == 3
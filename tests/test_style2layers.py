@@ -0,0 +1,36 @@
+import os
+import pytest
+
+pytest.importorskip('qgis.core')
+
+from qgis.testing import start_app
+from qgis.PyQt.QtXml import QDomDocument
+from qgis.core import QgsVectorLayer, QgsMarkerSymbol, QgsSvgMarkerSymbolLayer, QgsSingleSymbolRenderer, QgsPathResolver
+
+start_app()
+
+from densityanalysis.style2layers import resolveRelativePaths
+
+SVG = '<svg xmlns="http://www.w3.org/2000/svg" width="10" height="10"><circle cx="5" cy="5" r="4"/></svg>'
+
+def test_relative_svg_path_resolves_from_style_file(tmp_path):
+    svg_path = str(tmp_path / 'marker.svg')
+    with open(svg_path, 'w') as f:
+        f.write(SVG)
+    qml_path = str(tmp_path / 'style.qml')
+    styled = QgsVectorLayer('Point?crs=epsg:4326', 'styled', 'memory')
+    symbol = QgsMarkerSymbol()
+    symbol.changeSymbolLayer(0, QgsSvgMarkerSymbolLayer(svg_path))
+    styled.setRenderer(QgsSingleSymbolRenderer(symbol))
+    styled.saveNamedStyle(qml_path)
+    with open(qml_path, encoding='utf-8') as f:
+        text = f.read()
+    assert './marker.svg' in text
+
+    doc = QDomDocument()
+    assert doc.setContent(text)
+    resolveRelativePaths(doc, QgsPathResolver(qml_path))
+    layer = QgsVectorLayer('Point?crs=epsg:4326', 'target', 'memory')
+    status, msg = layer.importNamedStyle(doc)
+    assert status, msg
+    assert os.path.normpath(layer.renderer().symbol().symbolLayer(0).path()) == os.path.normpath(svg_path)
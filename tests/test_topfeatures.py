@@ -0,0 +1,69 @@
+import random
+
+import pytest
+
+from densityanalysis.hotspots import topFeatures
+
+
+class Feature():
+    def __init__(self, fid, attributes):
+        self.fid = fid
+        self.attributes = attributes
+
+    def id(self):
+        return self.fid
+
+    def __getitem__(self, name):
+        return self.attributes[name]
+
+
+class Task():
+    def __init__(self, cancel_after=None):
+        self.checks = 0
+        self.cancel_after = cancel_after
+        self.progress = []
+
+    def isCanceled(self):
+        self.checks += 1
+        return self.cancel_after is not None and self.checks > self.cancel_after
+
+    def setProgress(self, value):
+        self.progress.append(value)
+
+
+def randomFeatures(n, seed=0):
+    rng = random.Random(seed)
+    return [Feature(fid, {'id': fid * 10, 'NUMPOINTS': rng.randint(0, 50)}) for fid in range(n)]
+
+
+@pytest.mark.parametrize('k', [1, 10, 999, 1000, 5000])
+def test_heap_matches_sorting(k):
+    features = randomFeatures(1000)
+    fids, ids, scores = topFeatures(iter(features), 'id', 'NUMPOINTS', k)
+    expected = sorted((float(f['NUMPOINTS']) for f in features), reverse=True)[:k]
+    # Cells with tied scores may be listed in a different order than a full sort
+    assert scores == expected
+    assert len(set(fids)) == len(fids)
+    for fid, id, score in zip(fids, ids, scores):
+        assert id == features[fid]['id']
+        assert score == features[fid]['NUMPOINTS']
+
+
+def test_scores_that_are_not_numbers_are_skipped():
+    features = [Feature(1, {'id': 1, 'S': None}), Feature(2, {'id': 2, 'S': '7'}),
+        Feature(3, {'id': 3, 'S': 'abc'}), Feature(4, {'id': 4, 'S': 3})]
+    fids, ids, scores = topFeatures(features, 'id', 'S', 10)
+    assert list(fids) == [2, 4]
+    assert scores == [7.0, 3.0]
+
+
+def test_canceled_task_returns_nothing():
+    task = Task(cancel_after=5)
+    fids, ids, scores = topFeatures(randomFeatures(100), 'id', 'NUMPOINTS', 10, task)
+    assert len(fids) == 0 and ids == [] and scores == []
+
+
+def test_progress_is_reported():
+    task = Task()
+    topFeatures(randomFeatures(25000), 'id', 'NUMPOINTS', 10, task, 25000)
+    assert task.progress == [0, 20, 40]
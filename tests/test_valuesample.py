@@ -0,0 +1,64 @@
+import math
+
+from densityanalysis.valuesample import ValueSample
+
+
+def test_sample_is_bounded_and_keeps_exact_extremes():
+    sample = ValueSample(100)
+    for v in range(10000):
+        sample.add(v)
+    assert sample.count == 10000
+    assert len(sample.values) == 100
+    assert sample.minimum == 0
+    assert sample.maximum == 9999
+    values = sample.classValues()
+    assert values[-2:] == [0, 9999]
+    assert len(set(sample.values)) == 100
+
+
+def test_sample_is_spread_over_all_values():
+    sample = ValueSample(1000)
+    for v in range(100000):
+        sample.add(v)
+    # A uniform reservoir sample of 0..99999 has a mean close to 50000
+    mean = sum(sample.values) / len(sample.values)
+    assert abs(mean - 50000) < 5000
+
+
+def test_small_input_is_kept_whole():
+    sample = ValueSample(10)
+    for v in (3, 1, 2):
+        sample.add(v)
+    assert sorted(sample.values) == [1, 2, 3]
+    assert sample.minimum == 1
+    assert sample.maximum == 3
+
+
+def test_zero_size_keeps_every_value():
+    sample = ValueSample(0)
+    for v in range(500):
+        sample.add(v)
+    assert len(sample.values) == 500
+
+
+def test_invalid_values_are_ignored():
+    sample = ValueSample(10)
+    for v in (None, 'abc', math.nan, '4', 2):
+        sample.add(v)
+    assert sample.count == 2
+    assert sorted(sample.values) == [2.0, 4.0]
+
+
+def test_empty_sample():
+    sample = ValueSample(10)
+    assert sample.isEmpty()
+    assert sample.classValues() == []
+
+
+def test_sampling_is_repeatable():
+    first = ValueSample(50)
+    second = ValueSample(50)
+    for v in range(5000):
+        first.add(v)
+        second.add(v)
+    assert first.values == second.values
@@ -0,0 +1,57 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import random
+
+# Number of cell values the density algorithms keep for styling their output
+DEFAULT_SAMPLE_SIZE = 10000
+
+class ValueSample():
+    '''
+    Bounded reservoir sample of numeric values. The exact count, minimum and
+    maximum of all the values that were added are also kept so that the outer
+    class breaks are not affected by sampling.
+    '''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.values = []
+        self.count = 0
+        self.minimum = None
+        self.maximum = None
+        self.rand = random.Random(0)
+
+    def add(self, value):
+        try:
+            value = float(value)
+        except Exception:
+            return
+        if value != value:  # NaN
+            return
+        self.count += 1
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        if self.max_size <= 0 or len(self.values) < self.max_size:
+            self.values.append(value)
+        else:
+            # Algorithm R: replace an existing entry with probability max_size / count
+            i = self.rand.randrange(self.count)
+            if i < self.max_size:
+                self.values[i] = value
+
+    def isEmpty(self):
+        return self.count == 0
+
+    def classValues(self):
+        '''Returns the sampled values including the exact minimum and maximum.'''
+        if self.count == 0:
+            return []
+        return self.values + [self.minimum, self.maximum]